@@ -0,0 +1,306 @@
+import asyncio
+import math
+import threading
+import time
+from collections import defaultdict
+from config import ADMISSION_CONFIG
+from metrics import ADMISSION_REJECTED, ADMISSION_WAIT
+
+# 上游调用的准入控制：同时进行的请求数上限 + 令牌桶限速 + 有界等待队列
+#
+# 容量和令牌都可用时请求直接放行；否则进入等待队列，按优先级（数值越小越优先）出队，
+# 同一优先级内启用会话公平时优先放行进行中请求较少的会话，一个会话的大量请求不会饿死其他用户。
+# 队列已满、会话排队数超限、或按当前平均耗时估算无法在等待时限内轮到时立即拒绝，
+# 调用方返回 429 和建议的 Retry-After，不再让请求占着线程一直等到超时。
+# 传入请求的截止时间（deadline.py）时，等待时限不超过其剩余时间，截止前来不及轮到的请求同样尽早拒绝。
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+class AdmissionRejected(Exception):
+    """请求未被接纳，reason 为拒绝原因，retry_after 为建议的重试等待时间（秒）"""
+    
+    def __init__(self, reason, retry_after, message):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积累 burst 个"""
+    
+    def __init__(self, rate, burst=0):
+        self.rate = rate
+        self.burst = max(1, burst or math.ceil(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+    
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, count=1):
+        """再积累到 count 个令牌需要的时间"""
+        return max(0.0, (count - self.tokens) / self.rate)
+
+
+class Waiter:
+    """等待队列中的一个请求"""
+    __slots__ = ("session_id", "priority", "seq", "enqueued_at", "deadline", "notify", "granted")
+    
+    def __init__(self, session_id, priority, seq, now, timeout, notify):
+        self.session_id = session_id
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = now
+        self.deadline = now + timeout
+        self.notify = notify
+        self.granted = False
+
+
+class Permit:
+    """已获准的上游调用，结束时调用 release（可重复调用），也可作为上下文管理器使用"""
+    
+    def __init__(self, controller, session_id):
+        self.controller = controller
+        self.session_id = session_id
+        self.started_at = time.monotonic()
+        self.released = False
+    
+    def release(self):
+        if not self.released:
+            self.released = True
+            if self.controller is not None:
+                self.controller._release(self)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class AdmissionController:
+    """同步（线程）与异步（asyncio）调用方共用的准入控制器，内部状态由一把锁保护
+    
+    max_concurrency 为同时进行的上游请求上限；rate 为每秒允许开始的请求数，0 表示不限速；
+    max_queue 为等待队列长度，queue_timeout 为默认的最长排队时间；
+    max_session_queue 为单个会话最多排队的请求数，0 表示不限制。未启用时直接放行所有请求。
+    """
+    
+    def __init__(self, max_concurrency=10, rate=0, burst=0, max_queue=100, queue_timeout=10,
+                 fair_sessions=True, max_session_queue=0, enabled=True):
+        self.enabled = enabled
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.fair_sessions = fair_sessions
+        self.max_session_queue = max_session_queue
+        self.lock = threading.Lock()
+        self.queue = []
+        self.active = 0
+        self.session_active = defaultdict(int)
+        self.session_queued = defaultdict(int)
+        self.seq = 0
+        # 获准请求的平均持续时间（指数移动平均），用于估算排队时间
+        self.avg_duration = None
+        self.admitted = 0
+        self.rejected = defaultdict(int)
+    
+    def acquire(self, session_id=None, priority=PRIORITIES["normal"], timeout=None, deadline=None):
+        """获取上游调用许可，排队期间阻塞当前线程；无法接纳时抛出 AdmissionRejected
+        
+        排队时间不超过 timeout（默认 queue_timeout），指定 deadline 时也不超过其剩余时间。
+        """
+        if not self.enabled:
+            return Permit(None, session_id)
+        event = threading.Event()
+        waiter = self._enqueue(session_id, priority, timeout, deadline, event.set)
+        if waiter is None:
+            return Permit(self, session_id)
+        while True:
+            remaining = waiter.deadline - time.monotonic()
+            if remaining > 0:
+                event.wait(self._poll_interval(remaining))
+            with self.lock:
+                if not waiter.granted:
+                    self._dispatch()
+                if waiter.granted:
+                    break
+                if remaining <= 0:
+                    raise self._timed_out(waiter)
+        ADMISSION_WAIT.observe(time.monotonic() - waiter.enqueued_at)
+        return Permit(self, session_id)
+    
+    async def acquire_async(self, session_id=None, priority=PRIORITIES["normal"], timeout=None, deadline=None):
+        """acquire 的异步版本，排队期间不占用事件循环；等待中被取消时退出队列"""
+        if not self.enabled:
+            return Permit(None, session_id)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        def notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+        
+        waiter = self._enqueue(session_id, priority, timeout, deadline, notify)
+        if waiter is None:
+            return Permit(self, session_id)
+        try:
+            while True:
+                remaining = waiter.deadline - time.monotonic()
+                if remaining > 0:
+                    try:
+                        await asyncio.wait_for(asyncio.shield(future), self._poll_interval(remaining))
+                    except asyncio.TimeoutError:
+                        pass
+                with self.lock:
+                    if not waiter.granted:
+                        self._dispatch()
+                    if waiter.granted:
+                        break
+                    if remaining <= 0:
+                        raise self._timed_out(waiter)
+        except asyncio.CancelledError:
+            with self.lock:
+                granted = waiter.granted
+                if not granted:
+                    self._remove(waiter)
+            if granted:
+                Permit(self, session_id).release()
+            raise
+        ADMISSION_WAIT.observe(time.monotonic() - waiter.enqueued_at)
+        return Permit(self, session_id)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "active": self.active,
+                "queued": len(self.queue),
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "rate": self.bucket.rate if self.bucket else 0,
+                "avg_duration": self.avg_duration,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected)
+            }
+    
+    def _enqueue(self, session_id, priority, timeout, deadline, notify):
+        """能立即放行时返回None，否则放入等待队列并返回 Waiter；无法接纳时抛出 AdmissionRejected"""
+        timeout = self.queue_timeout if timeout is None else timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline.remaining())
+        now = time.monotonic()
+        with self.lock:
+            self._dispatch(now)
+            if not self.queue and self._has_capacity():
+                self._start(session_id)
+                ADMISSION_WAIT.observe(0)
+                return None
+            if len(self.queue) >= self.max_queue:
+                raise self._reject("queue_full", "请求过多，等待队列已满")
+            if self.max_session_queue and self.session_queued.get(session_id, 0) >= self.max_session_queue:
+                raise self._reject("session_limit", "该会话排队中的请求过多")
+            if self._estimate_wait(priority) > timeout:
+                raise self._reject("deadline", "预计排队时间超过等待时限")
+            self.seq += 1
+            waiter = Waiter(session_id, priority, self.seq, now, timeout, notify)
+            self.queue.append(waiter)
+            self.session_queued[session_id] += 1
+            return waiter
+    
+    def _has_capacity(self):
+        return self.active < self.max_concurrency and (self.bucket is None or self.bucket.tokens >= 1)
+    
+    def _start(self, session_id):
+        self.active += 1
+        self.session_active[session_id] += 1
+        self.admitted += 1
+        if self.bucket is not None:
+            self.bucket.tokens -= 1
+    
+    def _rank(self, waiter):
+        """出队顺序：优先级、（会话公平时）该会话进行中的请求数、入队顺序"""
+        share = self.session_active.get(waiter.session_id, 0) if self.fair_sessions else 0
+        return waiter.priority, share, waiter.seq
+    
+    def _dispatch(self, now=None):
+        """在容量和令牌允许的范围内放行排队的请求（需持有锁）"""
+        if self.bucket is not None:
+            self.bucket.refill(time.monotonic() if now is None else now)
+        while self.queue and self._has_capacity():
+            waiter = min(self.queue, key=self._rank)
+            self._remove(waiter)
+            self._start(waiter.session_id)
+            waiter.granted = True
+            waiter.notify()
+    
+    def _remove(self, waiter):
+        self.queue.remove(waiter)
+        self.session_queued[waiter.session_id] -= 1
+        if not self.session_queued[waiter.session_id]:
+            del self.session_queued[waiter.session_id]
+    
+    def _release(self, permit):
+        duration = time.monotonic() - permit.started_at
+        with self.lock:
+            self.active -= 1
+            self.session_active[permit.session_id] -= 1
+            if not self.session_active[permit.session_id]:
+                del self.session_active[permit.session_id]
+            self.avg_duration = duration if self.avg_duration is None else 0.8 * self.avg_duration + 0.2 * duration
+            self._dispatch()
+    
+    def _poll_interval(self, remaining):
+        """被唤醒前的最长等待时间：限速时令牌补充后需要重新尝试放行"""
+        if self.bucket is not None and self.active < self.max_concurrency:
+            return min(remaining, max(0.001, self.bucket.wait_time()))
+        return remaining
+    
+    def _estimate_wait(self, priority):
+        """按排在前面的请求数估算新请求的排队时间，尚无耗时样本时返回0（不按时限拒绝）"""
+        ahead = sum(1 for waiter in self.queue if waiter.priority <= priority) + 1
+        wait = 0.0
+        if self.avg_duration is not None and self.active >= self.max_concurrency:
+            wait = self.avg_duration * ahead / self.max_concurrency
+        if self.bucket is not None:
+            wait = max(wait, self.bucket.wait_time(ahead))
+        return wait
+    
+    def _retry_after(self):
+        """建议的重试等待时间（整秒）：大约是当前队列全部放行所需的时间"""
+        return max(1, math.ceil(self._estimate_wait(max(PRIORITIES.values()))))
+    
+    def _reject(self, reason, message):
+        self.rejected[reason] += 1
+        ADMISSION_REJECTED.inc(reason=reason)
+        return AdmissionRejected(reason, self._retry_after(), message)
+    
+    def _timed_out(self, waiter):
+        self._remove(waiter)
+        return self._reject("timeout", "排队等待超时")
+
+
+def from_config():
+    """按 ADMISSION_CONFIG 创建准入控制器"""
+    return AdmissionController(
+        max_concurrency=ADMISSION_CONFIG["max_concurrency"],
+        rate=ADMISSION_CONFIG["rate"],
+        burst=ADMISSION_CONFIG["burst"],
+        max_queue=ADMISSION_CONFIG["max_queue"],
+        queue_timeout=ADMISSION_CONFIG["queue_timeout"],
+        fair_sessions=ADMISSION_CONFIG["fair_sessions"],
+        max_session_queue=ADMISSION_CONFIG["max_session_queue"],
+        enabled=ADMISSION_CONFIG["enabled"]
+    )
+
+
+def parse_priority(value, trusted=False):
+    """请求中的优先级名称转换为数值，未知的值（包括非字符串）按 normal 处理；high 只对可信的调用方生效"""
+    if not isinstance(value, str):
+        return PRIORITIES["normal"]
+    priority = PRIORITIES.get(value, PRIORITIES["normal"])
+    if priority < PRIORITIES["normal"] and not trusted:
+        return PRIORITIES["normal"]
+    return priority
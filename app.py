@@ -1,19 +1,121 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context, make_response
 from flask_cors import CORS
 import uuid
+import json
 import threading
 import time
+import atexit
+import functools
+import hmac
+import ipaddress
+import logging
 from model_service import SparkModelService
+import admission as admission_control
+from admission import AdmissionRejected
 from message_manager import MessageManager
-from config import APP_CONFIG
+from deadline import request_deadline
+from data_storage import EXPORT_CONTENT_TYPES
+from config import APP_CONFIG, CONTEXT_CONFIG, TRACE_CONFIG, BATCH_CONFIG
+import metrics
+from tracing import TRACER, set_attribute
+from profiling import PROFILER
+from structured_logging import get_logger, setup_logging
 
 app = Flask(__name__)
 app.secret_key = "your_secret_key_here"  # 用于会话管理
 CORS(app)  # 允许跨域请求
 
+# 日志经后台队列写出，请求线程和上游读线程上不做同步IO
+setup_logging()
+logger = get_logger("app")
+
 # 初始化服务
 model_service = SparkModelService()
 message_manager = MessageManager()
+# 上游调用的准入控制，超出配额时排队或快速返回429
+admission = admission_control.from_config()
+# 启动时预热上游连接，首个请求无需等待鉴权和握手
+model_service.warm_up()
+# 进程退出前写入写回队列中的剩余数据
+atexit.register(message_manager.close)
+
+# 导出时读取的指标
+metrics.UPSTREAM_CONNECTIONS.set_function(lambda: model_service.pool.stats()["idle"], state="idle")
+metrics.UPSTREAM_CONNECTIONS.set_function(lambda: model_service.pool.stats()["in_use"], state="in_use")
+metrics.CONTEXT_SESSIONS.set_function(message_manager.get_session_count)
+metrics.CONTEXT_BYTES.set_function(lambda: message_manager.context_store.total_bytes)
+metrics.ADMISSION_REQUESTS.set_function(lambda: admission.active, state="active")
+metrics.ADMISSION_REQUESTS.set_function(lambda: len(admission.queue), state="queued")
+
+def track_request(endpoint):
+    """统计请求的端到端耗时和进行中的请求数，并记录链路追踪；流式响应在发送完毕（或客户端断开）时结束"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            metrics.IN_FLIGHT.inc(endpoint=endpoint)
+            trace = TRACER.begin(endpoint, request.headers.get("X-Request-ID"))
+            profile = PROFILER.begin_request()
+            
+            def finish(error=None):
+                PROFILER.end_request(profile)
+                TRACER.end(trace, error)
+                metrics.IN_FLIGHT.dec(endpoint=endpoint)
+                metrics.CHAT_LATENCY.observe(time.perf_counter() - start_time, endpoint=endpoint)
+            
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception as e:
+                finish(e)
+                raise
+            if trace:
+                response.headers["X-Request-ID"] = trace.request_id
+            response.call_on_close(finish)
+            return response
+        return wrapper
+    return decorator
+
+def is_local_request():
+    """请求直接来自本机；经反向代理转发（带有转发头）的请求不算本机"""
+    if request.headers.get("X-Forwarded-For") or request.headers.get("Forwarded"):
+        return False
+    try:
+        return ipaddress.ip_address(request.remote_addr or "").is_loopback
+    except ValueError:
+        return False
+
+def is_admin():
+    """X-Admin-Token 请求头与管理令牌一致；未配置管理令牌时只允许本机直接访问"""
+    token = TRACE_CONFIG["admin_token"]
+    if not token:
+        return is_local_request()
+    return hmac.compare_digest(request.headers.get("X-Admin-Token", ""), token)
+
+def require_admin(view):
+    """校验管理权限（见 is_admin），无权访问时返回403"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_admin():
+            return jsonify({"error": "无权访问", "success": False}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+def request_priority(data, default="normal"):
+    """请求体中的 priority（high / normal / low）决定排队顺序，high 仅对管理调用方生效"""
+    trusted = TRACE_CONFIG["admin_token"] is not None and is_admin()
+    return admission_control.parse_priority(data.get('priority', default), trusted)
+
+def admit(session_id, data, deadline):
+    """获取上游调用许可，排队时间不超过请求的截止时间"""
+    return admission.acquire(session_id, request_priority(data), deadline=deadline)
+
+def too_many_requests(error):
+    """准入控制拒绝请求时的429响应"""
+    response = jsonify({"error": str(error), "reason": error.reason, "retry_after": error.retry_after,
+                        "success": False})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
 
 # 定期清理过期会话的线程
 class SessionCleaner(threading.Thread):
@@ -26,8 +128,9 @@ class SessionCleaner(threading.Thread):
         while self.running:
             expired_count = message_manager.clean_expired_sessions()
             if expired_count > 0:
-                print(f"清理了 {expired_count} 个过期会话")
-            time.sleep(300)  # 每5分钟清理一次
+                logger.info("清理了 %d 个过期会话", expired_count)
+            # 清理开销只与过期会话数有关，可以频繁执行
+            time.sleep(CONTEXT_CONFIG["cleanup_interval"])
 
 @app.route('/')
 def index():
@@ -37,6 +140,7 @@ def index():
     return render_template('index.html', session_id=session['session_id'])
 
 @app.route('/api/chat', methods=['POST'])
+@track_request("chat")
 def chat():
     """处理聊天请求"""
     try:
@@ -46,18 +150,25 @@ def chat():
         
         if not message:
             return jsonify({"error": "消息不能为空"}), 400
+        set_attribute("session_id", session_id)
+        try:
+            deadline = request_deadline(data.get('timeout'))
+        except (TypeError, ValueError):
+            return jsonify({"error": "timeout 应为正数", "success": False}), 400
         
-        # 添加用户消息到上下文
-        message_manager.add_message(session_id, "user", message)
-        
-        # 获取对话上下文
-        context = message_manager.get_context(session_id)
-        
-        # 调用模型生成回复
-        response = model_service.chat(context)
-        
-        # 添加模型回复到上下文
-        message_manager.add_message(session_id, "assistant", response["text"])
+        # 先获取上游调用许可，被拒绝时不写入用户消息
+        with admit(session_id, data, deadline):
+            # 添加用户消息到上下文
+            message_manager.add_message(session_id, "user", message)
+            
+            # 获取对话上下文
+            context = message_manager.get_context(session_id)
+            
+            # 调用模型生成回复，请求可通过 cache=false 跳过响应缓存
+            response = model_service.chat(context, use_cache=data.get('cache', True), deadline=deadline)
+            
+            # 添加模型回复到上下文
+            message_manager.add_message(session_id, "assistant", response["text"])
         
         return jsonify({
             "session_id": session_id,
@@ -65,9 +176,108 @@ def chat():
             "ref_info": response["ref_info"],
             "success": True
         })
+    except AdmissionRejected as e:
+        return too_many_requests(e)
     except Exception as e:
         return jsonify({"error": str(e), "success": False}), 500
 
+@app.route('/api/chat/stream', methods=['POST'])
+@track_request("chat_stream")
+def chat_stream():
+    """流式聊天请求，以Server-Sent Events逐步返回模型回复"""
+    data = request.json
+    session_id = data.get('session_id', str(uuid.uuid4()))
+    message = data.get('message', '')
+    
+    if not message:
+        return jsonify({"error": "消息不能为空"}), 400
+    set_attribute("session_id", session_id)
+    try:
+        deadline = request_deadline(data.get('timeout'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "timeout 应为正数", "success": False}), 400
+    
+    # 在开始响应前获取上游调用许可，被拒绝时直接返回429；许可在生成结束或客户端断开时释放
+    try:
+        permit = admit(session_id, data, deadline)
+    except AdmissionRejected as e:
+        return too_many_requests(e)
+    
+    # 添加用户消息到上下文并获取对话上下文
+    try:
+        message_manager.add_message(session_id, "user", message)
+        context = message_manager.get_context(session_id)
+    except Exception:
+        permit.release()
+        raise
+    
+    def sse(event):
+        return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+    
+    def generate():
+        text_parts = []
+        ref_info = []
+        try:
+            for event in model_service.chat_stream(context, use_cache=data.get('cache', True), deadline=deadline):
+                if event["type"] == "delta":
+                    text_parts.append(event["content"])
+                else:
+                    ref_info.append(event["search_info"])
+                yield sse(event)
+            
+            # 生成结束后再保存完整回复
+            message_manager.add_message(session_id, "assistant", "".join(text_parts))
+            yield sse({"type": "done", "session_id": session_id, "ref_info": ref_info, "success": True})
+        except Exception as e:
+            yield sse({"type": "error", "error": str(e), "success": False})
+        finally:
+            # 客户端断开时立即关闭上游连接，不再为无人接收的回复消耗配额
+            deadline.cancel()
+            permit.release()
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(deadline.cancel)
+    response.call_on_close(permit.release)
+    return response
+
+@app.route('/api/chat/batch', methods=['POST'])
+@track_request("chat_batch")
+def chat_batch():
+    """批量聊天：并发执行多个独立的对话，结果按完成顺序以NDJSON逐行返回，单项出错不影响其他项"""
+    data = request.json or {}
+    items = data.get('conversations')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "conversations 应为非空列表", "success": False}), 400
+    if len(items) > BATCH_CONFIG["max_items"]:
+        return jsonify({"error": f"单次最多提交 {BATCH_CONFIG['max_items']} 个对话", "success": False}), 400
+    try:
+        parallelism, timeout = model_service.batch_limits(data.get('parallelism'), data.get('timeout'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "parallelism 和 timeout 应为数字", "success": False}), 400
+    
+    # 同一批次的各项按同一个会话参与准入控制的公平调度，默认以低优先级排队
+    batch_id = str(data.get('batch_id') or uuid.uuid4())
+    set_attribute("batch_id", batch_id)
+    priority = request_priority(data, "low")
+    results = model_service.chat_batch(items, parallelism, timeout, use_cache=data.get('cache', True),
+                                       admit=lambda index, deadline: admission.acquire(batch_id, priority, deadline=deadline))
+    
+    def generate():
+        failed = 0
+        try:
+            for result in results:
+                failed += not result["success"]
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+            yield json.dumps({"done": True, "batch_id": batch_id, "total": len(items), "failed": failed,
+                              "success": True}, ensure_ascii=False) + "\n"
+        finally:
+            # 客户端断开时取消尚未开始的项
+            results.close()
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route('/api/clear_context', methods=['POST'])
 def clear_context():
     """清理对话上下文"""
@@ -82,19 +292,139 @@ def clear_context():
 @app.route('/api/session_info', methods=['GET'])
 def session_info():
     """获取会话信息"""
-    return jsonify({
+    info = {
         "session_count": message_manager.get_session_count(),
+        "context_cache": message_manager.context_store.stats(),
+        "admission": admission.stats(),
+        "success": True
+    }
+    if model_service.cache:
+        info["cache"] = model_service.cache.stats()
+    if model_service.singleflight:
+        info["coalescing"] = model_service.singleflight.stats()
+    return jsonify(info)
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    """存活检查，返回上游连接状态"""
+    return jsonify({"status": "ok", "upstream": model_service.health(), "success": True})
+
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    """就绪检查：已建立上游连接时返回200，否则返回503，负载均衡据此决定是否转发流量"""
+    upstream = model_service.health()
+    return jsonify({"ready": upstream["ready"], "upstream": upstream}), 200 if upstream["ready"] else 503
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus文本格式的运行指标"""
+    return Response(metrics.generate_latest(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/api/admin/traces', methods=['GET'])
+@require_admin
+def admin_traces():
+    """查询最近的慢请求链路，可按 request_id 查找"""
+    request_id = request.args.get('request_id')
+    if request_id:
+        trace = TRACER.find(request_id)
+        if trace is None:
+            return jsonify({"error": "未找到该请求", "success": False}), 404
+        return jsonify({"trace": trace, "success": True})
+    return jsonify({
+        "traces": TRACER.recent_slow(request.args.get('limit', type=int)),
+        "stats": TRACER.stats(),
         "success": True
     })
 
+@app.route('/api/admin/profile', methods=['GET', 'POST'])
+@require_admin
+def admin_profile():
+    """开始一次限时性能采集（POST）或查询采集状态（GET）"""
+    if request.method == 'GET':
+        return jsonify({**PROFILER.status(), "success": True})
+    data = request.get_json(silent=True) or {}
+    try:
+        capture = PROFILER.start(data.get('mode', 'sample'), data.get('seconds', 10))
+    except ValueError as e:
+        return jsonify({"error": str(e), "success": False}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e), "success": False}), 409
+    return jsonify({"profile": capture, "success": True})
+
+def export_params(args):
+    """解析导出参数：session_id 可重复或以逗号分隔，since/until 为Unix时间戳"""
+    session_ids = [s for value in args.getlist('session_id') for s in value.split(',') if s] or None
+    since, until = (float(args[key]) if args.get(key) else None for key in ('since', 'until'))
+    return session_ids, since, until
+
+@app.route('/api/export', methods=['GET'])
+@require_admin
+def export():
+    """流式导出对话历史，以分块传输返回，内存占用与会话总数无关"""
+    export_format = request.args.get('format', 'json')
+    compress = request.args.get('gzip', '').lower() in ('1', 'true')
+    try:
+        session_ids, since, until = export_params(request.args)
+        chunks = message_manager.iter_export(export_format, session_ids, since, until, compress)
+    except ValueError as e:
+        return jsonify({"error": str(e), "success": False}), 400
+    except TimeoutError as e:
+        return jsonify({"error": str(e), "success": False}), 503
+    
+    filename = f"conversations.{export_format}" + (".gz" if compress else "")
+    return Response(chunks, content_type="application/gzip" if compress else EXPORT_CONTENT_TYPES[export_format],
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.route('/api/search', methods=['GET'])
+@require_admin
+def search():
+    """全文搜索对话消息：q 为关键词，可按 session_id、since/until 过滤，offset/limit 分页"""
+    if message_manager.search_index is None:
+        return jsonify({"error": "全文搜索未启用", "success": False}), 404
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "缺少搜索关键词", "success": False}), 400
+    try:
+        since, until = (float(request.args[key]) if request.args.get(key) else None for key in ('since', 'until'))
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+    except ValueError:
+        return jsonify({"error": "参数格式错误", "success": False}), 400
+    result = message_manager.search(query, request.args.get('session_id') or None, since, until, offset, limit)
+    return jsonify({**result, "success": True})
+
+@app.route('/api/history', methods=['GET'])
+def history():
+    """分页读取会话历史：返回游标 before 之前的最多 limit 条消息，next_before 为下一页游标"""
+    session_id = request.args.get('session_id', '').strip()
+    if not session_id:
+        return jsonify({"error": "缺少会话ID", "success": False}), 400
+    try:
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+        messages, next_before = message_manager.history(session_id, request.args.get('before') or None, limit)
+    except ValueError:
+        return jsonify({"error": "参数格式错误", "success": False}), 400
+    return jsonify({"session_id": session_id, "messages": messages, "next_before": next_before, "success": True})
+
+@app.route('/api/sessions', methods=['GET'])
+@require_admin
+def sessions():
+    """按最后更新时间倒序分页列出存储的会话，cursor 为上一页返回的 next_cursor"""
+    try:
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+        items, next_cursor = message_manager.list_sessions(request.args.get('cursor') or None, limit)
+    except ValueError:
+        return jsonify({"error": "参数格式错误", "success": False}), 400
+    except TimeoutError as e:
+        return jsonify({"error": str(e), "success": False}), 503
+    return jsonify({"sessions": items, "next_cursor": next_cursor, "success": True})
+
 if __name__ == '__main__':
     # 启动会话清理线程
     cleaner = SessionCleaner()
     cleaner.start()
     
     # 完全禁用Flask的日志输出，只保留自定义输出
-    import logging
-    
     # 禁用werkzeug日志器
     log = logging.getLogger('werkzeug')
     log.setLevel(logging.CRITICAL)  # 只记录致命错误
@@ -103,11 +433,10 @@ if __name__ == '__main__':
     logging.getLogger('flask').setLevel(logging.CRITICAL)
     
     # 自定义启动消息
-    print(f"智能聊天机器人服务已启动")
-    print(f"访问地址: http://127.0.0.1:{APP_CONFIG['port']}")
-    print(f"调试模式: {'开启' if APP_CONFIG['debug'] else '关闭'}")
-    print("按 CTRL+C 停止服务")
-    print("=" * 50)
+    logger.info("智能聊天机器人服务已启动")
+    logger.info("访问地址: http://127.0.0.1:%s", APP_CONFIG['port'])
+    logger.info("调试模式: %s", '开启' if APP_CONFIG['debug'] else '关闭')
+    logger.info("按 CTRL+C 停止服务")
     
     # 启动服务器，使用更简洁的配置
     app.run(
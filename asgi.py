@@ -0,0 +1,545 @@
+import asyncio
+import hmac
+import ipaddress
+import json
+import mimetypes
+import os
+import time
+import uuid
+from contextlib import aclosing
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from async_model_service import AsyncSparkModelService
+import admission as admission_control
+from admission import AdmissionRejected
+from message_manager import MessageManager
+from deadline import request_deadline
+from data_storage import EXPORT_CONTENT_TYPES
+from config import APP_CONFIG, CONTEXT_CONFIG, TRACE_CONFIG, BATCH_CONFIG
+import metrics
+from tracing import TRACER, set_attribute
+from profiling import PROFILER
+from structured_logging import get_logger, setup_logging
+
+# ASGI入口：提供与 app.py 相同的路由，模型调用在事件循环中进行，不再每个请求占用一个线程
+# 启动方式：python asgi.py 或 uvicorn asgi:app
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+
+templates = Environment(loader=FileSystemLoader(os.path.join(BASE_DIR, "templates")),
+                        autoescape=select_autoescape(["html"]))
+templates.globals["url_for"] = lambda endpoint, filename: f"/{endpoint}/{filename}"
+
+# 日志经后台队列写出，请求线程和上游读线程上不做同步IO
+setup_logging()
+logger = get_logger("asgi")
+
+# 初始化服务
+model_service = AsyncSparkModelService()
+message_manager = MessageManager()
+# 上游调用的准入控制，超出配额时排队或快速返回429
+admission = admission_control.from_config()
+metrics.CONTEXT_SESSIONS.set_function(message_manager.get_session_count)
+metrics.CONTEXT_BYTES.set_function(lambda: message_manager.context_store.total_bytes)
+
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-headers", b"Content-Type"),
+    (b"access-control-allow-methods", b"GET, POST, OPTIONS")
+]
+
+async def read_json(receive):
+    """读取完整请求体并解析为JSON"""
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return json.loads(body) if body else {}
+
+async def send_response(send, status, body, content_type, headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), *CORS_HEADERS, *headers]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send_response(send, status, body, "application/json", headers)
+
+def request_priority(scope, data, default="normal"):
+    """请求体中的 priority（high / normal / low）决定排队顺序，high 仅对管理调用方生效"""
+    trusted = TRACE_CONFIG["admin_token"] is not None and is_admin(scope)
+    return admission_control.parse_priority(data.get('priority', default), trusted)
+
+async def admit(scope, session_id, data, deadline):
+    """获取上游调用许可，排队时间不超过请求的截止时间"""
+    return await admission.acquire_async(session_id, request_priority(scope, data), deadline=deadline)
+
+async def too_many_requests(send, error):
+    """准入控制拒绝请求时的429响应"""
+    await send_json(send, {"error": str(error), "reason": error.reason, "retry_after": error.retry_after,
+                           "success": False}, 429, [(b"retry-after", str(error.retry_after).encode())])
+
+async def index(scope, receive, send):
+    # 为每个用户生成唯一的会话ID
+    cookie = SimpleCookie()
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            cookie.load(value.decode('latin-1'))
+    headers = []
+    if "session_id" in cookie:
+        session_id = cookie["session_id"].value
+    else:
+        session_id = str(uuid.uuid4())
+        headers.append((b"set-cookie", f"session_id={session_id}; Path=/; HttpOnly".encode()))
+    
+    body = templates.get_template("index.html").render(session_id=session_id).encode('utf-8')
+    await send_response(send, 200, body, "text/html; charset=utf-8", headers)
+
+async def static(scope, receive, send):
+    path = os.path.normpath(os.path.join(STATIC_DIR, scope["path"][len("/static/"):]))
+    if not path.startswith(STATIC_DIR + os.sep) or not os.path.isfile(path):
+        return await send_json(send, {"error": "文件不存在"}, 404)
+    
+    def read_file():
+        with open(path, 'rb') as f:
+            return f.read()
+    
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    await send_response(send, 200, await asyncio.to_thread(read_file), content_type)
+
+async def wait_disconnect(receive):
+    """等待客户端断开连接"""
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def chat(scope, receive, send):
+    """处理聊天请求，客户端断开时取消生成"""
+    try:
+        data = await read_json(receive)
+        session_id = data.get('session_id', str(uuid.uuid4()))
+        message = data.get('message', '')
+        
+        if not message:
+            return await send_json(send, {"error": "消息不能为空"}, 400)
+        set_attribute("session_id", session_id)
+        try:
+            deadline = request_deadline(data.get('timeout'))
+        except (TypeError, ValueError):
+            return await send_json(send, {"error": "timeout 应为正数", "success": False}, 400)
+        
+        # 先获取上游调用许可，被拒绝时不写入用户消息
+        with await admit(scope, session_id, data, deadline):
+            # 存储读写仍是同步调用，放到线程池中执行
+            await asyncio.to_thread(message_manager.add_message, session_id, "user", message)
+            context = await asyncio.to_thread(message_manager.get_context, session_id)
+            
+            # 客户端断开时取消生成，关闭上游连接，不保存回复
+            generation = asyncio.create_task(model_service.chat(context, deadline=deadline))
+            watcher = asyncio.create_task(wait_disconnect(receive))
+            await asyncio.wait({generation, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not generation.done():
+                generation.cancel()
+                try:
+                    await generation
+                except asyncio.CancelledError:
+                    pass
+                return
+            watcher.cancel()
+            response = generation.result()
+            
+            await asyncio.to_thread(message_manager.add_message, session_id, "assistant", response["text"])
+        
+        await send_json(send, {
+            "session_id": session_id,
+            "response": response["text"],
+            "ref_info": response["ref_info"],
+            "success": True
+        })
+    except AdmissionRejected as e:
+        await too_many_requests(send, e)
+    except Exception as e:
+        await send_json(send, {"error": str(e), "success": False}, 500)
+
+async def chat_stream(scope, receive, send):
+    """流式聊天请求，以Server-Sent Events逐步返回模型回复"""
+    data = await read_json(receive)
+    session_id = data.get('session_id', str(uuid.uuid4()))
+    message = data.get('message', '')
+    
+    if not message:
+        return await send_json(send, {"error": "消息不能为空"}, 400)
+    set_attribute("session_id", session_id)
+    try:
+        deadline = request_deadline(data.get('timeout'))
+    except (TypeError, ValueError):
+        return await send_json(send, {"error": "timeout 应为正数", "success": False}, 400)
+    
+    # 在开始响应前获取上游调用许可，被拒绝时直接返回429
+    try:
+        permit = await admit(scope, session_id, data, deadline)
+    except AdmissionRejected as e:
+        return await too_many_requests(send, e)
+    with permit:
+        await stream_response(send, receive, session_id, message, deadline)
+
+async def stream_response(send, receive, session_id, message, deadline=None):
+    """写入用户消息并以SSE返回模型回复，客户端断开时取消生成"""
+    await asyncio.to_thread(message_manager.add_message, session_id, "user", message)
+    context = await asyncio.to_thread(message_manager.get_context, session_id)
+    
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream; charset=utf-8"), (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no"), *CORS_HEADERS]
+    })
+    
+    async def send_event(event):
+        body = f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8')
+        await send({"type": "http.response.body", "body": body, "more_body": True})
+    
+    async def produce():
+        text_parts = []
+        ref_info = []
+        try:
+            async for event in model_service.chat_stream(context, deadline=deadline):
+                if event["type"] == "delta":
+                    text_parts.append(event["content"])
+                else:
+                    ref_info.append(event["search_info"])
+                await send_event(event)
+            
+            # 生成结束后再保存完整回复
+            await asyncio.to_thread(message_manager.add_message, session_id, "assistant", "".join(text_parts))
+            await send_event({"type": "done", "session_id": session_id, "ref_info": ref_info, "success": True})
+        except Exception as e:
+            await send_event({"type": "error", "error": str(e), "success": False})
+    
+    # 客户端断开时取消生成，关闭上游连接
+    producer = asyncio.create_task(produce())
+    watcher = asyncio.create_task(wait_disconnect(receive))
+    await asyncio.wait({producer, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    if producer.done():
+        watcher.cancel()
+        await send({"type": "http.response.body", "body": b""})
+    else:
+        producer.cancel()
+        try:
+            await producer
+        except asyncio.CancelledError:
+            pass
+
+async def chat_batch(scope, receive, send):
+    """批量聊天：并发执行多个独立的对话，结果按完成顺序以NDJSON逐行返回，单项出错不影响其他项"""
+    data = await read_json(receive)
+    items = data.get('conversations')
+    if not isinstance(items, list) or not items:
+        return await send_json(send, {"error": "conversations 应为非空列表", "success": False}, 400)
+    if len(items) > BATCH_CONFIG["max_items"]:
+        return await send_json(send, {"error": f"单次最多提交 {BATCH_CONFIG['max_items']} 个对话",
+                                      "success": False}, 400)
+    try:
+        parallelism, timeout = model_service.batch_limits(data.get('parallelism'), data.get('timeout'))
+    except (TypeError, ValueError):
+        return await send_json(send, {"error": "parallelism 和 timeout 应为数字", "success": False}, 400)
+    
+    # 同一批次的各项按同一个会话参与准入控制的公平调度，默认以低优先级排队
+    batch_id = str(data.get('batch_id') or uuid.uuid4())
+    set_attribute("batch_id", batch_id)
+    priority = request_priority(scope, data, "low")
+    
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"application/x-ndjson; charset=utf-8"), (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no"), *CORS_HEADERS]
+    })
+    
+    async def send_line(payload):
+        body = (json.dumps(payload, ensure_ascii=False) + "\n").encode('utf-8')
+        await send({"type": "http.response.body", "body": body, "more_body": True})
+    
+    failed = 0
+    async with aclosing(model_service.chat_batch(
+            items, parallelism, timeout,
+            admit=lambda index, deadline: admission.acquire_async(batch_id, priority, deadline=deadline))) as results:
+        async for result in results:
+            failed += not result["success"]
+            await send_line(result)
+    await send_line({"done": True, "batch_id": batch_id, "total": len(items), "failed": failed, "success": True})
+    await send({"type": "http.response.body", "body": b""})
+
+async def metrics_endpoint(scope, receive, send):
+    """Prometheus文本格式的运行指标"""
+    await send_response(send, 200, metrics.generate_latest().encode('utf-8'), metrics.CONTENT_TYPE)
+
+def query_params(scope):
+    return {key: values[0] for key, values in parse_qs(scope["query_string"].decode('latin-1')).items()}
+
+def query_param_list(scope, key):
+    """可重复的查询参数的全部取值"""
+    return parse_qs(scope["query_string"].decode('latin-1')).get(key, [])
+
+def is_local_request(scope):
+    """请求直接来自本机；经反向代理转发（带有转发头）的请求不算本机"""
+    headers = dict(scope["headers"])
+    if b"x-forwarded-for" in headers or b"forwarded" in headers:
+        return False
+    client = scope.get("client")
+    try:
+        return client is not None and ipaddress.ip_address(client[0]).is_loopback
+    except ValueError:
+        return False
+
+def is_admin(scope):
+    """X-Admin-Token 请求头与管理令牌一致；未配置管理令牌时只允许本机直接访问"""
+    token = TRACE_CONFIG["admin_token"]
+    if not token:
+        return is_local_request(scope)
+    provided = dict(scope["headers"]).get(b"x-admin-token", b"").decode('latin-1')
+    return hmac.compare_digest(provided, token)
+
+async def admin_traces(scope, receive, send):
+    """查询最近的慢请求链路，可按 request_id 查找"""
+    if not is_admin(scope):
+        return await send_json(send, {"error": "无权访问", "success": False}, 403)
+    params = query_params(scope)
+    if params.get("request_id"):
+        trace = TRACER.find(params["request_id"])
+        if trace is None:
+            return await send_json(send, {"error": "未找到该请求", "success": False}, 404)
+        return await send_json(send, {"trace": trace, "success": True})
+    limit = int(params["limit"]) if params.get("limit", "").isdigit() else None
+    await send_json(send, {"traces": TRACER.recent_slow(limit), "stats": TRACER.stats(), "success": True})
+
+async def admin_profile(scope, receive, send):
+    """开始一次限时性能采集（POST）或查询采集状态（GET）"""
+    if not is_admin(scope):
+        return await send_json(send, {"error": "无权访问", "success": False}, 403)
+    if scope["method"] == "GET":
+        return await send_json(send, {**PROFILER.status(), "success": True})
+    data = await read_json(receive)
+    mode = data.get('mode', 'sample')
+    if mode != "sample":
+        # 所有请求共用事件循环线程，无法按请求启用cProfile
+        return await send_json(send, {"error": "ASGI模式仅支持 sample 采集", "success": False}, 400)
+    try:
+        capture = PROFILER.start(mode, data.get('seconds', 10))
+    except ValueError as e:
+        return await send_json(send, {"error": str(e), "success": False}, 400)
+    except RuntimeError as e:
+        return await send_json(send, {"error": str(e), "success": False}, 409)
+    await send_json(send, {"profile": capture, "success": True})
+
+async def export(scope, receive, send):
+    """流式导出对话历史，逐块在线程中读取后发送"""
+    if not is_admin(scope):
+        return await send_json(send, {"error": "无权访问", "success": False}, 403)
+    params = query_params(scope)
+    export_format = params.get('format', 'json')
+    compress = params.get('gzip', '').lower() in ('1', 'true')
+    try:
+        # 与 app.py 的 export_params 相同：session_id 可重复或以逗号分隔
+        session_ids = [s for value in query_param_list(scope, 'session_id') for s in value.split(',') if s] or None
+        since, until = (float(params[key]) if params.get(key) else None for key in ('since', 'until'))
+        chunks = await asyncio.to_thread(message_manager.iter_export, export_format, session_ids, since, until, compress)
+    except ValueError as e:
+        return await send_json(send, {"error": str(e), "success": False}, 400)
+    except TimeoutError as e:
+        return await send_json(send, {"error": str(e), "success": False}, 503)
+    
+    filename = f"conversations.{export_format}" + (".gz" if compress else "")
+    content_type = "application/gzip" if compress else EXPORT_CONTENT_TYPES[export_format]
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", content_type.encode()),
+                    (b"content-disposition", f'attachment; filename="{filename}"'.encode()), *CORS_HEADERS]
+    })
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            break
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+async def search(scope, receive, send):
+    """全文搜索对话消息，在线程中查询索引"""
+    if not is_admin(scope):
+        return await send_json(send, {"error": "无权访问", "success": False}, 403)
+    if message_manager.search_index is None:
+        return await send_json(send, {"error": "全文搜索未启用", "success": False}, 404)
+    params = query_params(scope)
+    query = params.get('q', '').strip()
+    if not query:
+        return await send_json(send, {"error": "缺少搜索关键词", "success": False}, 400)
+    try:
+        since, until = (float(params[key]) if params.get(key) else None for key in ('since', 'until'))
+        offset = int(params.get('offset', 0))
+        limit = int(params['limit']) if params.get('limit') else None
+    except ValueError:
+        return await send_json(send, {"error": "参数格式错误", "success": False}, 400)
+    result = await asyncio.to_thread(message_manager.search, query, params.get('session_id') or None,
+                                     since, until, offset, limit)
+    await send_json(send, {**result, "success": True})
+
+async def history(scope, receive, send):
+    """分页读取会话历史，在线程中读取存储"""
+    params = query_params(scope)
+    session_id = params.get('session_id', '').strip()
+    if not session_id:
+        return await send_json(send, {"error": "缺少会话ID", "success": False}, 400)
+    try:
+        limit = int(params['limit']) if params.get('limit') else None
+        messages, next_before = await asyncio.to_thread(message_manager.history, session_id,
+                                                        params.get('before') or None, limit)
+    except ValueError:
+        return await send_json(send, {"error": "参数格式错误", "success": False}, 400)
+    await send_json(send, {"session_id": session_id, "messages": messages, "next_before": next_before,
+                           "success": True})
+
+async def sessions(scope, receive, send):
+    """按最后更新时间倒序分页列出存储的会话"""
+    if not is_admin(scope):
+        return await send_json(send, {"error": "无权访问", "success": False}, 403)
+    params = query_params(scope)
+    try:
+        limit = int(params['limit']) if params.get('limit') else None
+        items, next_cursor = await asyncio.to_thread(message_manager.list_sessions,
+                                                     params.get('cursor') or None, limit)
+    except ValueError:
+        return await send_json(send, {"error": "参数格式错误", "success": False}, 400)
+    except TimeoutError as e:
+        return await send_json(send, {"error": str(e), "success": False}, 503)
+    await send_json(send, {"sessions": items, "next_cursor": next_cursor, "success": True})
+
+async def clear_context(scope, receive, send):
+    """清理对话上下文"""
+    try:
+        session_id = (await read_json(receive)).get('session_id')
+        if session_id:
+            await asyncio.to_thread(message_manager.delete_session, session_id)
+        await send_json(send, {"success": True})
+    except Exception as e:
+        await send_json(send, {"error": str(e), "success": False}, 500)
+
+async def session_info(scope, receive, send):
+    """获取会话信息"""
+    await send_json(send, {
+        "session_count": message_manager.get_session_count(),
+        "context_cache": message_manager.context_store.stats(),
+        "admission": admission.stats(),
+        "success": True
+    })
+
+async def health(scope, receive, send):
+    """存活检查，返回上游连接状态"""
+    await send_json(send, {"status": "ok", "upstream": model_service.health(), "success": True})
+
+async def ready(scope, receive, send):
+    """就绪检查：已建立上游连接时返回200，否则返回503"""
+    upstream = model_service.health()
+    await send_json(send, {"ready": upstream["ready"], "upstream": upstream}, 200 if upstream["ready"] else 503)
+
+ROUTES = {
+    ("GET", "/"): index,
+    ("POST", "/api/chat"): chat,
+    ("POST", "/api/chat/stream"): chat_stream,
+    ("POST", "/api/chat/batch"): chat_batch,
+    ("POST", "/api/clear_context"): clear_context,
+    ("GET", "/api/session_info"): session_info,
+    ("GET", "/api/export"): export,
+    ("GET", "/api/search"): search,
+    ("GET", "/api/history"): history,
+    ("GET", "/api/sessions"): sessions,
+    ("GET", "/api/health"): health,
+    ("GET", "/api/ready"): ready,
+    ("GET", "/api/metrics"): metrics_endpoint,
+    ("GET", "/api/admin/traces"): admin_traces,
+    ("GET", "/api/admin/profile"): admin_profile,
+    ("POST", "/api/admin/profile"): admin_profile
+}
+
+# 需要统计端到端耗时和进行中请求数的接口
+TRACKED_ENDPOINTS = {chat: "chat", chat_stream: "chat_stream", chat_batch: "chat_batch"}
+
+async def clean_sessions_periodically():
+    """定期清理过期会话"""
+    while True:
+        await asyncio.sleep(CONTEXT_CONFIG["cleanup_interval"])
+        expired_count = await asyncio.to_thread(message_manager.clean_expired_sessions)
+        if expired_count > 0:
+            logger.info("清理了 %d 个过期会话", expired_count)
+
+async def lifespan(scope, receive, send):
+    cleaner = None
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            cleaner = asyncio.create_task(clean_sessions_periodically())
+            # 启动时预热上游连接
+            await model_service.warm_up()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if cleaner:
+                cleaner.cancel()
+            await model_service.close()
+            await asyncio.to_thread(message_manager.close)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    """ASGI应用入口"""
+    if scope["type"] == "lifespan":
+        return await lifespan(scope, receive, send)
+    if scope["type"] != "http":
+        return
+    
+    if scope["method"] == "OPTIONS":
+        return await send_response(send, 204, b"", "text/plain")
+    if scope["method"] == "GET" and scope["path"].startswith("/static/"):
+        return await static(scope, receive, send)
+    
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        return await send_json(send, {"error": "接口不存在"}, 404)
+    
+    endpoint = TRACKED_ENDPOINTS.get(handler)
+    if endpoint is None:
+        return await handler(scope, receive, send)
+    start_time = time.perf_counter()
+    metrics.IN_FLIGHT.inc(endpoint=endpoint)
+    request_id = dict(scope["headers"]).get(b"x-request-id", b"").decode('latin-1')
+    trace = TRACER.begin(endpoint, request_id or None)
+    
+    async def send_with_request_id(message):
+        if trace and message["type"] == "http.response.start":
+            message["headers"] = [*message["headers"], (b"x-request-id", trace.request_id.encode('latin-1'))]
+        await send(message)
+    
+    error = None
+    try:
+        await handler(scope, receive, send_with_request_id)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        TRACER.end(trace, error)
+        metrics.IN_FLIGHT.dec(endpoint=endpoint)
+        metrics.CHAT_LATENCY.observe(time.perf_counter() - start_time, endpoint=endpoint)
+
+if __name__ == '__main__':
+    import uvicorn
+    
+    logger.info("智能聊天机器人服务（ASGI）已启动")
+    logger.info("访问地址: http://127.0.0.1:%s", APP_CONFIG['port'])
+    logger.info("按 CTRL+C 停止服务")
+    
+    uvicorn.run(app, host=APP_CONFIG['host'], port=APP_CONFIG['port'], log_level="warning")
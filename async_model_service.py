@@ -0,0 +1,223 @@
+import asyncio
+import json
+import time
+from collections import deque
+from contextlib import aclosing, nullcontext
+from websockets.asyncio.client import connect
+from websockets.exceptions import ConnectionClosed, WebSocketException
+from websockets.protocol import State
+from config import WS_CONFIG
+from deadline import Deadline, DeadlineExceeded
+from model_service import SparkClientBase
+from tracing import span, mark
+from metrics import UPSTREAM_FIRST_TOKEN, UPSTREAM_GENERATION, UPSTREAM_TIMEOUTS, UPSTREAM_RECONNECTS
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+class AsyncSparkModelService(SparkClientBase):
+    """基于asyncio的模型调用服务
+    
+    每个请求在事件循环中使用一条独立的WebSocket连接，等待上游时不占用线程，
+    单个进程即可同时保持大量进行中的生成。鉴权、请求构建和帧解析与同步服务共用。
+    warm_up 后在后台保持 pool_min_idle 条预先建立的热备连接，请求优先取用。
+    """
+    def __init__(self, max_concurrency=None):
+        super().__init__()
+        self.semaphore = asyncio.Semaphore(max_concurrency or WS_CONFIG["async_max_concurrency"])
+        self.standby = deque()
+        self.min_standby = 0
+        # 成功建立的连接数、连续失败次数和最近一次错误，用于健康检查
+        self.connections = 0
+        self.failures = 0
+        self.last_error = None
+        self._warm_task = None
+        self._refill = None
+    
+    async def open_connection(self):
+        """建立一条上游连接"""
+        try:
+            with span("upstream.connect"):
+                ws = await connect(self.auth_url(), open_timeout=WS_CONFIG["timeout"], max_size=None)
+        except (OSError, asyncio.TimeoutError, WebSocketException) as e:
+            self.failures += 1
+            self.last_error = str(e)
+            raise ConnectionError(f"无法建立WebSocket连接: {e}")
+        self.connections += 1
+        self.failures = 0
+        return ws
+    
+    async def acquire(self):
+        """优先取用热备连接，没有可用的热备连接时新建"""
+        while self.standby:
+            ws = self.standby.popleft()
+            if ws.state is State.OPEN:
+                self._wake()
+                return ws
+        self._wake()
+        return await self.open_connection()
+    
+    def _wake(self):
+        """唤醒后台任务补充热备连接"""
+        if self._refill is not None and len(self.standby) < self.min_standby:
+            self._refill.set()
+    
+    async def warm_up(self):
+        """启动时预热：后台建立并保持 pool_min_idle 条热备连接，断开或失败时按指数退避重连"""
+        self.min_standby = WS_CONFIG["pool_min_idle"]
+        if self._warm_task is None and self.min_standby:
+            self._refill = asyncio.Event()
+            self._warm_task = asyncio.create_task(self._keep_warm())
+    
+    async def _keep_warm(self):
+        while True:
+            self._refill.clear()
+            self.standby = deque(ws for ws in self.standby if ws.state is State.OPEN)
+            healthy = True
+            while len(self.standby) < self.min_standby:
+                try:
+                    ws = await self.open_connection()
+                except ConnectionError as e:
+                    logger.warning("补充连接失败: %s", e)
+                    healthy = False
+                    break
+                self.standby.append(ws)
+                # 热备连接被服务端关闭时立即补充
+                asyncio.create_task(self._watch(ws))
+            delay = WS_CONFIG["health_check_interval"] if healthy else self.retry_delay(self.failures)
+            try:
+                await asyncio.wait_for(self._refill.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _watch(self, ws):
+        await ws.wait_closed()
+        if ws in self.standby:
+            self.standby.remove(ws)
+            self._wake()
+    
+    def health(self):
+        """上游连接的健康状态：有热备连接，或最近一次建立连接成功时视为就绪"""
+        idle = sum(ws.state is State.OPEN for ws in self.standby)
+        return {
+            "ready": idle > 0 or (self.connections > 0 and self.failures == 0),
+            "idle": idle,
+            "failures": self.failures,
+            "last_error": self.last_error
+        }
+    
+    async def close(self):
+        """停止预热并关闭热备连接"""
+        if self._warm_task:
+            self._warm_task.cancel()
+            self._warm_task = None
+        standby, self.standby = self.standby, deque()
+        for ws in standby:
+            await ws.close()
+    
+    async def chat_stream(self, messages, temperature=0.5, top_k=4, max_tokens=2048, chat_id=None, timeout=60,
+                          deadline=None):
+        """流式聊天流程，上游帧到达即产出 delta / search_info 事件
+        
+        建立连接失败或在产出第一个事件前连接断开时，按退避重试，最多 retry_times 次，重试共用同一个截止时间。
+        提前取消请求时取消所在的任务即可，退出时关闭连接。
+        """
+        request_data = self.build_request(messages, temperature, top_k, max_tokens, chat_id)
+        deadline = deadline or Deadline(timeout)
+        
+        async with self.semaphore:
+            for attempt in range(self.retry_times + 1):
+                produced = False
+                try:
+                    async with aclosing(self.stream_once(request_data, deadline)) as events:
+                        async for event in events:
+                            produced = True
+                            yield event
+                    return
+                except ConnectionError:
+                    if produced or attempt == self.retry_times:
+                        raise
+                    UPSTREAM_RECONNECTS.inc()
+                await asyncio.sleep(min(self.retry_delay(attempt + 1), deadline.remaining()))
+    
+    async def stream_once(self, request_data, deadline):
+        """在一条连接上完成一次生成"""
+        deadline.check()
+        ws = await self.acquire()
+        # 调用方提前停止迭代或任务被取消时，退出上下文即关闭连接
+        async with ws:
+            try:
+                await ws.send(json.dumps(request_data))
+            except ConnectionClosed:
+                raise ConnectionError("WebSocket连接已关闭")
+            start_time = time.perf_counter()
+            first_token = True
+            
+            while True:
+                try:
+                    message = await asyncio.wait_for(ws.recv(), deadline.remaining())
+                except asyncio.TimeoutError:
+                    UPSTREAM_TIMEOUTS.inc()
+                    raise DeadlineExceeded("模型响应超时")
+                except ConnectionClosed:
+                    raise ConnectionError("WebSocket连接在响应完成前关闭")
+                
+                events, finished = self.parse_frame(json.loads(message))
+                for event in events:
+                    if first_token and event["type"] == "delta":
+                        UPSTREAM_FIRST_TOKEN.observe(time.perf_counter() - start_time)
+                        mark("upstream.first_token")
+                        first_token = False
+                    yield event
+                if finished:
+                    UPSTREAM_GENERATION.observe(time.perf_counter() - start_time)
+                    return
+    
+    async def chat(self, messages, temperature=0.5, top_k=4, max_tokens=2048, chat_id=None, timeout=60,
+                   deadline=None):
+        """完整的聊天流程"""
+        text_parts = []
+        full_response = {"text": "", "ref_info": [], "is_finished": False}
+        
+        try:
+            async for event in self.chat_stream(messages, temperature, top_k, max_tokens, chat_id, timeout,
+                                                deadline):
+                if event["type"] == "delta":
+                    text_parts.append(event["content"])
+                else:
+                    full_response["ref_info"].append(event["search_info"])
+        except Exception as e:
+            logger.error("模型调用失败: %s", e)
+            raise
+        
+        full_response["text"] = "".join(text_parts)
+        full_response["is_finished"] = True
+        return full_response
+    
+    async def chat_batch(self, items, parallelism=None, timeout=None, admit=None):
+        """并发执行多个独立的对话，按完成顺序产出每一项的结果，参数含义与同步服务的 chat_batch 相同
+        
+        admit 为可选的异步准入函数，以序号和该项的截止时间调用，返回许可（上下文管理器）。调用方提前关闭时取消未完成的项。
+        """
+        parallelism, timeout = self.batch_limits(parallelism, timeout)
+        semaphore = asyncio.Semaphore(parallelism)
+        
+        async def run(index, item):
+            async with semaphore:
+                try:
+                    request = self.batch_request(item)
+                    deadline = Deadline(timeout)
+                    permit = await admit(index, deadline) if admit else nullcontext()
+                    with permit:
+                        response = await self.chat(**request, deadline=deadline)
+                    return self.batch_result(index, item, response)
+                except Exception as e:
+                    return self.batch_result(index, item, error=e)
+        
+        tasks = [asyncio.create_task(run(index, item)) for index, item in enumerate(items)]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                yield await next_result
+        finally:
+            for task in tasks:
+                task.cancel()
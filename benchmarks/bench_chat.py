@@ -0,0 +1,199 @@
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from config import XFYUN_CONFIG, WS_CONFIG, STORAGE_CONFIG, PERSIST_CONFIG
+from mock_spark_server import MockSparkServer
+
+# 聊天接口压测：以N个并发模拟会话请求 /api/chat/stream（或 /api/chat），上游为本地模拟服务
+# 运行方式：python benchmarks/bench_chat.py --sessions 50 --turns 5 --token-rate 200
+
+def percentile(values, p):
+    """最近秩法计算百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def dir_size(path):
+    """目录下所有文件的总字节数"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def disk_write_bytes():
+    """进程写入块设备的字节数（仅Linux），用于观察写放大"""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def send_chat(url, payload, stream, timeout):
+    """发送一次聊天请求，返回 (是否成功, 总耗时, 首token耗时)"""
+    request = urllib.request.Request(url, data=json.dumps(payload).encode('utf-8'),
+                                     headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    first_token = None
+    success = False
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        if not stream:
+            success = json.loads(response.read()).get("success", False)
+        else:
+            for line in response:
+                if not line.startswith(b"data: "):
+                    continue
+                event = json.loads(line[6:])
+                if event["type"] == "delta" and first_token is None:
+                    first_token = time.perf_counter() - start
+                elif event["type"] in ("done", "error"):
+                    success = event["success"]
+    return success, time.perf_counter() - start, first_token
+
+def run_session(url, args, results, lock):
+    """一个模拟会话：按顺序发送多轮消息"""
+    session_id = f"bench_{uuid.uuid4().hex}"
+    for turn in range(args.turns):
+        payload = {"session_id": session_id, "message": f"第{turn + 1}轮压测消息：" + "内容" * args.message_length,
+                   "cache": False}
+        try:
+            result = send_chat(url, payload, args.endpoint == "stream", args.timeout)
+        except Exception:
+            result = (False, None, None)
+        with lock:
+            results.append(result)
+        if args.think_time:
+            time.sleep(args.think_time)
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天接口压测")
+    parser.add_argument("--sessions", type=int, default=20, help="并发模拟会话数")
+    parser.add_argument("--turns", type=int, default=5, help="每个会话的对话轮数")
+    parser.add_argument("--endpoint", choices=["stream", "chat"], default="stream",
+                        help="压测的接口，stream 可统计首token耗时")
+    parser.add_argument("--message-length", type=int, default=10, help="用户消息长度（重复次数）")
+    parser.add_argument("--think-time", type=float, default=0.0, help="每轮之间的等待时间（秒）")
+    parser.add_argument("--timeout", type=float, default=120, help="单个请求超时（秒）")
+    parser.add_argument("--token-rate", type=float, default=200, help="模拟上游每秒产出的token数")
+    parser.add_argument("--chunk-size", type=int, default=4, help="模拟上游每帧token数")
+    parser.add_argument("--jitter", type=float, default=0.0, help="模拟上游每帧随机延迟上限（秒）")
+    parser.add_argument("--reply-length", type=int, default=200, help="模拟回复长度")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟上游返回错误码的概率")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="模拟上游中途断开的概率")
+    parser.add_argument("--backend", choices=["json", "log", "sqlite"], default=STORAGE_CONFIG["backend"])
+    parser.add_argument("--write-behind", action="store_true", help="启用异步批量写入")
+    parser.add_argument("--pool-size", type=int, default=WS_CONFIG["pool_max_size"], help="上游连接池大小")
+    parser.add_argument("--output", help="将结果以JSON写入该文件")
+    parser.add_argument("--verbose", action="store_true", help="保留服务端日志输出")
+    args = parser.parse_args()
+    
+    mock = MockSparkServer(token_rate=args.token_rate, chunk_size=args.chunk_size, jitter=args.jitter,
+                           reply_length=args.reply_length, error_rate=args.error_rate, drop_rate=args.drop_rate,
+                           seed=0)
+    mock.start()
+    
+    # 应用在导入时读取配置，需先指向模拟服务和临时存储目录
+    storage_dir = tempfile.mkdtemp(prefix="bench_storage_")
+    XFYUN_CONFIG.update(scheme="ws", host=mock.address)
+    WS_CONFIG["pool_max_size"] = args.pool_size
+    STORAGE_CONFIG.update(backend=args.backend, storage_dir=storage_dir)
+    PERSIST_CONFIG["write_behind"] = args.write_behind
+    
+    from werkzeug.serving import make_server
+    import app as chat_app
+    import metrics
+    
+    server = make_server("127.0.0.1", 0, chat_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    path = "/api/chat/stream" if args.endpoint == "stream" else "/api/chat"
+    url = f"http://127.0.0.1:{server.server_port}{path}"
+    
+    results = []
+    lock = threading.Lock()
+    size_before = dir_size(storage_dir)
+    io_before = disk_write_bytes()
+    written_before = metrics.STORAGE_BYTES.collect().get(("write",), 0)
+    
+    log_target = sys.stdout
+    if not args.verbose:
+        log_target = open(os.devnull, 'w')
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    with contextlib.redirect_stdout(log_target):
+        start_time = time.perf_counter()
+        threads = [threading.Thread(target=run_session, args=(url, args, results, lock))
+                   for _ in range(args.sessions)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start_time
+        chat_app.message_manager.flush()
+        
+        server.shutdown()
+        chat_app.model_service.close()
+        chat_app.message_manager.close()
+        mock.stop()
+    
+    if hasattr(os, "sync"):
+        os.sync()
+    io_after = disk_write_bytes()
+    latencies = [latency for success, latency, _ in results if success]
+    first_tokens = [first_token for success, _, first_token in results if success and first_token is not None]
+    report = {
+        "endpoint": path,
+        "backend": args.backend,
+        "write_behind": args.write_behind,
+        "sessions": args.sessions,
+        "requests": len(results),
+        "succeeded": len(latencies),
+        "failed": len(results) - len(latencies),
+        "elapsed": elapsed,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "latency": {f"p{p}": percentile(latencies, p) for p in (50, 95, 99)},
+        "ttft": {f"p{p}": percentile(first_tokens, p) for p in (50, 95, 99)},
+        "storage_bytes": dir_size(storage_dir) - size_before,
+        "storage_bytes_written": metrics.STORAGE_BYTES.collect().get(("write",), 0) - written_before,
+        "disk_write_bytes": io_after - io_before if io_before is not None else None,
+        "upstream": mock.stats
+    }
+    shutil.rmtree(storage_dir, ignore_errors=True)
+    
+    def ms(value):
+        return f"{value * 1000:.1f}ms" if value is not None else "-"
+    
+    print(f"接口: {path}  存储后端: {args.backend}  写回模式: {args.write_behind}")
+    print(f"请求数: {report['requests']}  成功: {report['succeeded']}  失败: {report['failed']}  "
+          f"耗时: {elapsed:.2f}s  吞吐: {report['rps']:.1f} req/s")
+    print("延迟: " + "  ".join(f"{k}={ms(v)}" for k, v in report["latency"].items()))
+    print("首token: " + "  ".join(f"{k}={ms(v)}" for k, v in report["ttft"].items()))
+    print(f"存储净增: {report['storage_bytes']} 字节  存储写入: {report['storage_bytes_written']} 字节  "
+          f"磁盘写入: {report['disk_write_bytes']} 字节")
+    print(f"上游统计: {json.dumps(mock.stats, ensure_ascii=False)}")
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
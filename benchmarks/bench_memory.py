@@ -0,0 +1,95 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from message_manager import MessageManager
+from token_estimator import estimate_message_tokens
+
+# 会话内存占用对比：每条消息一个字典的旧结构 与 按列保存的 Session
+# 运行方式：python benchmarks/bench_memory.py --sessions 10000 --messages 10
+
+def legacy_session(messages):
+    """旧的会话结构：消息字典列表，外加一份上下文字典列表和token列表"""
+    session = {
+        "messages": [],
+        "last_active": time.time(),
+        "context": [],
+        "tokens": [],
+        "token_total": 0,
+        "bytes": 0,
+        "lock": threading.Lock()
+    }
+    for message in messages:
+        tokens = estimate_message_tokens(message["content"])
+        session["messages"].append(message)
+        session["context"].append({"role": message["role"], "content": message["content"]})
+        session["tokens"].append(tokens)
+        session["token_total"] += tokens
+    return session
+
+def make_messages(session_index, count, length):
+    """生成一个会话的消息，模拟从存储加载（每条消息是独立的字典和字符串）"""
+    now = time.time()
+    return [{"role": "user" if n % 2 == 0 else "assistant",
+             "content": f"{session_index}-{n}:" + "消息内容" * length,
+             "timestamp": now + n}
+            for n in range(count)]
+
+def measure(build, sessions, count, length):
+    """构建所有会话后内存的增量，返回 (总字节数, 其中消息内容字符串的字节数)"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = {}
+    for i in range(sessions):
+        store[f"session_{i}"] = build(make_messages(i, count, length))
+    gc.collect()
+    total = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    contents = sum(sys.getsizeof(content) for content in
+                   (f"{i}-{n}:" + "消息内容" * length for i in range(sessions) for n in range(count)))
+    return total, contents
+
+def main():
+    parser = argparse.ArgumentParser(description="会话内存占用对比")
+    parser.add_argument("--sessions", type=int, default=10000, help="会话数")
+    parser.add_argument("--messages", type=int, default=10, help="每个会话的消息数")
+    parser.add_argument("--message-length", type=int, default=10, help="消息长度（重复次数）")
+    parser.add_argument("--output", help="将结果以JSON写入该文件")
+    args = parser.parse_args()
+    
+    manager = MessageManager()
+    manager.max_history = max(manager.max_history, args.messages)
+    manager.token_budget = 0
+    
+    report = {"sessions": args.sessions, "messages": args.messages}
+    for name, build in (("dict", legacy_session), ("compact", manager.new_session)):
+        total, contents = measure(build, args.sessions, args.messages, args.message_length)
+        report[name] = {
+            "bytes_per_session": total // args.sessions,
+            "overhead_per_session": (total - contents) // args.sessions
+        }
+    manager.close()
+    
+    saved = 1 - report["compact"]["bytes_per_session"] / report["dict"]["bytes_per_session"]
+    report["saved_ratio"] = round(saved, 4)
+    print(f"会话数: {args.sessions}  每会话消息数: {args.messages}")
+    for name in ("dict", "compact"):
+        print(f"{name:>8}: 每会话 {report[name]['bytes_per_session']} 字节  "
+              f"(不含消息内容 {report[name]['overhead_per_session']} 字节)")
+    print(f"节省: {saved:.1%}")
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
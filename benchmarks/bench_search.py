@@ -0,0 +1,87 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from search_index import SearchIndex
+
+# 全文搜索压测：生成随机中文消息建立索引，统计不同频率关键词的查询耗时
+# 运行方式：python benchmarks/bench_search.py --messages 1000000
+
+WORDS = ["天气", "订单", "退款", "物流", "发票", "密码", "账号", "会员", "优惠", "地址",
+         "快递", "售后", "投诉", "价格", "库存", "支付", "登录", "注册", "积分", "客服"]
+FILLER = "的了是在我有和就不人都一个上也很到说要去你会着没有看好自己这"
+
+class GeneratedStorage:
+    """按需生成会话的只读存储，供 rebuild 读取"""
+    
+    def __init__(self, messages, per_session, seed):
+        self.messages = messages
+        self.per_session = per_session
+        self.seed = seed
+    
+    def iter_conversations(self):
+        rng = random.Random(self.seed)
+        now = time.time()
+        for start in range(0, self.messages, self.per_session):
+            messages = []
+            for n in range(start, min(start + self.per_session, self.messages)):
+                # 关键词按 Zipf 分布出现，靠前的词更常见
+                words = [WORDS[min(int(rng.paretovariate(1.2)) - 1, len(WORDS) - 1)] for _ in range(3)]
+                filler = "".join(rng.choice(FILLER) for _ in range(rng.randint(10, 40)))
+                messages.append({"role": "user" if n % 2 == 0 else "assistant",
+                                 "content": filler[:10] + words[0] + filler[10:20] + words[1] + filler[20:] + words[2],
+                                 "timestamp": now - (self.messages - n)})
+            yield f"session_{start // self.per_session}", {"messages": messages}
+
+def main():
+    parser = argparse.ArgumentParser(description="全文搜索压测")
+    parser.add_argument("--messages", type=int, default=200000, help="消息总数")
+    parser.add_argument("--per-session", type=int, default=20, help="每个会话的消息数")
+    parser.add_argument("--queries", type=int, default=50, help="每个关键词的查询次数")
+    parser.add_argument("--output", help="将结果以JSON写入该文件")
+    args = parser.parse_args()
+    
+    storage_dir = tempfile.mkdtemp()
+    index = SearchIndex(storage_dir)
+    try:
+        start = time.perf_counter()
+        index.rebuild(GeneratedStorage(args.messages, args.per_session, seed=1))
+        build_seconds = time.perf_counter() - start
+        report = {"messages": args.messages, "build_seconds": round(build_seconds, 2),
+                  "index_bytes": index.stats()["index_bytes"], "queries": {}}
+        print(f"消息数: {args.messages}  建立索引: {build_seconds:.1f} 秒  "
+              f"索引大小: {report['index_bytes'] / 1024 / 1024:.1f} MB")
+        
+        for query in ("天气", "投诉", "客服", "天气 订单", "退款 客服", "售后 session_3"):
+            latencies, total = [], 0
+            for _ in range(args.queries):
+                result = index.search(query, limit=20)
+                latencies.append(result["took_ms"])
+                total = result["total"]
+            latencies.sort()
+            report["queries"][query] = {
+                "hits": total,
+                "p50_ms": statistics.median(latencies),
+                "p99_ms": latencies[int(len(latencies) * 0.99) - 1]
+            }
+            print(f"{query:>14}: 命中 {total:>8}  p50 {report['queries'][query]['p50_ms']:.2f} ms  "
+                  f"p99 {report['queries'][query]['p99_ms']:.2f} ms")
+    finally:
+        index.close()
+        shutil.rmtree(storage_dir, ignore_errors=True)
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
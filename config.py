@@ -5,13 +5,67 @@ XFYUN_CONFIG = {
     "api_secret": "your_api_secret",  # 请替换为实际的api_secret
     "model_id": "your_model_id",  # 模型ID
     "host": "maas-api.cn-huabei-1.xf-yun.com",  # API主机地址
-    "path": "/v1.1/chat"  # API路径
+    "path": "/v1.1/chat",  # API路径
+    "scheme": "wss"  # WebSocket协议，连接本地替身服务时可改为ws
 }
 
 # WebSocket配置
 WS_CONFIG = {
     "timeout": 30,  # 连接超时时间（秒）
-    "retry_times": 3  # 重试次数
+    "retry_times": 3,  # 建立连接失败或首帧前连接断开时的重试次数
+    "backoff_base": 0.5,  # 重连退避的初始等待时间（秒），之后按指数增长并加入随机抖动
+    "backoff_max": 30,  # 重连退避的最长等待时间（秒）
+    "auth_url_ttl": 60,  # 鉴权URL的复用时间（秒），服务端允许签名日期与服务器时间相差300秒以内
+    "pool_min_size": 0,  # 连接池最小连接数
+    "pool_min_idle": 1,  # 启动时预热并保持的空闲（热备）连接数
+    "pool_max_size": 10,  # 连接池最大连接数，即同时进行的上游请求上限
+    "idle_timeout": 300,  # 空闲连接超过该时间（秒）后被淘汰
+    "health_check_interval": 30,  # 连接池健康检查间隔（秒）
+    "acquire_timeout": 30,  # 等待可用连接的最长时间（秒）
+    "async_max_concurrency": 1000,  # 异步客户端同时进行的上游请求上限
+    "coalesce_requests": False,  # 是否合并相同的进行中请求，共享一次上游生成
+    "request_timeout": 60,  # 聊天请求的默认截止时间（秒），覆盖取连接、重试和等待响应的全过程
+    "max_request_timeout": 300  # 请求体中 timeout 的上限（秒）
+}
+
+# 对冲请求配置：首帧迟迟未到时在另一条连接上重发，先返回的一方胜出
+HEDGE_CONFIG = {
+    "enabled": False,  # 是否启用对冲请求
+    "percentile": 0.95,  # 等待首帧超过最近首帧延迟的该分位数时发出对冲请求
+    "min_delay": 0.1,  # 对冲延迟下限（秒）
+    "max_delay": 5.0,  # 对冲延迟上限（秒）
+    "window": 500,  # 计算分位数使用的最近样本数
+    "min_samples": 20,  # 样本数不足时不对冲
+    "budget": 0.1  # 对冲请求数占请求总数的比例上限
+}
+
+# 准入控制配置（保护上游的QPS与并发配额）
+ADMISSION_CONFIG = {
+    "enabled": True,  # 是否启用准入控制
+    "max_concurrency": 10,  # 同时进行的上游请求上限，不应超过上游的并发配额
+    "rate": 0,  # 每秒允许开始的上游请求数（令牌桶），0表示不限速
+    "burst": 0,  # 令牌桶容量，允许的突发请求数，0表示与 rate 相同
+    "max_queue": 100,  # 等待队列长度，队列已满时立即返回429
+    "queue_timeout": 10,  # 最长排队时间（秒），预计无法在该时间内轮到的请求立即返回429
+    "fair_sessions": True,  # 同一优先级内优先放行进行中请求较少的会话
+    "max_session_queue": 5  # 单个会话最多排队的请求数，0表示不限制
+}
+
+# 批量聊天配置
+BATCH_CONFIG = {
+    "parallelism": 4,  # 默认的批内并发数
+    "max_parallelism": 5,  # 批内并发数上限，不宜超过准入控制的 max_session_queue，否则排队的项可能被拒绝
+    "max_items": 1000,  # 单次批量请求的最大条数
+    "item_timeout": 60  # 每一项的模型响应超时（秒）
+}
+
+# 响应缓存配置
+CACHE_CONFIG = {
+    "enabled": False,  # 是否启用模型响应缓存
+    "max_bytes": 64 * 1024 * 1024,  # 内存缓存容量（字节），超出时按LRU淘汰
+    "ttl": 3600,  # 缓存条目有效期（秒）
+    "disk_path": None,  # 磁盘缓存的SQLite文件路径，None表示仅使用内存缓存
+    "replay_chunk_size": 16  # 流式接口回放缓存时每个分片的字符数
 }
 
 # 应用配置
@@ -24,5 +78,77 @@ APP_CONFIG = {
 # 上下文配置
 CONTEXT_CONFIG = {
     "max_history": 10,  # 最大历史消息数
-    "expire_time": 3600  # 上下文过期时间（秒）
+    "max_context_tokens": 0,  # 发送给模型的上下文token预算，超出时不发送最早的消息（已保存的历史不受影响），0表示不限制
+    "expire_time": 3600,  # 上下文过期时间（秒）
+    "cleanup_interval": 60,  # 过期会话清理间隔（秒）
+    "max_sessions": 10000,  # 内存中保留的最大会话数，超出时淘汰最久未使用的会话
+    "max_bytes": 256 * 1024 * 1024  # 内存中会话消息的估算总字节数上限
+}
+
+# 存储配置
+STORAGE_CONFIG = {
+    "backend": "json",  # 存储后端：json（单文件）、log（分段追加日志）或 sqlite
+    "storage_dir": "data",  # 数据存储目录
+    "segment_max_bytes": 16 * 1024 * 1024,  # 单个日志段的最大字节数
+    "compact_interval": 60,  # 后台压缩检查间隔（秒）
+    "compact_min_segments": 4,  # 触发压缩的最少已封存日志段数量
+    "fsync": False,  # 每次追加后是否调用fsync落盘
+    "sqlite_file": "conversations.db",  # SQLite数据库文件名
+    "pool_size": 5,  # SQLite连接池大小
+    "multi_process": False,  # 多进程部署（如gunicorn多个worker）：写入加跨进程文件锁，会话上下文每次从存储读取
+    "tiering": False,  # 是否将长时间未更新的会话归档到压缩段（分层存储）
+    "archive_after": 7 * 24 * 3600,  # 会话超过该时间（秒）未更新即归档
+    "archive_interval": 3600,  # 后台归档检查间隔（秒）
+    "archive_compression": "gzip",  # 归档段压缩格式：gzip 或 lzma
+    "archive_block_size": 256 * 1024  # 归档段中每个压缩块的大小（字节，压缩前），按需读取时只解压一个块
+}
+
+# 持久化配置
+PERSIST_CONFIG = {
+    "write_behind": False,  # 是否启用异步批量写入（写回模式）
+    "flush_interval": 1.0,  # 脏数据最长等待写入时间（秒）
+    "batch_size": 100,  # 脏会话达到该数量时立即写入
+    "max_pending": 10000,  # 待写入会话数上限，超出时写入方阻塞等待
+    "close_retries": 3,  # 关闭时写入失败的最多重试次数，仍失败时丢弃剩余数据
+    "flush_timeout": 5,  # 列出、导出会话前等待未写入数据落盘的最长时间（秒），超时返回503
+    "close_timeout": 10  # 关闭时等待剩余数据写入的最长时间（秒）
+}
+
+# 全文搜索配置
+SEARCH_CONFIG = {
+    "enabled": False,  # 是否为存储的对话消息建立全文索引（/api/search）
+    "index_file": "search.db",  # 索引数据库文件名（位于存储目录下）
+    "block_size": 128,  # 每个倒排块最多包含的消息数
+    "flush_interval": 1.0,  # 存储写入到可被搜索的最长延迟（秒），期间的更新合并为一个事务
+    "page_size": 20,  # 默认每页结果数
+    "max_page_size": 100,  # 每页结果数上限
+    "snippet_length": 80,  # 结果中消息片段的最大字数
+    "close_timeout": 10  # 关闭时等待剩余更新写入索引的最长时间（秒），超时后未写入的更新需重建索引才能恢复
+}
+
+# 历史记录分页配置（/api/history、/api/sessions）
+HISTORY_CONFIG = {
+    "page_size": 20,  # 默认每页条数
+    "max_page_size": 100  # 每页条数上限
+}
+
+# 链路追踪与性能采集配置
+TRACE_CONFIG = {
+    "enabled": True,  # 是否记录请求各阶段耗时
+    "slow_threshold": 1.0,  # 耗时超过该值（秒）的请求保留到慢请求缓冲区
+    "buffer_size": 100,  # 慢请求缓冲区保留的最近请求数
+    "admin_token": None,  # 管理接口令牌，设置后请求需携带 X-Admin-Token 头；未设置时管理接口只允许本机直接访问
+    "profile_dir": "profiles",  # 性能采集文件输出目录
+    "max_profile_seconds": 300,  # 单次性能采集的最长时间（秒）
+    "sample_interval": 0.005  # 采样模式的采样间隔（秒）
+}
+
+# 日志配置
+LOG_CONFIG = {
+    "level": "INFO",  # 日志级别，设为 DEBUG 时输出上游逐帧日志
+    "format": "text",  # 输出格式：text（单行文本）或 json（每行一个JSON对象，便于日志采集）
+    "file": None,  # 日志文件路径，为None时输出到标准输出
+    "queue_size": 10000,  # 后台写日志队列的容量，队列满时丢弃新日志而不阻塞调用线程
+    "frame_rate": 20,  # 逐帧日志每秒最多输出的条数
+    "frame_burst": 100  # 逐帧日志允许的突发条数
 }
@@ -0,0 +1,222 @@
+import random
+import threading
+import time
+from collections import deque
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class PoolError(ConnectionError):
+    """连接池本身不可用（已关闭或等待可用连接超时），换一条连接重试没有意义"""
+
+
+def backoff_delay(attempt, base=0.5, cap=30):
+    """第 attempt 次重试前的等待时间：按指数增长并加入随机抖动，避免大量实例同时重连"""
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class ConnectionPool:
+    """通用连接池，每个进行中的请求独占一条连接
+    
+    连接由 factory 创建，需要提供 is_healthy()、close() 方法和 last_used 属性。
+    后台线程定期检查空闲连接的健康状态，淘汰失效或空闲过久的连接，
+    并将连接数补足到 min_size、空闲连接补足到 min_idle（热备连接）。
+    连接意外断开时调用 connection_lost 立即唤醒后台线程补充，补充失败时按指数退避重试。
+    """
+    
+    def __init__(self, factory, min_size=0, max_size=10, idle_timeout=300, health_check_interval=30,
+                 min_idle=0, backoff_base=0.5, backoff_max=30):
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_idle = min_idle
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        
+        self.idle = deque()
+        # 连接总数，包括空闲、使用中和正在创建的连接
+        self.size = 0
+        # 正在创建的连接数，其中 warming 条由后台线程创建、建立后放入空闲队列
+        self.creating = 0
+        self.warming = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        # 连续建立连接失败的次数和最近一次错误
+        self.failures = 0
+        self.last_error = None
+        
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self._maintainer = threading.Thread(target=self._maintain_loop, daemon=True)
+        self._maintainer.start()
+    
+    def acquire(self, timeout=30):
+        """取出一条健康的连接，没有空闲连接且未达上限时新建，否则等待"""
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise PoolError("连接池已关闭")
+                conn = self._pop_idle()
+                if conn is not None:
+                    return conn
+                if self.size < self.max_size:
+                    self.size += 1
+                    self.creating += 1
+                    self._check_standby()
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolError("等待可用连接超时")
+                self.condition.wait(remaining)
+        
+        return self._create(release=False)
+    
+    def acquire_idle(self):
+        """取出一条健康的空闲连接，没有空闲连接时立即返回None，不新建连接也不等待"""
+        with self.condition:
+            if self.closed:
+                return None
+            return self._pop_idle()
+    
+    def _pop_idle(self):
+        """从空闲队列取出一条健康的连接，淘汰途中遇到的失效连接（需持有 condition）"""
+        while self.idle:
+            conn = self.idle.pop()
+            if conn.is_healthy():
+                self._check_standby()
+                return conn
+            self.size -= 1
+            conn.close()
+        return None
+    
+    def _create(self, release=True):
+        """调用 factory 新建连接（调用前已占用名额），release 为 True 时作为热备连接放入空闲队列"""
+        try:
+            conn = self.factory()
+        except Exception as e:
+            with self.condition:
+                self.size -= 1
+                self.creating -= 1
+                self.warming -= release
+                self.failures += 1
+                self.last_error = str(e)
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.creating -= 1
+            self.warming -= release
+            self.failures = 0
+        if release:
+            self.release(conn)
+        return conn
+    
+    def _check_standby(self):
+        """热备连接被取用后唤醒后台线程补充（需持有 condition）"""
+        if len(self.idle) + self.warming < self.min_idle:
+            self._wake_event.set()
+    
+    def release(self, conn, reusable=True):
+        """归还连接，不可复用或已失效的连接直接关闭"""
+        with self.condition:
+            if reusable and not self.closed and conn.is_healthy():
+                conn.last_used = time.time()
+                self.idle.append(conn)
+                conn = None
+            else:
+                self.size -= 1
+                self._check_standby()
+            self.condition.notify()
+        if conn is not None:
+            conn.close()
+    
+    def connection_lost(self, conn=None):
+        """连接意外断开时调用，立即唤醒后台线程淘汰失效连接并补充"""
+        self._wake_event.set()
+    
+    def warm(self, min_idle):
+        """开始预热：后台建立并保持 min_idle 条空闲连接"""
+        self.min_idle = min_idle
+        self._wake_event.set()
+    
+    def _maintain_loop(self):
+        """后台健康检查线程，被唤醒或到达检查间隔时维护连接；补充失败时按指数退避提前重试"""
+        delay = self.health_check_interval
+        while True:
+            self._wake_event.wait(delay)
+            self._wake_event.clear()
+            if self._stop_event.is_set():
+                return
+            try:
+                healthy = self.maintain()
+            except Exception as e:
+                logger.error("连接池维护失败: %s", e)
+                healthy = False
+            if healthy:
+                delay = self.health_check_interval
+            else:
+                delay = backoff_delay(max(1, self.failures), self.backoff_base, self.backoff_max)
+    
+    def maintain(self):
+        """淘汰失效和空闲过久的连接，补足最小连接数和热备连接数，全部补充成功时返回True"""
+        evicted = []
+        now = time.time()
+        with self.condition:
+            for conn in list(self.idle):
+                expired = now - conn.last_used > self.idle_timeout and self.size - len(evicted) > self.min_size
+                if not conn.is_healthy() or expired:
+                    self.idle.remove(conn)
+                    evicted.append(conn)
+            self.size -= len(evicted)
+            missing = max(0, self.min_size - self.size, self.min_idle - len(self.idle) - self.warming)
+            missing = min(missing, self.max_size - self.size)
+            self.size += missing
+            self.creating += missing
+            self.warming += missing
+            if evicted:
+                self.condition.notify_all()
+        
+        for conn in evicted:
+            conn.close()
+        
+        healthy = True
+        for _ in range(missing):
+            try:
+                self._create()
+            except Exception as e:
+                logger.warning("补充连接失败: %s", e)
+                healthy = False
+        return healthy
+    
+    def stats(self):
+        """获取连接池状态"""
+        with self.condition:
+            return {"size": self.size, "idle": len(self.idle), "in_use": self.size - len(self.idle)}
+    
+    def health(self):
+        """连接池健康状态：至少有一条已建立的连接（空闲或使用中）时视为就绪"""
+        with self.condition:
+            return {
+                "ready": self.size - self.creating > 0,
+                "idle": len(self.idle),
+                "connecting": self.creating,
+                "failures": self.failures,
+                "last_error": self.last_error
+            }
+    
+    def close(self):
+        """关闭连接池及所有空闲连接"""
+        self._stop_event.set()
+        self._wake_event.set()
+        with self.condition:
+            self.closed = True
+            idle = list(self.idle)
+            self.idle.clear()
+            self.size -= len(idle)
+            self.condition.notify_all()
+        for conn in idle:
+            conn.close()
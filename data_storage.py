@@ -1,35 +1,317 @@
+import codecs
+import heapq
 import json
 import os
+import threading
 import time
+import zlib
 from datetime import datetime
+from metrics import STORAGE_BYTES
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 fcntl，文件锁只保证进程内的互斥
+    fcntl = None
+
+EXPORT_FORMATS = ("json", "ndjson", "txt")
+EXPORT_CONTENT_TYPES = {
+    "json": "application/json; charset=utf-8",
+    "ndjson": "application/x-ndjson; charset=utf-8",
+    "txt": "text/plain; charset=utf-8"
+}
+# 流式导出时每次输出的块大小
+EXPORT_CHUNK_SIZE = 64 * 1024
+# 增量解析JSON文件时每次读取的字节数
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def iter_json_object(f, chunk_size=READ_CHUNK_SIZE):
+    """增量解析二进制文件中的顶层JSON对象，逐个返回 (键, 值)，内存中只保留当前条目"""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ""
+    eof = False
+    
+    def read_more():
+        nonlocal buffer, eof
+        # 单个条目较大时按已缓冲的长度加倍读取，避免反复解析
+        data = f.read(max(chunk_size, len(buffer)))
+        STORAGE_BYTES.inc(len(data), direction="read")
+        eof = not data
+        buffer += utf8.decode(data, final=eof)
+    
+    def skip_whitespace(pos):
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer) or eof:
+                return pos
+            read_more()
+    
+    def decode(pos):
+        while True:
+            try:
+                return decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                read_more()
+    
+    pos = skip_whitespace(0)
+    if pos >= len(buffer):
+        return
+    if buffer[pos] != "{":
+        raise json.JSONDecodeError("应为JSON对象", buffer, pos)
+    pos = skip_whitespace(pos + 1)
+    if buffer[pos:pos + 1] == "}":
+        return
+    while True:
+        key, pos = decode(pos)
+        pos = skip_whitespace(pos)
+        if buffer[pos:pos + 1] != ":":
+            raise json.JSONDecodeError("应为 ':'", buffer, pos)
+        value, pos = decode(skip_whitespace(pos + 1))
+        yield key, value
+        pos = skip_whitespace(pos)
+        separator = buffer[pos:pos + 1]
+        if separator not in (",", "}"):
+            raise json.JSONDecodeError("应为 ',' 或 '}'", buffer, pos)
+        # 丢弃已解析的部分
+        buffer = buffer[pos + 1:]
+        if separator == "}":
+            return
+        pos = skip_whitespace(0)
+
+
+def conversation_matches(session_id, conversation, session_ids=None, since=None, until=None):
+    """判断会话是否满足导出条件：会话ID在列表中，最后更新时间在 [since, until] 范围内"""
+    if session_ids is not None and session_id not in session_ids:
+        return False
+    last_updated = conversation.get("last_updated", 0)
+    if since is not None and last_updated < since:
+        return False
+    if until is not None and last_updated > until:
+        return False
+    return True
+
+
+def message_cursor(before):
+    """统一消息分页游标的格式，返回 (时间戳, 跳过的同一时间戳消息数) 或None
+    
+    before 为 (时间戳, n) 时表示上一页已经返回了该时间戳下最新的 n 条消息；只给出时间戳时 n 为None，
+    表示只取更早的消息。同一时间戳的消息按存储顺序排列，存储重写（行ID变化）或截断最早的消息后游标仍然有效。
+    """
+    if before is None:
+        return None
+    if isinstance(before, (tuple, list)):
+        timestamp, skip = before
+        return float(timestamp), (None if skip is None else int(skip))
+    return float(before), None
+
+
+def select_messages(newest_first, before=None, limit=None):
+    """从按时间倒序的消息序列中取出排在游标 before 之后的消息，最多 limit 条"""
+    before = message_cursor(before)
+    selected = []
+    skipped = 0
+    for message in newest_first:
+        if limit is not None and len(selected) >= limit:
+            break
+        if before is not None:
+            timestamp = message.get("timestamp") or 0
+            if timestamp > before[0]:
+                continue
+            if timestamp == before[0] and (before[1] is None or skipped < before[1]):
+                skipped += 1
+                continue
+        selected.append(message)
+    return selected
+
+
+def newest_messages(messages, before=None, limit=None):
+    """从按时间顺序排列的消息列表中，按时间倒序取出排在游标 before 之后的消息，最多 limit 条"""
+    return select_messages(reversed(messages), before, limit)
+
+
+def next_message_cursor(page, before=None):
+    """按时间倒序的一页消息之后的游标：最后一条消息的时间戳，以及至此已返回的该时间戳消息数"""
+    timestamp = page[-1].get("timestamp") or 0
+    count = sum(1 for message in page if (message.get("timestamp") or 0) == timestamp)
+    before = message_cursor(before)
+    if before is not None and before[0] == timestamp and before[1] is not None:
+        count += before[1]
+    return timestamp, count
+
+
+def session_summary(session_id, conversation):
+    """会话列表中的一项：会话ID与最后更新时间"""
+    return {
+        "session_id": session_id,
+        "last_updated": conversation.get("last_updated", 0),
+        "updated_at": conversation.get("updated_at", "")
+    }
+
+
+def newest_sessions(summaries, before=None, limit=None):
+    """按 (last_updated, session_id) 倒序取出排在游标 before 之后的会话，最多 limit 条
+    
+    summaries 可以是迭代器，指定 limit 时内存中只保留 limit 条。
+    """
+    key = lambda summary: (summary["last_updated"], summary["session_id"])
+    if before is not None:
+        before = tuple(before)
+        summaries = (summary for summary in summaries if key(summary) < before)
+    if limit is None:
+        return sorted(summaries, key=key, reverse=True)
+    return heapq.nlargest(limit, summaries, key=key)
+
+
+def export_pieces(format, conversations):
+    """将 (session_id, 对话数据) 迭代器按导出格式逐段转换为文本"""
+    if format == "json":
+        # 与 json.dumps(全部会话, indent=2) 的输出一致，但每次只序列化一个会话
+        separator = "{\n"
+        for session_id, conversation in conversations:
+            text = json.dumps({session_id: conversation}, ensure_ascii=False, indent=2)
+            yield separator + text[2:-2]
+            separator = ",\n"
+        yield "{}" if separator == "{\n" else "\n}"
+    elif format == "ndjson":
+        for session_id, conversation in conversations:
+            yield json.dumps({"session_id": session_id, **conversation}, ensure_ascii=False) + "\n"
+    else:
+        for session_id, conversation in conversations:
+            lines = [f"=== 会话 {session_id} ===\n", f"最后更新: {conversation.get('updated_at', '')}\n\n"]
+            for msg in conversation["messages"]:
+                lines.append(f"[{msg['role']}] {msg['content']}\n\n")
+            lines.append("\n")
+            yield "".join(lines)
+
+
+def encode_chunks(pieces, compress=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """将文本片段编码为UTF-8并合并为较大的块输出，可选边输出边gzip压缩"""
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+    buffered = []
+    size = 0
+    for piece in pieces:
+        data = piece.encode('utf-8')
+        buffered.append(data)
+        size += len(data)
+        if size < chunk_size:
+            continue
+        chunk = b"".join(buffered)
+        buffered, size = [], 0
+        if compressor:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+    chunk = b"".join(buffered)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+class FileLock:
+    """跨进程的排他锁（fcntl.flock），同一线程内可重入，同一进程的线程之间也互斥
+    
+    每次在最外层加锁时重新打开锁文件：flock 的锁属于打开的文件描述，
+    若在 fork 之前打开，所有worker进程共享同一个描述，锁就失去了互斥作用。
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+    
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if self.depth == 0 and fcntl is not None:
+            try:
+                self.file = open(self.path, 'ab')
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            except BaseException:
+                if self.file:
+                    self.file.close()
+                    self.file = None
+                self.thread_lock.release()
+                raise
+        self.depth += 1
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0 and self.file is not None:
+            # 关闭文件即释放 flock
+            self.file.close()
+            self.file = None
+        self.thread_lock.release()
+
 
 class DataStorage:
     def __init__(self, storage_dir="data"):
         self.storage_dir = storage_dir
         self.conversations_file = os.path.join(storage_dir, "conversations.json")
+        # 读-改-写整个文件期间持有，多个进程（gunicorn worker）同时写入也不会互相覆盖
+        self.file_lock = FileLock(os.path.join(storage_dir, "storage.lock"))
+        # 写入观察者（如全文索引），写入成功后被通知
+        self.observers = []
         self.init_storage()
     
+    def add_observer(self, observer):
+        """注册写入观察者，观察者需提供 conversations_saved(会话ID -> 消息列表)、
+        message_saved(session_id, 消息) 和 conversations_deleted(会话ID列表) 方法"""
+        self.observers.append(observer)
+    
+    def _notify(self, event, *args):
+        """通知所有观察者，观察者的异常不影响写入结果"""
+        for observer in self.observers:
+            try:
+                getattr(observer, event)(*args)
+            except Exception as e:
+                logger.error("存储观察者处理 %s 失败: %s", event, e)
+    
     def init_storage(self):
         """初始化存储目录和文件"""
-        if not os.path.exists(self.storage_dir):
-            os.makedirs(self.storage_dir)
+        os.makedirs(self.storage_dir, exist_ok=True)
         
-        if not os.path.exists(self.conversations_file):
-            with open(self.conversations_file, 'w', encoding='utf-8') as f:
-                json.dump({}, f, ensure_ascii=False, indent=2)
+        # 多个worker同时启动时只由一个进程创建文件
+        with self.file_lock:
+            if not os.path.exists(self.conversations_file):
+                self._write_all({})
     
     def save_conversation(self, session_id, messages):
         """保存对话历史"""
-        conversations = self.load_all_conversations()
-        
-        conversations[session_id] = {
-            "messages": messages,
-            "last_updated": time.time(),
-            "updated_at": datetime.now().isoformat()
-        }
-        
-        with open(self.conversations_file, 'w', encoding='utf-8') as f:
-            json.dump(conversations, f, ensure_ascii=False, indent=2)
+        with self.file_lock:
+            conversations = self.load_all_conversations()
+            
+            conversations[session_id] = {
+                "messages": messages,
+                "last_updated": time.time(),
+                "updated_at": datetime.now().isoformat()
+            }
+            
+            self._write_all(conversations)
+        self._notify("conversations_saved", {session_id: messages})
+    
+    def save_conversations(self, conversations):
+        """批量保存多个会话的对话历史，只读写一次文件"""
+        with self.file_lock:
+            all_conversations = self.load_all_conversations()
+            
+            for session_id, messages in conversations.items():
+                all_conversations[session_id] = {
+                    "messages": messages,
+                    "last_updated": time.time(),
+                    "updated_at": datetime.now().isoformat()
+                }
+            
+            self._write_all(all_conversations)
+        self._notify("conversations_saved", conversations)
     
     def load_conversation(self, session_id):
         """加载特定会话的对话历史"""
@@ -43,40 +325,70 @@ class DataStorage:
     def load_all_conversations(self):
         """加载所有对话历史"""
         try:
-            with open(self.conversations_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
+            with open(self.conversations_file, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return {}
+        STORAGE_BYTES.inc(len(data), direction="read")
+        try:
+            return json.loads(data)
+        except json.JSONDecodeError:
             return {}
     
+    def _write_all(self, conversations):
+        """将所有对话历史写回文件（调用方需持有 file_lock）
+        
+        先写入临时文件再原子替换，不加锁的读取方只会看到完整的旧文件或新文件。
+        """
+        data = json.dumps(conversations, ensure_ascii=False, indent=2).encode('utf-8')
+        temp_file = f"{self.conversations_file}.{os.getpid()}.tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(data)
+        os.replace(temp_file, self.conversations_file)
+        STORAGE_BYTES.inc(len(data), direction="write")
+    
     def delete_conversation(self, session_id):
         """删除特定会话的对话历史"""
-        conversations = self.load_all_conversations()
-        
-        if session_id in conversations:
-            del conversations[session_id]
+        with self.file_lock:
+            conversations = self.load_all_conversations()
             
-            with open(self.conversations_file, 'w', encoding='utf-8') as f:
-                json.dump(conversations, f, ensure_ascii=False, indent=2)
-            return True
+            if session_id in conversations:
+                del conversations[session_id]
+                
+                self._write_all(conversations)
+                self._notify("conversations_deleted", [session_id])
+                return True
         
         return False
     
+    def delete_conversations(self, session_ids):
+        """批量删除多个会话，只读写一次文件，返回删除的会话数"""
+        with self.file_lock:
+            conversations = self.load_all_conversations()
+            deleted = [session_id for session_id in session_ids if conversations.pop(session_id, None) is not None]
+            if deleted:
+                self._write_all(conversations)
+                self._notify("conversations_deleted", deleted)
+        return len(deleted)
+    
     def clean_old_conversations(self, days=7):
         """清理指定天数前的对话历史"""
         cutoff_time = time.time() - (days * 24 * 60 * 60)
-        conversations = self.load_all_conversations()
-        
-        old_conversations = []
-        for session_id, data in conversations.items():
-            if data.get("last_updated", 0) < cutoff_time:
-                old_conversations.append(session_id)
-        
-        for session_id in old_conversations:
-            del conversations[session_id]
-        
-        with open(self.conversations_file, 'w', encoding='utf-8') as f:
-            json.dump(conversations, f, ensure_ascii=False, indent=2)
+        with self.file_lock:
+            conversations = self.load_all_conversations()
+            
+            old_conversations = []
+            for session_id, data in conversations.items():
+                if data.get("last_updated", 0) < cutoff_time:
+                    old_conversations.append(session_id)
+            
+            for session_id in old_conversations:
+                del conversations[session_id]
+            
+            self._write_all(conversations)
         
+        if old_conversations:
+            self._notify("conversations_deleted", old_conversations)
         return len(old_conversations)
     
     def get_conversation_count(self):
@@ -86,8 +398,6 @@ class DataStorage:
     
     def save_message(self, session_id, role, content):
         """保存单条消息"""
-        conversation = self.load_conversation(session_id)
-        
         message = {
             "role": role,
             "content": content,
@@ -95,30 +405,103 @@ class DataStorage:
             "created_at": datetime.now().isoformat()
         }
         
-        conversation["messages"].append(message)
-        conversation["last_updated"] = time.time()
-        conversation["updated_at"] = datetime.now().isoformat()
+        with self.file_lock:
+            conversations = self.load_all_conversations()
+            conversation = conversations.get(session_id) or {"messages": []}
+            
+            conversation["messages"].append(message)
+            conversation["last_updated"] = time.time()
+            conversation["updated_at"] = datetime.now().isoformat()
+            conversations[session_id] = conversation
+            
+            self._write_all(conversations)
+        self._notify("message_saved", session_id, message)
+    
+    def iter_conversations(self, session_ids=None, since=None, until=None):
+        """逐个读取满足条件的会话，返回 (session_id, 对话数据) 迭代器，不一次加载全部会话"""
+        session_ids = set(session_ids) if session_ids is not None else None
+        try:
+            f = open(self.conversations_file, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            for session_id, conversation in iter_json_object(f):
+                if conversation_matches(session_id, conversation, session_ids, since, until):
+                    yield session_id, conversation
+    
+    def iter_messages(self, session_id, before=None, limit=None):
+        """按时间倒序逐条返回会话中排在游标 before 之后的消息（见 message_cursor），最多 limit 条
         
-        conversations = self.load_all_conversations()
-        conversations[session_id] = conversation
+        JSON 文件只能顺序解析，找到该会话后即停止读取，内存中不保留其他会话。
+        """
+        for _, conversation in self.iter_conversations([session_id]):
+            yield from newest_messages(conversation["messages"], before, limit)
+            return
+    
+    def list_sessions(self, before=None, limit=None):
+        """按最后更新时间倒序列出会话，before 为上一页最后一项的 (last_updated, session_id)
         
-        with open(self.conversations_file, 'w', encoding='utf-8') as f:
-            json.dump(conversations, f, ensure_ascii=False, indent=2)
+        需要顺序解析整个文件，但内存中只保留 limit 条会话摘要。
+        """
+        return newest_sessions((session_summary(session_id, conversation)
+                                for session_id, conversation in self.iter_conversations()), before, limit)
+    
+    def iter_export(self, format="json", session_ids=None, since=None, until=None, compress=False):
+        """流式导出对话历史，返回 bytes 块的迭代器，内存占用与会话总数无关
+        
+        format 为 json / ndjson / txt；compress 为 True 时输出gzip格式。
+        """
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"不支持的导出格式: {format}")
+        conversations = self.iter_conversations(session_ids, since, until)
+        return encode_chunks(export_pieces(format, conversations), compress)
     
     def export_conversations(self, format="json"):
         """导出对话历史"""
-        conversations = self.load_all_conversations()
+        return b"".join(self.iter_export(format)).decode('utf-8')
+    
+    def import_conversations(self, conversations):
+        """批量导入对话历史（用于迁移）"""
+        with self.file_lock:
+            all_conversations = self.load_all_conversations()
+            all_conversations.update(conversations)
+            
+            self._write_all(all_conversations)
         
-        if format == "json":
-            return json.dumps(conversations, ensure_ascii=False, indent=2)
-        elif format == "txt":
-            txt_content = ""
-            for session_id, data in conversations.items():
-                txt_content += f"=== 会话 {session_id} ===\n"
-                txt_content += f"最后更新: {data['updated_at']}\n\n"
-                for msg in data['messages']:
-                    txt_content += f"[{msg['role']}] {msg['content']}\n\n"
-                txt_content += "\n"
-            return txt_content
-        else:
-            raise ValueError(f"不支持的导出格式: {format}")
+        self._notify("conversations_saved", {session_id: data.get("messages", [])
+                                             for session_id, data in conversations.items()})
+        return len(conversations)
+    
+    def close(self):
+        """释放存储资源"""
+        pass
+
+
+def create_storage(backend=None, storage_dir=None):
+    """根据配置创建存储后端"""
+    from config import STORAGE_CONFIG
+    backend = backend or STORAGE_CONFIG.get("backend", "json")
+    storage_dir = storage_dir or STORAGE_CONFIG.get("storage_dir", "data")
+    
+    if backend == "json":
+        storage = DataStorage(storage_dir)
+    elif backend == "log":
+        if STORAGE_CONFIG.get("multi_process"):
+            # 日志段的偏移索引只在单个进程的内存中维护
+            raise ValueError("log 存储后端不支持多进程部署，请使用 json 或 sqlite")
+        from log_storage import LogStorage
+        storage = LogStorage(storage_dir)
+    elif backend == "sqlite":
+        from sqlite_storage import SQLiteStorage
+        storage = SQLiteStorage(storage_dir)
+    else:
+        raise ValueError(f"不支持的存储后端: {backend}")
+    
+    if STORAGE_CONFIG.get("tiering"):
+        if STORAGE_CONFIG.get("multi_process"):
+            storage.close()
+            # 归档索引只在单个进程的内存中维护
+            raise ValueError("分层存储不支持多进程部署")
+        from tiered_storage import TieredStorage
+        storage = TieredStorage(storage, storage_dir)
+    return storage
@@ -0,0 +1,79 @@
+import threading
+import time
+from config import WS_CONFIG
+
+# 请求截止时间：每个聊天请求在进入服务时确定一个绝对截止时间（time.monotonic），
+# 沿调用链传递给取连接、发送、重试退避和等待上游帧的各个环节，每一步只等待剩余的时间，
+# 重试不会重新开始计时。cancel() 提前结束请求，注册的回调（关闭上游连接）立即执行，
+# 上游随之停止生成，不再消耗配额。
+
+
+class DeadlineExceeded(TimeoutError):
+    """请求超过截止时间或已被取消"""
+
+
+class Deadline:
+    """一次请求的截止时间，可被提前取消"""
+    
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+        self.cancelled = False
+        self.callbacks = []
+        self.lock = threading.Lock()
+    
+    def remaining(self):
+        """剩余时间（秒），已取消或已超时时为0"""
+        if self.cancelled:
+            return 0.0
+        return max(0.0, self.expires_at - time.monotonic())
+    
+    def expired(self):
+        return self.cancelled or time.monotonic() >= self.expires_at
+    
+    def check(self):
+        """已取消或已超时时抛出 DeadlineExceeded"""
+        if self.cancelled:
+            raise DeadlineExceeded("请求已取消")
+        if time.monotonic() >= self.expires_at:
+            raise DeadlineExceeded("请求超过截止时间")
+    
+    def extend(self, expires_at):
+        """把截止时间延后到 expires_at，更早时不变；用于多个请求共享的生成"""
+        with self.lock:
+            self.expires_at = max(self.expires_at, expires_at)
+    
+    def on_cancel(self, callback):
+        """注册取消时的回调，返回注销函数；已取消时立即调用"""
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return lambda: self._unregister(callback)
+        callback()
+        return lambda: None
+    
+    def _unregister(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+    
+    def cancel(self):
+        """取消请求，执行所有注册的回调"""
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+def request_deadline(timeout=None):
+    """聊天请求的截止时间：timeout 为请求指定的秒数，默认 request_timeout，不超过 max_request_timeout
+    
+    timeout 不是正数时抛出 ValueError。
+    """
+    timeout = float(timeout) if timeout is not None else WS_CONFIG["request_timeout"]
+    if not timeout > 0:
+        raise ValueError("timeout 应为正数")
+    return Deadline(min(timeout, WS_CONFIG["max_request_timeout"]))
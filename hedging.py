@@ -0,0 +1,76 @@
+import threading
+from collections import deque
+from config import HEDGE_CONFIG
+
+# 对冲请求：上游偶尔有慢连接时，首帧迟迟不到的请求在另一条连接上再发一次，先返回首帧的一方胜出，
+# 另一方的连接立即关闭。对冲延迟取最近首帧延迟的分位数，只有落在长尾的请求才会对冲；
+# 对冲次数受预算限制（不超过请求数的 budget 比例），上游整体变慢时不会成倍放大负载。
+
+
+class HedgePolicy:
+    """根据最近的首帧延迟决定何时发出对冲请求"""
+    
+    def __init__(self, percentile=0.95, min_delay=0.1, max_delay=5.0, window=500, min_samples=20,
+                 budget=0.1):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.budget = budget
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+        # 对冲预算：每个请求积累 budget 个令牌，每次对冲消耗一个，最多积累10个
+        self.tokens = 1.0
+        self.cached_delay = None
+        self.new_samples = 0
+        self.requests = 0
+        self.hedged = 0
+    
+    def observe(self, seconds):
+        """记录一次请求从发送到收到首帧的耗时"""
+        with self.lock:
+            self.samples.append(seconds)
+            self.new_samples += 1
+    
+    def delay(self):
+        """本次请求的对冲延迟（秒），样本不足时返回None（不对冲）"""
+        with self.lock:
+            self.requests += 1
+            self.tokens = min(10.0, self.tokens + self.budget)
+            if len(self.samples) < self.min_samples:
+                return None
+            # 分位数每积累一批新样本才重新计算
+            if self.cached_delay is None or self.new_samples * 20 >= len(self.samples):
+                ordered = sorted(self.samples)
+                value = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))] if ordered else self.max_delay
+                self.cached_delay = min(self.max_delay, max(self.min_delay, value))
+                self.new_samples = 0
+            return self.cached_delay
+    
+    def allow(self):
+        """消耗一次对冲预算，预算不足时返回False"""
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.hedged += 1
+            return True
+    
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "hedged": self.hedged, "samples": len(self.samples),
+                    "delay": self.cached_delay}
+
+
+def from_config():
+    """按 HEDGE_CONFIG 创建对冲策略，未启用时返回None"""
+    if not HEDGE_CONFIG["enabled"]:
+        return None
+    return HedgePolicy(
+        percentile=HEDGE_CONFIG["percentile"],
+        min_delay=HEDGE_CONFIG["min_delay"],
+        max_delay=HEDGE_CONFIG["max_delay"],
+        window=HEDGE_CONFIG["window"],
+        min_samples=HEDGE_CONFIG["min_samples"],
+        budget=HEDGE_CONFIG["budget"]
+    )
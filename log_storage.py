@@ -0,0 +1,404 @@
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from data_storage import DataStorage, conversation_matches, newest_sessions, select_messages, session_summary
+from config import STORAGE_CONFIG
+from metrics import STORAGE_BYTES
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+SEGMENT_PATTERN = re.compile(r"^segment_(\d{6})\.jsonl$")
+
+
+class LogStorage(DataStorage):
+    """基于分段JSONL追加日志的存储后端
+    
+    每次写入只在当前日志段末尾追加一条记录，内存中为每个会话维护记录偏移索引，
+    读取时按偏移直接定位；已封存的日志段由后台线程定期压缩，启动时重放日志完成崩溃恢复。
+    """
+    
+    def __init__(self, storage_dir="data", segment_max_bytes=None, compact_interval=None,
+                 compact_min_segments=None, fsync=None):
+        self.log_dir = os.path.join(storage_dir, "log")
+        self.segment_max_bytes = segment_max_bytes or STORAGE_CONFIG["segment_max_bytes"]
+        self.compact_interval = compact_interval or STORAGE_CONFIG["compact_interval"]
+        self.compact_min_segments = compact_min_segments or STORAGE_CONFIG["compact_min_segments"]
+        self.fsync = STORAGE_CONFIG["fsync"] if fsync is None else fsync
+        
+        self.lock = threading.RLock()
+        self.compact_lock = threading.Lock()
+        # session_id -> {"entries": [(段号, 偏移, 长度)], "last_updated": ..., "updated_at": ...}
+        self.index = {}
+        self.segments = []
+        self.active_segment = None
+        self.active_file = None
+        self.active_size = 0
+        
+        super().__init__(storage_dir)
+        
+        # 启动后台压缩线程
+        self._stop_event = threading.Event()
+        self._compactor = threading.Thread(target=self._compact_loop, daemon=True)
+        self._compactor.start()
+    
+    def init_storage(self):
+        """初始化日志目录并重放已有日志段"""
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        
+        # 清理压缩过程中崩溃遗留的临时文件
+        for name in os.listdir(self.log_dir):
+            if name.endswith(".compact"):
+                os.remove(os.path.join(self.log_dir, name))
+        
+        self._recover()
+        
+        if self.segments and os.path.getsize(self._segment_path(self.segments[-1])) < self.segment_max_bytes:
+            self._open_active(self.segments[-1])
+        else:
+            self._open_active(self.segments[-1] + 1 if self.segments else 1)
+    
+    def _segment_path(self, segment_id):
+        return os.path.join(self.log_dir, f"segment_{segment_id:06d}.jsonl")
+    
+    def _open_active(self, segment_id):
+        """打开（或新建）当前可写的日志段"""
+        if self.active_file:
+            self.active_file.close()
+        path = self._segment_path(segment_id)
+        self.active_file = open(path, 'ab')
+        self.active_size = self.active_file.tell()
+        self.active_segment = segment_id
+        if segment_id not in self.segments:
+            self.segments.append(segment_id)
+    
+    def _recover(self):
+        """按段号顺序重放日志，重建内存索引并截断写入不完整的尾部记录"""
+        segment_ids = []
+        for name in os.listdir(self.log_dir):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                segment_ids.append(int(match.group(1)))
+        segment_ids.sort()
+        
+        stale_segments = []
+        for segment_id in segment_ids:
+            path = self._segment_path(segment_id)
+            offset = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if record.get("op") == "base":
+                        # 压缩段包含此前的全部状态，更早的段是压缩中途崩溃的残留
+                        stale_segments.extend(s for s in segment_ids if s < segment_id)
+                        self.index.clear()
+                    self._apply(record, segment_id, offset, len(line))
+                    offset += len(line)
+            
+            if offset < os.path.getsize(path):
+                logger.warning("日志段 %s 尾部记录不完整，已截断至 %d 字节", path, offset)
+                with open(path, 'r+b') as f:
+                    f.truncate(offset)
+        
+        for segment_id in set(stale_segments):
+            os.remove(self._segment_path(segment_id))
+        self.segments = [s for s in segment_ids if s not in stale_segments]
+    
+    def _apply(self, record, segment_id, offset, length):
+        """将一条日志记录应用到内存索引"""
+        op = record.get("op")
+        session_id = record.get("session_id")
+        
+        if op == "put":
+            self.index[session_id] = {
+                "entries": [(segment_id, offset, length)],
+                "last_updated": record["last_updated"],
+                "updated_at": record["updated_at"]
+            }
+        elif op == "append":
+            entry = self.index.setdefault(session_id, {"entries": []})
+            entry["entries"].append((segment_id, offset, length))
+            entry["last_updated"] = record["last_updated"]
+            entry["updated_at"] = record["updated_at"]
+        elif op == "delete":
+            self.index.pop(session_id, None)
+    
+    def _append(self, records):
+        """追加若干条记录到当前日志段并更新索引"""
+        written = 0
+        with self.lock:
+            for record in records:
+                line = (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+                if self.active_size > 0 and self.active_size + len(line) > self.segment_max_bytes:
+                    self._open_active(self.active_segment + 1)
+                
+                offset = self.active_size
+                self.active_file.write(line)
+                self.active_size += len(line)
+                written += len(line)
+                self._apply(record, self.active_segment, offset, len(line))
+            
+            self.active_file.flush()
+            if self.fsync:
+                os.fsync(self.active_file.fileno())
+        STORAGE_BYTES.inc(written, direction="write")
+    
+    def _read_records(self, entries):
+        """按索引条目读取日志记录"""
+        records = []
+        handles = {}
+        read = 0
+        try:
+            for segment_id, offset, length in entries:
+                if segment_id not in handles:
+                    handles[segment_id] = open(self._segment_path(segment_id), 'rb')
+                f = handles[segment_id]
+                f.seek(offset)
+                records.append(json.loads(f.read(length)))
+                read += length
+        finally:
+            for f in handles.values():
+                f.close()
+            STORAGE_BYTES.inc(read, direction="read")
+        return records
+    
+    def _materialize(self, records):
+        """将一个会话的日志记录合并为完整的对话数据"""
+        conversation = {"messages": [], "last_updated": time.time(), "updated_at": datetime.now().isoformat()}
+        for record in records:
+            if record["op"] == "put":
+                conversation["messages"] = list(record["messages"])
+            else:
+                conversation["messages"].append(record["message"])
+            conversation["last_updated"] = record["last_updated"]
+            conversation["updated_at"] = record["updated_at"]
+        return conversation
+    
+    def save_conversation(self, session_id, messages):
+        """保存对话历史"""
+        self._append([{
+            "op": "put",
+            "session_id": session_id,
+            "messages": messages,
+            "last_updated": time.time(),
+            "updated_at": datetime.now().isoformat()
+        }])
+        self._notify("conversations_saved", {session_id: messages})
+    
+    def save_conversations(self, conversations):
+        """批量保存多个会话的对话历史，一次追加写入"""
+        self._append([{
+            "op": "put",
+            "session_id": session_id,
+            "messages": messages,
+            "last_updated": time.time(),
+            "updated_at": datetime.now().isoformat()
+        } for session_id, messages in conversations.items()])
+        self._notify("conversations_saved", conversations)
+    
+    def load_conversation(self, session_id):
+        """加载特定会话的对话历史"""
+        with self.lock:
+            entry = self.index.get(session_id)
+            if entry is None:
+                return {
+                    "messages": [],
+                    "last_updated": time.time(),
+                    "updated_at": datetime.now().isoformat()
+                }
+            return self._materialize(self._read_records(entry["entries"]))
+    
+    def load_all_conversations(self):
+        """加载所有对话历史"""
+        with self.lock:
+            return {
+                session_id: self._materialize(self._read_records(entry["entries"]))
+                for session_id, entry in self.index.items()
+            }
+    
+    def iter_conversations(self, session_ids=None, since=None, until=None):
+        """逐个读取满足条件的会话，先按索引中的更新时间过滤，只读取需要导出的记录"""
+        with self.lock:
+            candidates = list(self.index) if session_ids is None else [s for s in session_ids if s in self.index]
+        for session_id in candidates:
+            with self.lock:
+                entry = self.index.get(session_id)
+                # 遍历期间可能已被删除
+                if entry is None or not conversation_matches(session_id, entry, None, since, until):
+                    continue
+                conversation = self._materialize(self._read_records(entry["entries"]))
+            yield session_id, conversation
+    
+    def iter_messages(self, session_id, before=None, limit=None):
+        """按时间倒序逐条返回会话中排在游标 before 之后的消息（见 message_cursor），最多 limit 条
+        
+        从最新的日志记录向前逐条读取，凑够 limit 条或遇到整体保存（put）的记录即停止。
+        """
+        def newest_first(entries):
+            for position in reversed(entries):
+                record = self._read_records([position])[0]
+                if record["op"] == "put":
+                    yield from reversed(record["messages"])
+                    return
+                yield record["message"]
+        
+        with self.lock:
+            entry = self.index.get(session_id)
+            messages = select_messages(newest_first(entry["entries"] if entry else []), before, limit)
+        yield from messages
+    
+    def list_sessions(self, before=None, limit=None):
+        """按最后更新时间倒序列出会话，只使用内存索引，不读取日志"""
+        with self.lock:
+            summaries = [session_summary(session_id, entry) for session_id, entry in self.index.items()]
+        return newest_sessions(summaries, before, limit)
+    
+    def delete_conversation(self, session_id):
+        """删除特定会话的对话历史"""
+        with self.lock:
+            if session_id not in self.index:
+                return False
+            self._append([{"op": "delete", "session_id": session_id}])
+        self._notify("conversations_deleted", [session_id])
+        return True
+    
+    def delete_conversations(self, session_ids):
+        """批量删除多个会话，一次追加写入"""
+        with self.lock:
+            deleted = [session_id for session_id in dict.fromkeys(session_ids) if session_id in self.index]
+            if deleted:
+                self._append([{"op": "delete", "session_id": session_id} for session_id in deleted])
+        if deleted:
+            self._notify("conversations_deleted", deleted)
+        return len(deleted)
+    
+    def clean_old_conversations(self, days=7):
+        """清理指定天数前的对话历史"""
+        cutoff_time = time.time() - (days * 24 * 60 * 60)
+        with self.lock:
+            old_conversations = [
+                session_id for session_id, entry in self.index.items()
+                if entry.get("last_updated", 0) < cutoff_time
+            ]
+            if old_conversations:
+                self._append([{"op": "delete", "session_id": session_id} for session_id in old_conversations])
+        if old_conversations:
+            self._notify("conversations_deleted", old_conversations)
+        return len(old_conversations)
+    
+    def get_conversation_count(self):
+        """获取对话历史数量"""
+        with self.lock:
+            return len(self.index)
+    
+    def save_message(self, session_id, role, content):
+        """保存单条消息"""
+        message = {
+            "role": role,
+            "content": content,
+            "timestamp": time.time(),
+            "created_at": datetime.now().isoformat()
+        }
+        self._append([{
+            "op": "append",
+            "session_id": session_id,
+            "message": message,
+            "last_updated": time.time(),
+            "updated_at": datetime.now().isoformat()
+        }])
+        self._notify("message_saved", session_id, message)
+    
+    def import_conversations(self, conversations):
+        """批量导入对话历史（用于迁移），保留原有的更新时间"""
+        self._append([{
+            "op": "put",
+            "session_id": session_id,
+            "messages": data.get("messages", []),
+            "last_updated": data.get("last_updated", time.time()),
+            "updated_at": data.get("updated_at", datetime.now().isoformat())
+        } for session_id, data in conversations.items()])
+        self._notify("conversations_saved", {session_id: data.get("messages", [])
+                                             for session_id, data in conversations.items()})
+        return len(conversations)
+    
+    def compact(self):
+        """压缩所有已封存的日志段，返回被合并的段数量
+        
+        已封存的段不再被写入，因此读取和重写都在锁外进行，
+        只有最后替换文件和更新索引时才持有锁。
+        """
+        with self.compact_lock:
+            with self.lock:
+                sealed = [s for s in self.segments if s != self.active_segment]
+                if not sealed:
+                    return 0
+                target = sealed[-1]
+                snapshot = {}
+                for session_id, entry in self.index.items():
+                    prefix = [e for e in entry["entries"] if e[0] <= target]
+                    if prefix:
+                        snapshot[session_id] = prefix
+            
+            tmp_path = self._segment_path(target) + ".compact"
+            positions = {}
+            with open(tmp_path, 'wb') as f:
+                f.write((json.dumps({"op": "base"}) + "\n").encode('utf-8'))
+                for session_id, entries in snapshot.items():
+                    conversation = self._materialize(self._read_records(entries))
+                    line = (json.dumps({
+                        "op": "put",
+                        "session_id": session_id,
+                        "messages": conversation["messages"],
+                        "last_updated": conversation["last_updated"],
+                        "updated_at": conversation["updated_at"]
+                    }, ensure_ascii=False) + "\n").encode('utf-8')
+                    positions[session_id] = (target, f.tell(), len(line))
+                    f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+                STORAGE_BYTES.inc(f.tell(), direction="write")
+            
+            with self.lock:
+                os.replace(tmp_path, self._segment_path(target))
+                for session_id, position in positions.items():
+                    entry = self.index.get(session_id)
+                    if entry is None:
+                        continue
+                    # 快照之后被覆盖或删除重建的会话不再引用旧段，无需替换
+                    sealed_count = sum(1 for e in entry["entries"] if e[0] <= target)
+                    if sealed_count:
+                        entry["entries"] = [position] + entry["entries"][sealed_count:]
+                removed = [s for s in self.segments if s < target]
+                self.segments = [s for s in self.segments if s >= target]
+            
+            for segment_id in removed:
+                os.remove(self._segment_path(segment_id))
+            return len(sealed)
+    
+    def _compact_loop(self):
+        """后台压缩线程"""
+        while not self._stop_event.wait(self.compact_interval):
+            with self.lock:
+                sealed_count = len(self.segments) - 1
+            if sealed_count >= self.compact_min_segments:
+                try:
+                    self.compact()
+                except Exception as e:
+                    logger.error("日志压缩失败: %s", e)
+    
+    def close(self):
+        """停止后台压缩并关闭日志文件"""
+        self._stop_event.set()
+        with self.lock:
+            if self.active_file:
+                self.active_file.close()
+                self.active_file = None
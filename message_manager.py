@@ -1,96 +1,337 @@
+import contextlib
+import threading
 import time
-from config import CONTEXT_CONFIG
-from data_storage import DataStorage
+from array import array
+from config import CONTEXT_CONFIG, HISTORY_CONFIG, PERSIST_CONFIG, STORAGE_CONFIG, SEARCH_CONFIG
+from data_storage import create_storage, newest_messages, next_message_cursor
+from metrics import STORAGE_LATENCY
+from session_cache import SessionCache
+from tracing import span, traced
+from token_estimator import estimate_message_tokens
+from write_behind import WriteBehindQueue
+
+# 估算内存占用时每条消息的固定开销（字符串对象头、列表指针、角色、时间戳和token数）
+MESSAGE_BYTES = 80
+# 每个会话的固定开销（会话对象、锁和各数组对象）
+SESSION_BYTES = 600
+
+# 角色以小整数保存，遇到新角色时追加编号
+ROLES = ["user", "assistant", "system"]
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+ASSISTANT = ROLE_CODES["assistant"]
+_roles_lock = threading.Lock()
+
+
+def role_code(role):
+    """角色对应的编号"""
+    code = ROLE_CODES.get(role)
+    if code is None:
+        with _roles_lock:
+            code = ROLE_CODES.get(role)
+            if code is None:
+                code = ROLE_CODES[role] = len(ROLES)
+                ROLES.append(role)
+    return code
+
+
+def estimate_message_bytes(content):
+    """估算一条消息在会话缓存中占用的字节数"""
+    return len(content.encode('utf-8')) + MESSAGE_BYTES
+
+
+class Session:
+    """内存中的会话：按列保存消息，不为每条消息创建字典
+    
+    角色、时间戳和token估算分别存放在 bytearray / array 中，只有消息内容是独立的字符串对象；
+    模型请求和持久化所需的字典格式在 context() / messages() 中按需生成。
+    """
+    __slots__ = ("roles", "contents", "timestamps", "tokens", "token_total", "bytes", "last_active", "lock")
+    
+    def __init__(self):
+        self.roles = bytearray()
+        self.contents = []
+        self.timestamps = array('d')
+        self.tokens = array('I')
+        self.token_total = 0
+        self.bytes = SESSION_BYTES
+        self.last_active = time.time()
+        # 串行化同一会话的修改和保存，持有期间会话不会被淘汰
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.contents)
+    
+    def append(self, role, content, timestamp, tokens):
+        self.roles.append(role_code(role))
+        self.contents.append(content)
+        self.timestamps.append(timestamp)
+        self.tokens.append(tokens)
+        self.token_total += tokens
+        self.bytes += estimate_message_bytes(content)
+    
+    def drop(self, count):
+        """删除最早的 count 条消息"""
+        self.token_total -= sum(self.tokens[:count])
+        self.bytes -= sum(estimate_message_bytes(content) for content in self.contents[:count])
+        del self.roles[:count]
+        del self.contents[:count]
+        del self.timestamps[:count]
+        del self.tokens[:count]
+    
+    def context(self, start=0):
+        """模型请求所需的上下文，从第 start 条消息开始"""
+        return [{"role": ROLES[role], "content": content}
+                for role, content in zip(self.roles[start:], self.contents[start:])]
+    
+    def messages(self):
+        """持久化格式的消息列表"""
+        return [{"role": ROLES[role], "content": content, "timestamp": timestamp}
+                for role, content, timestamp in zip(self.roles, self.contents, self.timestamps)]
 
 class MessageManager:
     def __init__(self):
-        self.context_store = {}
         self.max_history = CONTEXT_CONFIG["max_history"]
         self.expire_time = CONTEXT_CONFIG["expire_time"]
-        self.data_storage = DataStorage()
+        self.context_store = SessionCache(
+            max_sessions=CONTEXT_CONFIG["max_sessions"],
+            max_bytes=CONTEXT_CONFIG["max_bytes"],
+            expire_time=self.expire_time
+        )
+        self.token_budget = CONTEXT_CONFIG["max_context_tokens"]
+        self.data_storage = create_storage()
+        # 多进程部署：各worker的内存会话可能已过时，每次读写都以持久化存储为准，并在跨进程锁内完成
+        self.multi_process = STORAGE_CONFIG["multi_process"]
+        self.write_queue = None
+        if PERSIST_CONFIG["write_behind"]:
+            if self.multi_process:
+                raise ValueError("多进程部署不支持写回模式：尚未落盘的数据对其他worker不可见")
+            self.write_queue = WriteBehindQueue(
+                self.data_storage,
+                flush_interval=PERSIST_CONFIG["flush_interval"],
+                batch_size=PERSIST_CONFIG["batch_size"],
+                max_pending=PERSIST_CONFIG["max_pending"],
+                close_retries=PERSIST_CONFIG["close_retries"]
+            )
+        # 全文索引随存储写入增量更新
+        self.search_index = None
+        if SEARCH_CONFIG["enabled"]:
+            from search_index import SearchIndex
+            self.search_index = SearchIndex(self.data_storage.storage_dir)
+            self.search_index.attach(self.data_storage)
+    
+    def new_session(self, messages=()):
+        """构建会话，同时记录每条消息的token估算和内存占用估算"""
+        session = Session()
+        for message in messages:
+            self._append_to_session(session, message)
+        self._trim_session(session)
+        return session
+    
+    def _append_to_session(self, session, message):
+        """追加消息，token数只在此处计算一次"""
+        content = message["content"]
+        session.append(message["role"], content, message.get("timestamp") or 0.0, estimate_message_tokens(content))
+    
+    def _trim_session(self, session):
+        """按消息条数从最早的消息开始截断，返回截断的消息数
+        
+        会话中保留的消息也是持久化的内容，token预算不在这里截断，只在 get_context 中限制发送给模型的上下文。
+        """
+        drop = max(0, len(session) - self.max_history)
+        if drop:
+            session.drop(drop)
+        return drop
+    
+    def _context_start(self, session):
+        """按token预算确定发送给模型的第一条消息的下标"""
+        count = len(session)
+        start = 0
+        if self.token_budget:
+            tokens = session.tokens
+            total = session.token_total
+            # 至少保留最新的一条消息
+            while start < count - 1 and total > self.token_budget:
+                total -= tokens[start]
+                start += 1
+            # 按轮次截断，上下文不以助手回复开头
+            while start < count - 1 and session.roles[start] == ASSISTANT:
+                start += 1
+        return start
     
     def create_session(self, session_id):
         """创建新会话"""
-        if session_id not in self.context_store:
-            self.context_store[session_id] = {
-                "messages": [],
-                "last_active": time.time()
-            }
+        self.context_store.setdefault(session_id, self.new_session())
     
+    def _load_session(self, session_id):
+        """获取内存中的会话，不在内存中（新会话或已被淘汰）时从持久化存储加载
+        
+        多进程部署时其他worker可能已修改该会话，总是从存储重新加载。
+        """
+        if self.multi_process:
+            session = self.new_session(self.load_messages(session_id))
+            self.context_store[session_id] = session
+            return session
+        session = self.context_store.get(session_id)
+        if session is None:
+            session = self.context_store.setdefault(session_id, self.new_session(self.load_messages(session_id)))
+        return session
+    
+    def _storage_lock(self):
+        """多进程部署时，加载-追加-保存需要在存储的跨进程锁内完成，否则并发的写入会互相覆盖"""
+        if self.multi_process:
+            return self.data_storage.file_lock
+        return contextlib.nullcontext()
+    
+    @traced("message_manager.add_message")
     def add_message(self, session_id, role, content):
         """添加消息到会话上下文"""
-        if session_id not in self.context_store:
-            self.create_session(session_id)
-        
         message = {
             "role": role,
             "content": content,
             "timestamp": time.time()
         }
         
-        self.context_store[session_id]["messages"].append(message)
-        self.context_store[session_id]["last_active"] = time.time()
-        
-        # 限制历史消息数量
-        if len(self.context_store[session_id]["messages"]) > self.max_history:
-            self.context_store[session_id]["messages"] = self.context_store[session_id]["messages"][-self.max_history:]
-        
-        # 保存到持久化存储
-        self.data_storage.save_conversation(session_id, self.context_store[session_id]["messages"])
+        with self._storage_lock():
+            session = self._load_session(session_id)
+            with session.lock:
+                self._append_to_session(session, message)
+                
+                # 限制历史消息数量
+                self._trim_session(session)
+                self.context_store.touch(session_id, time.time())
+                
+                # 保存到持久化存储
+                if self.write_queue:
+                    self.write_queue.put(session_id, session.messages())
+                else:
+                    with STORAGE_LATENCY.time(operation="save"), span("storage.save"):
+                        self.data_storage.save_conversation(session_id, session.messages())
     
+    @traced("message_manager.get_context")
     def get_context(self, session_id):
         """获取会话上下文"""
-        if session_id not in self.context_store:
-            # 从持久化存储加载对话历史
-            saved_conversation = self.data_storage.load_conversation(session_id)
-            self.context_store[session_id] = {
-                "messages": saved_conversation["messages"],
-                "last_active": time.time()
-            }
+        session = self._load_session(session_id)
         
         # 检查会话是否过期
-        if time.time() - self.context_store[session_id]["last_active"] > self.expire_time:
-            self.context_store[session_id] = {
-                "messages": [],
-                "last_active": time.time()
-            }
+        if time.time() - session.last_active > self.expire_time:
+            session = self.context_store[session_id] = self.new_session()
+        
+        # 模型所需的字典格式只在这里按需生成，超出token预算的早期轮次不发送给模型
+        with session.lock:
+            return session.context(self._context_start(session))
+    
+    def load_messages(self, session_id):
+        """从持久化存储加载最新的 max_history 条消息，写回模式下优先读取尚未落盘的数据"""
+        if self.write_queue:
+            found, messages = self.write_queue.lookup(session_id)
+            if found:
+                return messages or []
+        with STORAGE_LATENCY.time(operation="load"), span("storage.load"):
+            messages = list(self.data_storage.iter_messages(session_id, limit=self.max_history))
+        messages.reverse()
+        return messages
+    
+    def history(self, session_id, cursor=None, limit=None):
+        """分页读取会话历史，返回 (排在游标之前的最多 limit 条消息（按时间顺序）, 下一页游标)
+        
+        每次只从存储读取一页。游标格式为 "timestamp:n"：本页最早一条消息的时间戳，以及至此已返回的
+        该时间戳消息数，时间戳相同的消息跨页时不会重复或遗漏；只有时间戳时只取更早的消息。
+        没有更早的消息时下一页游标为None，游标格式错误时抛出 ValueError。
+        """
+        limit = max(1, min(limit or HISTORY_CONFIG["page_size"], HISTORY_CONFIG["max_page_size"]))
+        before = None
+        if cursor:
+            timestamp, separator, count = cursor.partition(":")
+            before = (float(timestamp), int(count) if separator else None)
+        # 多取一条用于判断是否还有下一页
+        messages = None
+        if self.write_queue:
+            found, pending = self.write_queue.lookup(session_id)
+            if found:
+                messages = newest_messages(pending or [], before, limit + 1)
+        if messages is None:
+            with STORAGE_LATENCY.time(operation="history"), span("storage.history"):
+                messages = list(self.data_storage.iter_messages(session_id, before, limit + 1))
         
-        # 将消息格式化为模型所需的格式
-        context_messages = []
-        for msg in self.context_store[session_id]["messages"]:
-            context_messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
+        next_before = None
+        if len(messages) > limit:
+            messages = messages[:limit]
+            timestamp, count = next_message_cursor(messages, before)
+            next_before = f"{timestamp!r}:{count}"
+        messages.reverse()
+        return messages, next_before
+    
+    def list_sessions(self, cursor=None, limit=None):
+        """按最后更新时间倒序分页列出存储中的会话，返回 (会话列表, 下一页游标)
+        
+        游标格式为 "last_updated:session_id"，格式错误时抛出 ValueError。
+        """
+        limit = max(1, min(limit or HISTORY_CONFIG["page_size"], HISTORY_CONFIG["max_page_size"]))
+        before = None
+        if cursor:
+            last_updated, separator, session_id = cursor.partition(":")
+            if not separator:
+                raise ValueError(f"无效的分页游标: {cursor}")
+            before = (float(last_updated), session_id)
+        # 写回模式下先写入尚未落盘的数据
+        self.flush_or_raise()
+        with STORAGE_LATENCY.time(operation="list"), span("storage.list"):
+            sessions = self.data_storage.list_sessions(before, limit + 1)
         
-        return context_messages
+        next_cursor = None
+        if len(sessions) > limit:
+            sessions = sessions[:limit]
+            next_cursor = f"{sessions[-1]['last_updated']!r}:{sessions[-1]['session_id']}"
+        return sessions, next_cursor
+    
+    def iter_export(self, format="json", session_ids=None, since=None, until=None, compress=False):
+        """流式导出对话历史，写回模式下先写入尚未落盘的数据"""
+        self.flush_or_raise()
+        return self.data_storage.iter_export(format, session_ids, since, until, compress)
+    
+    def search(self, query, session_id=None, since=None, until=None, offset=0, limit=None):
+        """全文搜索存储中的消息，未启用全文索引时返回None"""
+        if self.search_index is None:
+            return None
+        return self.search_index.search(query, session_id, since, until, offset, limit)
     
     def update_last_active(self, session_id):
         """更新会话最后活跃时间"""
-        if session_id in self.context_store:
-            self.context_store[session_id]["last_active"] = time.time()
+        self.context_store.touch(session_id, time.time())
     
     def delete_session(self, session_id):
         """删除会话"""
-        if session_id in self.context_store:
-            del self.context_store[session_id]
+        self.context_store.pop(session_id)
         # 从持久化存储中删除对话历史
-        self.data_storage.delete_conversation(session_id)
+        if self.write_queue:
+            self.write_queue.delete(session_id)
+        else:
+            with STORAGE_LATENCY.time(operation="delete"), span("storage.delete"):
+                self.data_storage.delete_conversation(session_id)
     
     def clean_expired_sessions(self):
-        """清理过期会话"""
-        current_time = time.time()
-        expired_sessions = []
-        
-        for session_id, session_data in self.context_store.items():
-            if current_time - session_data["last_active"] > self.expire_time:
-                expired_sessions.append(session_id)
-        
-        for session_id in expired_sessions:
-            del self.context_store[session_id]
-        
-        return len(expired_sessions)
+        """清理过期会话，只处理已到期的会话，不扫描全部会话"""
+        return self.context_store.expire()
     
     def get_session_count(self):
         """获取当前会话数量"""
         return len(self.context_store)
+    
+    def flush(self, timeout=None):
+        """将写回队列中的数据立即写入存储"""
+        if self.write_queue:
+            return self.write_queue.flush(timeout)
+        return True
+    
+    def flush_or_raise(self):
+        """在 flush_timeout 内写入未落盘数据，存储持续失败导致超时时抛出 TimeoutError，避免请求线程无限等待"""
+        if not self.flush(PERSIST_CONFIG["flush_timeout"]):
+            raise TimeoutError("写入未落盘数据超时，存储暂不可用")
+    
+    def close(self):
+        """写入剩余数据并释放存储资源"""
+        if self.write_queue:
+            self.write_queue.close(PERSIST_CONFIG["close_timeout"])
+        if self.search_index:
+            self.search_index.close()
+        self.data_storage.close()
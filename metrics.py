@@ -0,0 +1,240 @@
+import bisect
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+# 进程内指标，按Prometheus文本格式导出（/api/metrics），无需外部服务
+#
+# 计数器、直方图和可增减的仪表按线程分片：每个线程只写自己的分片，热路径上没有锁，
+# 导出时再汇总所有分片。线程退出时其分片并入公共部分，按请求创建线程的服务器也不会累积分片。
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STORAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+
+class _ShardOwner:
+    """存放在线程局部变量中，线程退出时被回收并触发分片合并"""
+    __slots__ = ("__weakref__",)
+
+
+class Metric:
+    """按线程分片的指标基类"""
+    type = "untyped"
+    
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # 活跃线程的分片：id -> {标签值元组: 值}
+        self._shards = {}
+        # 已退出线程合并后的值
+        self._retired = {}
+        (registry or REGISTRY).register(self)
+    
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+    
+    def _shard(self):
+        """当前线程的分片，首次使用时创建"""
+        shard = getattr(self._local, "values", None)
+        if shard is None:
+            shard = self._local.values = {}
+            owner = self._local.owner = _ShardOwner()
+            with self._lock:
+                self._shards[id(shard)] = shard
+            weakref.finalize(owner, self._retire, shard)
+        return shard
+    
+    def _retire(self, shard):
+        with self._lock:
+            self._shards.pop(id(shard), None)
+            for key, value in shard.items():
+                self._retired[key] = self._merge(self._retired.get(key), value)
+    
+    def _merge(self, total, value):
+        return value if total is None else total + value
+    
+    def _copy(self, value):
+        return value
+    
+    def collect(self):
+        """汇总所有分片，返回 {标签值元组: 值}"""
+        with self._lock:
+            totals = {key: self._copy(value) for key, value in self._retired.items()}
+            shards = list(self._shards.values())
+        for shard in shards:
+            # dict.copy 在GIL下是原子的，不会与写入线程冲突
+            for key, value in shard.copy().items():
+                totals[key] = self._merge(totals.get(key), self._copy(value))
+        return totals
+    
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+    
+    def expose(self):
+        """生成该指标的Prometheus文本"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{self.format_labels(key)} {float(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """单调递增计数器"""
+    type = "counter"
+    
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """仪表：inc/dec 按线程分片累加，set_function 在导出时取值"""
+    type = "gauge"
+    
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self._functions = {}
+    
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+    
+    def set_function(self, function, **labels):
+        """导出时调用 function 获取当前值，适合连接数、会话数等已有数据"""
+        self._functions[self._key(labels)] = function
+    
+    @contextmanager
+    def track_inprogress(self, **labels):
+        """进入时加一，退出时减一"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+    
+    def collect(self):
+        totals = super().collect()
+        for key, function in list(self._functions.items()):
+            try:
+                totals[key] = function()
+            except Exception:
+                pass
+        return totals
+
+
+class Histogram(Metric):
+    """直方图：每个分片保存各桶计数、总和与样本数"""
+    type = "histogram"
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+    
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        # [各桶计数..., +Inf桶计数, 总和, 样本数]
+        state = shard.get(key)
+        if state is None:
+            state = shard[key] = [0] * (len(self.buckets) + 3)
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        """统计代码块耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+    
+    def _merge(self, total, value):
+        if total is None:
+            return value
+        for i, count in enumerate(value):
+            total[i] += count
+        return total
+    
+    def _copy(self, value):
+        return list(value)
+    
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, state in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{self.name}_bucket{self.format_labels(key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self.format_labels(key)} {float(state[-2])}")
+            lines.append(f"{self.name}_count{self.format_labels(key)} {state[-1]}")
+        return lines
+
+
+class Registry:
+    """指标注册表"""
+    
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+    
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"指标 {metric.name} 已注册")
+            self.metrics[metric.name] = metric
+    
+    def generate_latest(self):
+        """生成所有指标的Prometheus文本格式"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 应用指标
+CHAT_LATENCY = Histogram("chatbot_chat_duration_seconds", "聊天请求端到端耗时", ["endpoint"])
+UPSTREAM_FIRST_TOKEN = Histogram("chatbot_upstream_first_token_seconds", "发送请求到收到上游首个增量的耗时")
+UPSTREAM_GENERATION = Histogram("chatbot_upstream_generation_seconds", "上游完整生成耗时")
+STORAGE_LATENCY = Histogram("chatbot_storage_duration_seconds", "存储操作耗时", ["operation"],
+                            buckets=STORAGE_BUCKETS)
+STORAGE_BYTES = Counter("chatbot_storage_bytes_total", "存储读写字节数", ["direction"])
+IN_FLIGHT = Gauge("chatbot_requests_in_flight", "进行中的聊天请求数", ["endpoint"])
+UPSTREAM_CONNECTIONS = Gauge("chatbot_upstream_connections", "上游WebSocket连接数", ["state"])
+CONTEXT_SESSIONS = Gauge("chatbot_context_sessions", "内存中的会话数（context_store大小）")
+CONTEXT_BYTES = Gauge("chatbot_context_bytes", "内存中会话消息的估算字节数")
+UPSTREAM_ERRORS = Counter("chatbot_upstream_errors_total", "上游返回的错误码次数", ["code"])
+UPSTREAM_TIMEOUTS = Counter("chatbot_upstream_timeouts_total", "等待上游响应超时次数")
+UPSTREAM_RECONNECTS = Counter("chatbot_upstream_reconnects_total", "连接失效后换新连接重试的次数")
+ADMISSION_WAIT = Histogram("chatbot_admission_wait_seconds", "上游调用在准入队列中的等待时间")
+ADMISSION_REJECTED = Counter("chatbot_admission_rejected_total", "准入控制拒绝的请求数", ["reason"])
+ADMISSION_REQUESTS = Gauge("chatbot_admission_requests", "准入控制中的上游调用数", ["state"])
+UPSTREAM_HEDGES = Counter("chatbot_upstream_hedges_total", "对冲请求次数（sent 发出 / won 先于原请求返回）", ["outcome"])
+LOG_DROPPED = Counter("chatbot_log_records_dropped_total", "被丢弃的日志条数（队列已满或限流）", ["reason"])
+
+
+def generate_latest():
+    """生成默认注册表的Prometheus文本"""
+    return REGISTRY.generate_latest()
@@ -0,0 +1,35 @@
+import argparse
+import json
+import os
+from data_storage import create_storage
+from config import STORAGE_CONFIG
+
+
+def main():
+    """将 data/conversations.json 中的对话历史导入到指定的存储后端"""
+    parser = argparse.ArgumentParser(description="迁移对话历史到新的存储后端")
+    parser.add_argument("--backend", default="sqlite", choices=["log", "sqlite"], help="目标存储后端")
+    parser.add_argument("--storage-dir", default=STORAGE_CONFIG["storage_dir"], help="目标存储目录")
+    parser.add_argument("--source", default=None, help="源JSON文件，默认为存储目录下的conversations.json")
+    args = parser.parse_args()
+
+    source = args.source or os.path.join(args.storage_dir, "conversations.json")
+    try:
+        with open(source, 'r', encoding='utf-8') as f:
+            conversations = json.load(f)
+    except (json.JSONDecodeError, FileNotFoundError) as e:
+        print(f"读取源文件失败: {e}")
+        return 1
+
+    storage = create_storage(args.backend, args.storage_dir)
+    try:
+        count = storage.import_conversations(conversations)
+    finally:
+        storage.close()
+
+    print(f"已将 {count} 个会话从 {source} 迁移到 {args.backend} 存储")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
+from urllib.parse import urlparse, parse_qs
+from websockets.asyncio.server import serve
+from config import XFYUN_CONFIG
+
+# 本地模拟的讯飞星辰 /v1.1/chat 服务，用于离线测试和压测
+# 启动方式：python mock_spark_server.py --port 9001，然后将 XFYUN_CONFIG 的 scheme 改为 "ws"、host 改为 "127.0.0.1:9001"
+
+
+class MockSparkServer:
+    """模拟讯飞星辰WebSocket对话协议
+    
+    握手时按 generate_auth_url 的规则校验签名，之后按配置的速率逐帧返回 payload.choices.text，
+    可注入抖动、错误码、search_info 和连接中断。默认逐字回显最后一条用户消息，
+    设置 reply_length 后返回固定长度的回复。一个字符按一个token计。
+    """
+    
+    def __init__(self, host="127.0.0.1", port=0, api_key=None, api_secret=None, path=None,
+                 token_rate=0, chunk_size=1, jitter=0.0, reply_length=None, search_info=False,
+                 error_rate=0.0, error_code=10013, drop_rate=0.0, keep_alive=True, clock_skew=300, seed=None):
+        self.host = host
+        self.port = port
+        self.api_key = api_key or XFYUN_CONFIG["api_key"]
+        self.api_secret = api_secret or XFYUN_CONFIG["api_secret"]
+        self.path = path or XFYUN_CONFIG["path"]
+        # 每秒产出的token数，0 表示不限速
+        self.token_rate = token_rate
+        # 每帧包含的token数
+        self.chunk_size = chunk_size
+        # 每帧额外的随机延迟上限（秒）
+        self.jitter = jitter
+        self.reply_length = reply_length
+        self.search_info = search_info
+        # 按概率返回错误码或在回复中途断开连接
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.drop_rate = drop_rate
+        # 回复完成后是否保持连接，允许客户端复用
+        self.keep_alive = keep_alive
+        self.clock_skew = clock_skew
+        self.random = random.Random(seed)
+        
+        self.stats = {"connections": 0, "rejected": 0, "requests": 0, "errors": 0, "dropped": 0, "frames": 0}
+        self.loop = None
+        self.server = None
+        self._thread = None
+        self._started = threading.Event()
+        self._stopped = None
+    
+    def verify_auth(self, request_path):
+        """校验鉴权URL，返回错误原因，通过时返回None"""
+        parsed = urlparse(request_path)
+        if parsed.path != self.path:
+            return f"路径不存在: {parsed.path}"
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        if not {"authorization", "date", "host"} <= set(query):
+            return "缺少鉴权参数"
+        
+        try:
+            authorization = base64.b64decode(query["authorization"]).decode('utf-8')
+            fields = dict(item.strip().split("=", 1) for item in authorization.split(","))
+            fields = {key: value.strip('"') for key, value in fields.items()}
+            signed_at = parsedate_to_datetime(query["date"]).timestamp()
+        except Exception:
+            return "鉴权参数格式错误"
+        
+        if fields.get("api_key") != self.api_key or fields.get("algorithm") != "hmac-sha256":
+            return "api_key或签名算法不正确"
+        if abs(time.time() - signed_at) > self.clock_skew:
+            return "签名已过期"
+        
+        signature_origin = f"host: {query['host']}\ndate: {query['date']}\nGET {self.path} HTTP/1.1"
+        expected = base64.b64encode(hmac.new(self.api_secret.encode('utf-8'), signature_origin.encode('utf-8'),
+                                             digestmod=hashlib.sha256).digest()).decode('utf-8')
+        if not hmac.compare_digest(expected, fields.get("signature", "")):
+            return "签名不正确"
+        return None
+    
+    def process_request(self, connection, request):
+        """握手阶段校验签名，失败时与真实服务一样返回HTTP 401"""
+        reason = self.verify_auth(request.path)
+        if reason:
+            self.stats["rejected"] += 1
+            return connection.respond(HTTPStatus.UNAUTHORIZED, reason)
+        self.stats["connections"] += 1
+    
+    def make_frame(self, sid, content="", status=1, seq=0, code=0, message="Success", search_info=None):
+        """构造一帧响应"""
+        frame = {"header": {"code": code, "message": message, "sid": sid, "status": status}}
+        if code == 0:
+            frame["payload"] = {"choices": {"status": status, "seq": seq,
+                                            "text": [{"role": "assistant", "content": content, "index": 0}]}}
+            if search_info is not None:
+                frame["payload"]["search_info"] = search_info
+        return json.dumps(frame, ensure_ascii=False)
+    
+    def make_reply(self, request_data):
+        """生成回复文本"""
+        if self.reply_length is not None:
+            return ("模拟回复" * (self.reply_length // 4 + 1))[:self.reply_length]
+        return request_data["payload"]["message"]["text"][-1]["content"]
+    
+    async def handler(self, ws):
+        """处理一条连接上的所有请求"""
+        async for message in ws:
+            self.stats["requests"] += 1
+            sid = f"mock{self.stats['requests']:08d}"
+            request_data = json.loads(message)
+            
+            if self.random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                await ws.send(self.make_frame(sid, status=2, code=self.error_code, message="模拟错误"))
+                await ws.close()
+                return
+            
+            text = self.make_reply(request_data)
+            chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+            drop_at = self.random.randrange(len(chunks) + 1) if self.random.random() < self.drop_rate else None
+            
+            if self.search_info:
+                await ws.send(self.make_frame(sid, search_info={"urls": [f"https://example.com/{sid}"]}))
+            for seq, chunk in enumerate(chunks):
+                if seq == drop_at:
+                    return self.drop(ws)
+                await self.pace(len(chunk))
+                await ws.send(self.make_frame(sid, chunk, seq=seq))
+                self.stats["frames"] += 1
+            if drop_at == len(chunks):
+                return self.drop(ws)
+            await ws.send(self.make_frame(sid, status=2, seq=len(chunks)))
+            
+            if not self.keep_alive:
+                await ws.close()
+                return
+    
+    def drop(self, ws):
+        """不发送关闭帧直接断开，模拟网络中断"""
+        self.stats["dropped"] += 1
+        ws.transport.abort()
+    
+    async def pace(self, tokens):
+        """按token速率和抖动等待"""
+        delay = tokens / self.token_rate if self.token_rate else 0
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+    
+    async def serve_forever(self):
+        """在当前事件循环中运行服务，直到 stop 被调用"""
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        async with serve(self.handler, self.host, self.port, process_request=self.process_request,
+                         max_size=None, close_timeout=1) as server:
+            self.server = server
+            self.port = server.sockets[0].getsockname()[1]
+            self._started.set()
+            await self._stopped.wait()
+    
+    def start(self):
+        """在后台线程中启动服务，返回监听端口"""
+        self._thread = threading.Thread(target=asyncio.run, args=(self.serve_forever(),), daemon=True)
+        self._thread.start()
+        if not self._started.wait(5):
+            raise RuntimeError("模拟服务启动失败")
+        return self.port
+    
+    def stop(self):
+        """停止后台线程中的服务"""
+        if self.loop and self._stopped:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+        if self._thread:
+            self._thread.join(5)
+    
+    @property
+    def address(self):
+        """供 XFYUN_CONFIG["host"] 使用的地址"""
+        return f"{self.host}:{self.port}"
+    
+    def __enter__(self):
+        self.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="本地模拟讯飞星辰WebSocket服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--token-rate", type=float, default=50, help="每秒产出的token数，0表示不限速")
+    parser.add_argument("--chunk-size", type=int, default=1, help="每帧包含的token数")
+    parser.add_argument("--jitter", type=float, default=0.0, help="每帧额外随机延迟上限（秒）")
+    parser.add_argument("--reply-length", type=int, default=None, help="固定回复长度，默认回显用户消息")
+    parser.add_argument("--search-info", action="store_true", help="在回复前返回search_info")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误码的概率")
+    parser.add_argument("--error-code", type=int, default=10013)
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="回复中途断开连接的概率")
+    parser.add_argument("--close-after-reply", action="store_true", help="每次回复后关闭连接")
+    args = parser.parse_args()
+    
+    mock = MockSparkServer(args.host, args.port, token_rate=args.token_rate, chunk_size=args.chunk_size,
+                           jitter=args.jitter, reply_length=args.reply_length, search_info=args.search_info,
+                           error_rate=args.error_rate, error_code=args.error_code, drop_rate=args.drop_rate,
+                           keep_alive=not args.close_after_reply)
+    print(f"模拟讯飞星辰服务已启动: ws://{args.host}:{args.port}{mock.path}")
+    print("按 CTRL+C 停止服务")
+    try:
+        asyncio.run(mock.serve_forever())
+    except KeyboardInterrupt:
+        pass
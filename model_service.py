@@ -3,79 +3,98 @@ import hmac
 import hashlib
 import base64
 import json
+import logging
+import queue
 import websocket
 import threading
-from config import XFYUN_CONFIG, WS_CONFIG
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from config import XFYUN_CONFIG, WS_CONFIG, CACHE_CONFIG, BATCH_CONFIG
+from connection_pool import ConnectionPool, PoolError, backoff_delay
+from deadline import Deadline, DeadlineExceeded
+import hedging
+from response_cache import ResponseCache, SQLiteCacheTier
+from singleflight import SingleFlight
+from tracing import span, mark, traced
+from metrics import UPSTREAM_FIRST_TOKEN, UPSTREAM_GENERATION, UPSTREAM_ERRORS, UPSTREAM_TIMEOUTS, UPSTREAM_RECONNECTS, UPSTREAM_HEDGES
+from structured_logging import FRAME_LOGGER, get_logger
 
-class SparkModelService:
-    def __init__(self):
-        self.app_id = XFYUN_CONFIG["app_id"]
-        self.api_key = XFYUN_CONFIG["api_key"]
-        self.api_secret = XFYUN_CONFIG["api_secret"]
-        self.host = XFYUN_CONFIG["host"]
-        self.path = XFYUN_CONFIG["path"]
-        self.model_id = XFYUN_CONFIG["model_id"]
+logger = get_logger(__name__)
+# 逐帧日志（DEBUG级别）单独限流
+frame_logger = logging.getLogger(FRAME_LOGGER)
+
+# 连接关闭时放入帧队列的哨兵，唤醒等待中的消费者
+CONNECTION_CLOSED = object()
+
+class SparkConnection:
+    """单条上游WebSocket连接，拥有独立的响应帧队列
+    
+    on_message 把帧直接推入阻塞队列，消费者在帧到达时立即被唤醒；
+    连接建立、出错或关闭时设置 ready 事件，connect 无需轮询等待。
+    """
+    def __init__(self, url):
+        self.url = url
         self.ws = None
-        self.response_buffer = []
+        self.frames = queue.Queue()
+        self.ready = threading.Event()
         self.is_connected = False
-        self.lock = threading.Lock()
-        
-    def generate_auth_url(self):
-        """生成WebSocket鉴权URL"""
-        # 生成RFC1123格式的时间戳
-        date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
-        
-        # 拼接签名字符串，确保host头正确使用
-        signature_origin = f"host: {self.host}\ndate: {date}\nGET {self.path} HTTP/1.1"
-        
-        # 使用hmac-sha256算法生成签名
-        signature_sha = hmac.new(self.api_secret.encode('utf-8'), signature_origin.encode('utf-8'), 
-                               digestmod=hashlib.sha256).digest()
-        
-        # 对签名进行base64编码
-        signature = base64.b64encode(signature_sha).decode('utf-8')
-        
-        # 生成最终的authorization，注意引号格式
-        authorization_origin = f"api_key=\"{self.api_key}\", algorithm=\"hmac-sha256\", headers=\"host date request-line\", signature=\"{signature}\""
-        authorization = base64.b64encode(authorization_origin.encode('utf-8')).decode('utf-8')
-        
-        # 生成鉴权URL，确保参数正确编码
-        import urllib.parse
-        url = f"wss://{self.host}{self.path}?authorization={urllib.parse.quote(authorization)}&date={urllib.parse.quote(date)}&host={urllib.parse.quote(self.host)}"
-        return url
+        self.closed = False
+        self.created_at = time.time()
+        self.last_used = time.time()
+        # 连接意外断开时的回调，由连接池设置
+        self.on_lost = None
+        # 对冲请求等待首帧期间设置：有帧到达时把连接本身放入该队列，以便同时等待多条连接
+        self.listener = None
     
     def on_message(self, ws, message):
         """WebSocket消息接收回调"""
         try:
             data = json.loads(message)
-            print(f"收到模型响应: {json.dumps(data, ensure_ascii=False)}")
-            with self.lock:
-                self.response_buffer.append(data)
+            # 在WebSocket读线程上：原始帧本就是JSON文本，直接作为参数交给后台线程格式化，
+            # 不再重新序列化；DEBUG级别未开启时没有任何开销
+            frame_logger.debug("收到模型响应: %s", message)
+            self.deliver(data)
         except json.JSONDecodeError as e:
-            print(f"解析WebSocket消息失败: {e}")
+            logger.warning("解析WebSocket消息失败: %s", e)
     
     def on_error(self, ws, error):
         """WebSocket错误回调"""
-        print(f"WebSocket连接错误: {error}")
+        logger.warning("WebSocket连接错误: %s", error)
+        self.notify_lost()
         self.is_connected = False
+        self.ready.set()
+        self.deliver(CONNECTION_CLOSED)
     
     def on_close(self, ws, close_status_code, close_msg):
         """WebSocket关闭回调"""
-        print(f"WebSocket连接关闭: {close_status_code} - {close_msg}")
+        logger.info("WebSocket连接关闭: %s - %s", close_status_code, close_msg)
+        self.notify_lost()
         self.is_connected = False
+        self.closed = True
+        self.ready.set()
+        self.deliver(CONNECTION_CLOSED)
     
     def on_open(self, ws):
         """WebSocket连接建立回调"""
-        print("WebSocket连接已建立")
+        logger.info("WebSocket连接已建立")
         self.is_connected = True
+        self.ready.set()
+    
+    def deliver(self, item):
+        """放入一帧（或连接关闭的哨兵），唤醒等待的消费者"""
+        self.frames.put(item)
+        listener = self.listener
+        if listener is not None:
+            listener.put(self)
+    
+    def notify_lost(self):
+        """连接非主动关闭时通知连接池，后台立即补充连接，无需等到下一个请求才发现"""
+        if self.on_lost and self.is_connected and not self.closed:
+            self.on_lost(self)
     
-    def connect(self):
+    def connect(self, timeout):
         """建立WebSocket连接"""
-        if self.is_connected:
-            return True
-        
-        url = self.generate_auth_url()
-        self.ws = websocket.WebSocketApp(url, 
+        self.ws = websocket.WebSocketApp(self.url,
                                        on_open=self.on_open,
                                        on_message=self.on_message,
                                        on_error=self.on_error,
@@ -86,22 +105,95 @@ class SparkModelService:
         ws_thread.daemon = True
         ws_thread.start()
         
-        # 等待连接建立
-        for _ in range(WS_CONFIG["timeout"]):
-            if self.is_connected:
-                return True
-            time.sleep(1)
-        
-        return False
+        # 等待连接建立、出错或关闭
+        self.ready.wait(timeout)
+        return self.is_healthy()
     
-    def send_request(self, messages, temperature=0.5, top_k=4, max_tokens=2048, chat_id=None):
-        """发送请求到模型"""
-        # 确保WebSocket连接已建立
-        if not self.connect():
-            raise ConnectionError("无法建立WebSocket连接")
+    def is_healthy(self):
+        """连接是否可用"""
+        return self.is_connected and not self.closed
+    
+    def send(self, request_data):
+        """发送请求，发送前清空上一次请求残留的响应"""
+        while True:
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                break
+        self.last_used = time.time()
+        self.ws.send(json.dumps(request_data))
+    
+    def close(self):
+        """关闭WebSocket连接"""
+        self.closed = True
+        self.is_connected = False
+        if self.ws:
+            self.ws.close()
+    
+    def abort(self):
+        """取消进行中的请求：关闭连接，上游随之停止生成，并立即唤醒等待响应的消费者"""
+        self.close()
+        self.deliver(CONNECTION_CLOSED)
+
+class SparkClientBase:
+    """同步与异步模型客户端共用的鉴权、请求构建和响应解析逻辑"""
+    def __init__(self):
+        self.app_id = XFYUN_CONFIG["app_id"]
+        self.api_key = XFYUN_CONFIG["api_key"]
+        self.api_secret = XFYUN_CONFIG["api_secret"]
+        self.host = XFYUN_CONFIG["host"]
+        self.path = XFYUN_CONFIG["path"]
+        self.model_id = XFYUN_CONFIG["model_id"]
+        self.scheme = XFYUN_CONFIG["scheme"]
+        self.retry_times = WS_CONFIG["retry_times"]
+        self.backoff_base = WS_CONFIG["backoff_base"]
+        self.backoff_max = WS_CONFIG["backoff_max"]
+        self.auth_url_ttl = WS_CONFIG["auth_url_ttl"]
+        # (鉴权参数, URL, 生成时间)
+        self._auth_cache = (None, None, 0)
+        self._auth_lock = threading.Lock()
+    
+    def auth_url(self):
+        """带缓存的鉴权URL：有效期内复用签名，鉴权参数变化时重新生成"""
+        params = (self.scheme, self.host, self.path, self.api_key, self.api_secret)
+        with self._auth_lock:
+            cached_params, url, created_at = self._auth_cache
+            if cached_params != params or time.time() - created_at >= self.auth_url_ttl:
+                url = self.generate_auth_url()
+                self._auth_cache = (params, url, time.time())
+            return url
+    
+    def retry_delay(self, attempt):
+        """第 attempt 次重试前的退避时间"""
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max)
+    
+    def generate_auth_url(self):
+        """生成WebSocket鉴权URL"""
+        # 生成RFC1123格式的时间戳
+        date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+        
+        # 拼接签名字符串，确保host头正确使用
+        signature_origin = f"host: {self.host}\ndate: {date}\nGET {self.path} HTTP/1.1"
+        
+        # 使用hmac-sha256算法生成签名
+        signature_sha = hmac.new(self.api_secret.encode('utf-8'), signature_origin.encode('utf-8'),
+                               digestmod=hashlib.sha256).digest()
         
-        # 构建请求参数
-        request_data = {
+        # 对签名进行base64编码
+        signature = base64.b64encode(signature_sha).decode('utf-8')
+        
+        # 生成最终的authorization，注意引号格式
+        authorization_origin = f"api_key=\"{self.api_key}\", algorithm=\"hmac-sha256\", headers=\"host date request-line\", signature=\"{signature}\""
+        authorization = base64.b64encode(authorization_origin.encode('utf-8')).decode('utf-8')
+        
+        # 生成鉴权URL，确保参数正确编码
+        import urllib.parse
+        url = f"{self.scheme}://{self.host}{self.path}?authorization={urllib.parse.quote(authorization)}&date={urllib.parse.quote(date)}&host={urllib.parse.quote(self.host)}"
+        return url
+    
+    def build_request(self, messages, temperature=0.5, top_k=4, max_tokens=2048, chat_id=None):
+        """构建请求参数"""
+        return {
             "header": {
                 "app_id": self.app_id,
                 "uid": chat_id or f"user_{int(time.time())}"
@@ -124,71 +216,465 @@ class SparkModelService:
                 }
             }
         }
+    
+    def parse_frame(self, data):
+        """解析一帧上游响应，返回 (事件列表, 是否完成)，上游返回错误码时抛出异常"""
+        events = []
         
-        # 发送请求
-        self.ws.send(json.dumps(request_data))
+        # 处理响应
+        if "header" in data:
+            code = data["header"].get("code", 0)
+            if code != 0:
+                UPSTREAM_ERRORS.inc(code=code)
+                error_msg = data["header"].get("message", "未知错误")
+                raise Exception(f"模型调用错误: {code} - {error_msg}")
         
-        # 清空之前的响应缓冲区
-        with self.lock:
-            self.response_buffer.clear()
+        # 检查响应格式并处理
+        if "payload" in data:
+            payload = data["payload"]
+            
+            # 处理choices字段
+            if "choices" in payload:
+                choices = payload["choices"]
+                if isinstance(choices, dict) and "text" in choices:
+                    text_field = choices["text"]
+                    if isinstance(text_field, list):
+                        content = "".join(
+                            text_item["content"] for text_item in text_field
+                            if isinstance(text_item, dict) and "content" in text_item
+                        )
+                        if content:
+                            events.append({"type": "delta", "content": content})
+        
+        # 处理search_info字段
+        if "payload" in data and "search_info" in data["payload"]:
+            search_info = data["payload"]["search_info"]
+            if isinstance(search_info, dict):
+                events.append({"type": "search_info", "search_info": search_info})
+        
+        # 检查是否完成
+        finished = "header" in data and data["header"].get("status", 0) == 2
+        return events, finished
     
-    def get_response(self, timeout=60):
-        """获取模型响应"""
-        start_time = time.time()
-        full_response = {"text": "", "ref_info": [], "is_finished": False}
+    def batch_request(self, item):
+        """校验批量请求中的一项，返回 chat 的参数；格式不正确时抛出 ValueError
+        
+        每一项为 {"messages": [...]} 或 {"message": "..."}，可选 id、temperature、top_k、max_tokens。
+        """
+        if not isinstance(item, dict):
+            raise ValueError("每一项应为JSON对象")
+        messages = item.get("messages")
+        if messages is None and isinstance(item.get("message"), str) and item["message"]:
+            messages = [{"role": "user", "content": item["message"]}]
+        if not isinstance(messages, list) or not messages or not all(
+                isinstance(m, dict) and m.get("role") and isinstance(m.get("content"), str) for m in messages):
+            raise ValueError("messages 应为非空的消息列表，或提供非空的 message")
+        request = {"messages": [{"role": m["role"], "content": m["content"]} for m in messages]}
+        for key in ("temperature", "top_k", "max_tokens"):
+            if key in item:
+                request[key] = item[key]
+        return request
+    
+    def batch_limits(self, parallelism=None, timeout=None):
+        """批量请求的并发数（不超过 max_parallelism）和每一项的响应超时"""
+        parallelism = min(int(parallelism or BATCH_CONFIG["parallelism"]), BATCH_CONFIG["max_parallelism"])
+        return max(1, parallelism), float(timeout or BATCH_CONFIG["item_timeout"])
+    
+    @staticmethod
+    def batch_result(index, item, response=None, error=None):
+        """批量请求中一项的结果，出错时 error_type 为 invalid / timeout / 准入拒绝原因 / upstream"""
+        result = {"index": index}
+        if isinstance(item, dict) and "id" in item:
+            result["id"] = item["id"]
+        if error is None:
+            result.update(response=response["text"], ref_info=response["ref_info"], success=True)
+            return result
+        if isinstance(error, ValueError):
+            error_type = "invalid"
+        elif isinstance(error, TimeoutError):
+            error_type = "timeout"
+        else:
+            error_type = getattr(error, "reason", "upstream")
+        result.update(error=str(error), error_type=error_type, success=False)
+        if getattr(error, "retry_after", None):
+            result["retry_after"] = error.retry_after
+        return result
+
+class SparkModelService(SparkClientBase):
+    connection_class = SparkConnection
+    
+    def __init__(self):
+        super().__init__()
+        # 每个进行中的请求独占一条连接，响应不会在并发请求之间串线
+        self.pool = ConnectionPool(
+            self.create_connection,
+            min_size=WS_CONFIG["pool_min_size"],
+            max_size=WS_CONFIG["pool_max_size"],
+            idle_timeout=WS_CONFIG["idle_timeout"],
+            health_check_interval=WS_CONFIG["health_check_interval"],
+            backoff_base=self.backoff_base,
+            backoff_max=self.backoff_max
+        )
+        self.cache = None
+        if CACHE_CONFIG["enabled"]:
+            disk_tier = SQLiteCacheTier(CACHE_CONFIG["disk_path"]) if CACHE_CONFIG["disk_path"] else None
+            self.cache = ResponseCache(CACHE_CONFIG["max_bytes"], CACHE_CONFIG["ttl"], disk_tier)
+        # 合并相同的进行中请求，共享一次上游生成
+        self.singleflight = SingleFlight() if WS_CONFIG["coalesce_requests"] else None
+        # 首帧迟迟未到时发出对冲请求，未启用时为None
+        self.hedging = hedging.from_config()
+    
+    @traced("upstream.connect")
+    def create_connection(self):
+        """创建并建立一条新的上游连接（供连接池调用）"""
+        conn = self.connection_class(self.auth_url())
+        if not conn.connect(WS_CONFIG["timeout"]):
+            conn.close()
+            raise ConnectionError("无法建立WebSocket连接")
+        conn.on_lost = self.pool.connection_lost
+        return conn
+    
+    def warm_up(self):
+        """启动时预热：后台建立并保持 pool_min_idle 条空闲连接，断开或失败时按指数退避重连"""
+        self.pool.warm(WS_CONFIG["pool_min_idle"])
+    
+    def health(self):
+        """上游连接的健康状态"""
+        return self.pool.health()
+    
+    def send_request(self, messages, temperature=0.5, top_k=4, max_tokens=2048, chat_id=None, deadline=None):
+        """从连接池取出连接并发送请求，返回该连接，调用方负责归还"""
+        request_data = self.build_request(messages, temperature, top_k, max_tokens, chat_id)
+        return self.send_request_data(request_data, deadline or Deadline(WS_CONFIG["request_timeout"]))
+    
+    def send_request_data(self, request_data, deadline):
+        """发送已构建的请求，返回所用的连接
+        
+        建立连接失败时按指数退避重试，发送失败（空闲连接已被服务端关闭）时立即换一条连接重试，
+        最多重试 retry_times 次；等待连接和退避都不超过截止时间。
+        """
+        for attempt in range(self.retry_times + 1):
+            deadline.check()
+            try:
+                with span("upstream.acquire"):
+                    conn = self.pool.acquire(min(WS_CONFIG["acquire_timeout"], deadline.remaining()))
+            except PoolError:
+                deadline.check()
+                raise
+            except ConnectionError:
+                if attempt == self.retry_times:
+                    raise
+                UPSTREAM_RECONNECTS.inc()
+                time.sleep(min(self.retry_delay(attempt + 1), deadline.remaining()))
+                continue
+            try:
+                with span("upstream.send"):
+                    conn.send(request_data)
+                return conn
+            except websocket.WebSocketException as e:
+                self.pool.release(conn, reusable=False)
+                if attempt == self.retry_times:
+                    raise ConnectionError(f"发送请求失败: {e}")
+                UPSTREAM_RECONNECTS.inc()
+            except Exception:
+                self.pool.release(conn, reusable=False)
+                raise
+    
+    def next_frame(self, conn, deadline, wait=None):
+        """阻塞等待连接上的下一帧，帧到达时立即唤醒
+        
+        指定 wait 时最多等待 wait 秒，期间没有帧到达则返回None；超过截止时间时抛出 DeadlineExceeded。
+        """
+        timeout = deadline.remaining() if wait is None else min(wait, deadline.remaining())
+        try:
+            return conn.frames.get(timeout=timeout)
+        except queue.Empty:
+            if wait is not None and not deadline.expired():
+                return None
+            UPSTREAM_TIMEOUTS.inc()
+            raise DeadlineExceeded("模型响应超时")
+    
+    def iter_response(self, conn, timeout=60, deadline=None, first_frame=None):
+        """逐帧解析模型响应，产出增量文本（delta）和搜索信息（search_info）事件
         
-        while time.time() - start_time < timeout:
-            with self.lock:
-                if self.response_buffer:
-                    data = self.response_buffer.pop(0)
-                    
-                    # 处理响应
-                    if "header" in data:
-                        code = data["header"].get("code", 0)
-                        if code != 0:
-                            error_msg = data["header"].get("message", "未知错误")
-                            raise Exception(f"模型调用错误: {code} - {error_msg}")
-                    
-                    # 检查响应格式并处理
-                    if "payload" in data:
-                        payload = data["payload"]
-                        
-                        # 处理choices字段
-                        if "choices" in payload:
-                            choices = payload["choices"]
-                            if isinstance(choices, dict) and "text" in choices:
-                                text_field = choices["text"]
-                                if isinstance(text_field, list):
-                                    for text_item in text_field:
-                                        if isinstance(text_item, dict) and "content" in text_item:
-                                            full_response["text"] += text_item["content"]
-                    
-                    # 处理search_info字段
-                    if "payload" in data and "search_info" in data["payload"]:
-                        search_info = data["payload"]["search_info"]
-                        if isinstance(search_info, dict):
-                            full_response["ref_info"].append(search_info)
-                    
-                    # 检查是否完成
-                    if "header" in data and data["header"].get("status", 0) == 2:
-                        full_response["is_finished"] = True
-                        return full_response
+        first_frame 为已经取出的首帧（对冲等待首帧时取出）。
+        """
+        deadline = deadline or Deadline(timeout)
+        data = first_frame
+        
+        while True:
+            if data is None:
+                data = self.next_frame(conn, deadline)
+            
+            if data is CONNECTION_CLOSED:
+                # 请求被取消时连接由取消回调关闭
+                deadline.check()
+                raise ConnectionError("WebSocket连接在响应完成前关闭")
             
-            time.sleep(0.1)
+            events, finished = self.parse_frame(data)
+            data = None
+            yield from events
+            if finished:
+                return
+    
+    def get_response(self, conn, timeout=60, deadline=None):
+        """获取完整的模型响应"""
+        return self.collect_response(self.iter_response(conn, timeout, deadline))
+    
+    def await_first_frame(self, conn, request_data, deadline):
+        """等待首帧，返回 (连接, 首帧)
         
-        raise TimeoutError("模型响应超时")
+        等待超过对冲延迟时在另一条连接上重发同一请求，先收到首帧（或出错）的一方胜出，
+        另一条连接被关闭，其上的生成随之终止；首帧延迟计入对冲策略的样本。
+        """
+        start_time = time.perf_counter()
+        frame = self.next_frame(conn, deadline, self.hedging.delay())
+        if frame is None:
+            conn, frame = self.hedge(conn, request_data, deadline)
+        if frame is not CONNECTION_CLOSED:
+            self.hedging.observe(time.perf_counter() - start_time)
+        return conn, frame
     
-    def chat(self, messages, temperature=0.5, top_k=4, max_tokens=2048, chat_id=None):
-        """完整的聊天流程"""
+    def hedge(self, primary, request_data, deadline):
+        """在另一条连接上重发请求，同时等待两条连接的首帧，返回 (胜出的连接, 首帧)
+        
+        落败的连接在这里关闭；出错时只关闭对冲连接，原连接仍由调用方归还。
+        只使用已建立的空闲连接，不为对冲新建连接（建立连接可能比等待原请求更久）；
+        没有空闲连接、预算不足、原请求已返回或对冲请求发送失败时不对冲，继续等待原连接。
+        """
+        race = queue.Queue()
+        primary.listener = race
+        hedge = None
+        sent = False
+        winner = None
+        cancel_hedge = None
         try:
-            self.send_request(messages, temperature, top_k, max_tokens, chat_id)
-            return self.get_response()
-        except Exception as e:
-            print(f"模型调用失败: {e}")
-            raise
+            # 设置监听之前首帧可能已经到达
+            if not primary.frames.empty():
+                return primary, primary.frames.get_nowait()
+            if not self.hedging.allow():
+                return primary, self.next_frame(primary, deadline)
+            hedge = self.pool.acquire_idle()
+            if hedge is None:
+                return primary, self.next_frame(primary, deadline)
+            hedge.listener = race
+            cancel_hedge = deadline.on_cancel(hedge.abort)
+            # 取连接期间原请求的首帧可能已经到达
+            if not primary.frames.empty():
+                return primary, primary.frames.get_nowait()
+            try:
+                with span("upstream.hedge"):
+                    hedge.send(request_data)
+            except Exception:
+                hedge.listener = None
+                self.pool.release(hedge, reusable=False)
+                hedge = None
+                return primary, self.next_frame(primary, deadline)
+            sent = True
+            UPSTREAM_HEDGES.inc(outcome="sent")
+            
+            pending = [primary, hedge]
+            while True:
+                try:
+                    conn = race.get(timeout=deadline.remaining())
+                    frame = conn.frames.get_nowait()
+                except queue.Empty:
+                    if not deadline.expired():
+                        continue
+                    UPSTREAM_TIMEOUTS.inc()
+                    raise DeadlineExceeded("模型响应超时")
+                if conn not in pending:
+                    continue
+                if frame is CONNECTION_CLOSED and len(pending) > 1 and not deadline.expired():
+                    # 一方连接断开时继续等待另一方
+                    pending.remove(conn)
+                    continue
+                break
+            
+            winner = conn
+            if winner is hedge:
+                UPSTREAM_HEDGES.inc(outcome="won")
+            return winner, frame
+        finally:
+            # 先解除监听再归还连接，归还后的连接不再向本次的 race 队列投递
+            primary.listener = None
+            if cancel_hedge is not None:
+                cancel_hedge()
+            if hedge is not None:
+                hedge.listener = None
+                # 未发出请求的对冲连接原样归还；对冲胜出时关闭原连接，否则（落败或出错）关闭对冲连接
+                if not sent:
+                    self.pool.release(hedge)
+                elif winner is hedge:
+                    self.pool.release(primary, reusable=False)
+                else:
+                    self.pool.release(hedge, reusable=False)
+    
+    def collect_response(self, events):
+        """将事件序列汇总为完整响应"""
+        text_parts = []
+        full_response = {"text": "", "ref_info": [], "is_finished": False}
+        
+        for event in events:
+            if event["type"] == "delta":
+                text_parts.append(event["content"])
+            else:
+                full_response["ref_info"].append(event["search_info"])
+        
+        full_response["text"] = "".join(text_parts)
+        full_response["is_finished"] = True
+        return full_response
+    
+    def request_key(self, messages, temperature, top_k, max_tokens):
+        """请求的规范化键，用于响应缓存和合并相同请求"""
+        return ResponseCache.make_key(messages, temperature, top_k, max_tokens, self.model_id)
+    
+    def cache_key(self, messages, temperature, top_k, max_tokens, use_cache=True):
+        """计算请求的缓存键，未启用缓存或请求选择不使用缓存时返回None"""
+        if self.cache is None or not use_cache:
+            return None
+        return self.request_key(messages, temperature, top_k, max_tokens)
+    
+    def replay_response(self, response):
+        """将缓存的完整响应按分片回放为流式事件"""
+        for search_info in response["ref_info"]:
+            yield {"type": "search_info", "search_info": search_info}
+        text = response["text"]
+        chunk_size = CACHE_CONFIG["replay_chunk_size"]
+        for start in range(0, len(text), chunk_size):
+            yield {"type": "delta", "content": text[start:start + chunk_size]}
+    
+    def upstream_stream(self, messages, temperature, top_k, max_tokens, chat_id, timeout=60, deadline=None):
+        """向上游发起一次生成并逐步产出事件
+        
+        连接在产出第一个事件前断开时，换一条连接按退避重试整个请求；已产出内容后断开则直接报错，
+        避免调用方收到重复的内容。重试共用同一个截止时间，请求被取消时立即关闭当前连接。
+        """
+        deadline = deadline or Deadline(timeout)
+        request_data = self.build_request(messages, temperature, top_k, max_tokens, chat_id)
+        for attempt in range(self.retry_times + 1):
+            conn = self.send_request_data(request_data, deadline)
+            # 回调读取的是当前的 conn，对冲胜出换成另一条连接后取消的也是它
+            unwatch = deadline.on_cancel(lambda: conn.abort())
+            start_time = time.perf_counter()
+            first_token = True
+            produced = False
+            finished = False
+            try:
+                first_frame = None
+                if self.hedging is not None:
+                    conn, first_frame = self.await_first_frame(conn, request_data, deadline)
+                with span("upstream.frames"):
+                    for event in self.iter_response(conn, deadline=deadline, first_frame=first_frame):
+                        if first_token and event["type"] == "delta":
+                            UPSTREAM_FIRST_TOKEN.observe(time.perf_counter() - start_time)
+                            mark("upstream.first_token")
+                            first_token = False
+                        produced = True
+                        yield event
+                UPSTREAM_GENERATION.observe(time.perf_counter() - start_time)
+                finished = True
+                return
+            except ConnectionError as e:
+                if produced or attempt == self.retry_times:
+                    logger.error("模型调用失败: %s", e)
+                    raise
+                UPSTREAM_RECONNECTS.inc()
+            except Exception as e:
+                logger.error("模型调用失败: %s", e)
+                raise
+            finally:
+                unwatch()
+                # 调用方提前停止迭代或出错时连接上可能残留未读的帧，不再复用
+                self.pool.release(conn, reusable=finished)
+            time.sleep(min(self.retry_delay(attempt + 1), deadline.remaining()))
+    
+    def generate(self, messages, temperature, top_k, max_tokens, chat_id, timeout=60, deadline=None):
+        """产出上游事件，启用请求合并时相同的进行中请求共享一次生成
+        
+        合并的生成使用所有订阅者中最晚的截止时间，每个订阅者只按自己的截止时间等待。
+        """
+        deadline = deadline or Deadline(timeout)
+        if self.singleflight is None:
+            return self.upstream_stream(messages, temperature, top_k, max_tokens, chat_id, deadline=deadline)
+        key = self.request_key(messages, temperature, top_k, max_tokens)
+        return self.singleflight.stream(
+            key, lambda flight_deadline: self.upstream_stream(messages, temperature, top_k, max_tokens, chat_id,
+                                                              deadline=flight_deadline),
+            deadline)
+    
+    @traced("model.chat")
+    def chat(self, messages, temperature=0.5, top_k=4, max_tokens=2048, chat_id=None, use_cache=True, timeout=60,
+             deadline=None):
+        """完整的聊天流程，启用缓存时相同的请求直接返回缓存的响应
+        
+        deadline 为请求的截止时间（见 deadline.py），未指定时按 timeout 计时。
+        """
+        cache_key = self.cache_key(messages, temperature, top_k, max_tokens, use_cache)
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        response = self.collect_response(
+            self.generate(messages, temperature, top_k, max_tokens, chat_id, timeout, deadline))
+        
+        if cache_key:
+            self.cache.set(cache_key, response)
+        return response
+    
+    def chat_stream(self, messages, temperature=0.5, top_k=4, max_tokens=2048, chat_id=None, use_cache=True,
+                    timeout=60, deadline=None):
+        """流式聊天流程，上游帧到达即产出 delta / search_info 事件，缓存命中时回放缓存"""
+        cache_key = self.cache_key(messages, temperature, top_k, max_tokens, use_cache)
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                yield from self.replay_response(cached)
+                return
+        
+        text_parts = []
+        ref_info = []
+        for event in self.generate(messages, temperature, top_k, max_tokens, chat_id, timeout, deadline):
+            if event["type"] == "delta":
+                text_parts.append(event["content"])
+            else:
+                ref_info.append(event["search_info"])
+            yield event
+        
+        # 只缓存完整生成的响应
+        if cache_key:
+            self.cache.set(cache_key, {"text": "".join(text_parts), "ref_info": ref_info, "is_finished": True})
+    
+    def chat_batch(self, items, parallelism=None, timeout=None, use_cache=True, admit=None):
+        """并发执行多个独立的对话，按完成顺序产出每一项的结果（见 batch_result）
+        
+        同时进行的上游请求不超过 parallelism，timeout 为每一项的超时（从该项开始执行算起，包含排队时间）；
+        单项的格式错误、上游错误或超时只体现在该项的结果中。admit 为可选的准入函数，每一项调用上游前
+        以序号和该项的截止时间调用，返回上下文管理器。调用方提前关闭生成器时，尚未开始的项被取消。
+        """
+        parallelism, timeout = self.batch_limits(parallelism, timeout)
+        
+        def run(index, item):
+            try:
+                request = self.batch_request(item)
+                deadline = Deadline(timeout)
+                with admit(index, deadline) if admit else nullcontext():
+                    response = self.chat(**request, use_cache=use_cache, deadline=deadline)
+                return self.batch_result(index, item, response)
+            except Exception as e:
+                return self.batch_result(index, item, error=e)
+        
+        executor = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="chat-batch")
+        try:
+            futures = [executor.submit(run, index, item) for index, item in enumerate(items)]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
     
     def close(self):
-        """关闭WebSocket连接"""
-        if self.ws:
-            self.ws.close()
-            self.is_connected = False
+        """关闭所有WebSocket连接"""
+        self.pool.close()
+        if self.cache:
+            self.cache.close()
@@ -0,0 +1,162 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from config import TRACE_CONFIG
+
+# 按需性能采集：由管理接口触发，在限定时间窗口内采集后写入文件，无需重新部署
+#
+# sample 模式：后台线程定期抓取所有线程的调用栈，输出折叠栈格式（可用 flamegraph.pl / speedscope 查看）
+# cprofile 模式：窗口内开始的每个请求在自己的线程中启用 cProfile，结束后合并，输出 .prof 文件（pstats / snakeviz 查看）
+
+MODES = ("sample", "cprofile")
+
+
+class ProfileCapture:
+    """一次限定时长的性能采集"""
+    
+    def __init__(self, mode, seconds, path):
+        self.mode = mode
+        self.seconds = seconds
+        self.path = path
+        self.started_at = time.time()
+        self.ends_at = self.started_at + seconds
+        self.samples = Counter()
+        self.sample_count = 0
+        self.stats = None
+        self.requests = 0
+        # cProfile 窗口已结束、正在写出文件，之后结束的请求不再合并
+        self.closed = False
+        self.stop_event = threading.Event()
+    
+    def to_dict(self):
+        return {
+            "mode": self.mode,
+            "seconds": self.seconds,
+            "path": self.path,
+            "started_at": self.started_at,
+            "ends_at": self.ends_at,
+            "samples": self.sample_count,
+            "requests": self.requests
+        }
+
+
+class Profiler:
+    """管理性能采集窗口，同一时间只允许一次采集"""
+    
+    def __init__(self, output_dir="profiles", max_seconds=300, sample_interval=0.005):
+        self.output_dir = output_dir
+        self.max_seconds = max_seconds
+        self.sample_interval = sample_interval
+        self.active = None
+        self.last = None
+        self.lock = threading.Lock()
+    
+    def start(self, mode="sample", seconds=10):
+        """开始采集，返回采集信息；已有采集进行中时抛出 RuntimeError"""
+        if mode not in MODES:
+            raise ValueError(f"不支持的采集模式: {mode}")
+        seconds = float(seconds)
+        if not 0 < seconds <= self.max_seconds:
+            raise ValueError(f"采集时长需在 0 到 {self.max_seconds} 秒之间")
+        
+        os.makedirs(self.output_dir, exist_ok=True)
+        suffix = "prof" if mode == "cprofile" else "folded"
+        filename = f"profile_{time.strftime('%Y%m%d_%H%M%S')}_{mode}.{suffix}"
+        with self.lock:
+            if self.active is not None:
+                raise RuntimeError("已有性能采集在进行中")
+            capture = self.active = ProfileCapture(mode, seconds, os.path.join(self.output_dir, filename))
+        
+        target = self._sample if mode == "sample" else self._wait
+        threading.Thread(target=target, args=(capture,), daemon=True).start()
+        return capture.to_dict()
+    
+    def stop(self):
+        """提前结束当前采集"""
+        with self.lock:
+            capture = self.active
+        if capture is not None:
+            capture.stop_event.set()
+    
+    def status(self):
+        with self.lock:
+            return {
+                "active": self.active.to_dict() if self.active else None,
+                "last": self.last.to_dict() if self.last else None
+            }
+    
+    def _sample(self, capture):
+        """采样线程：定期记录所有其他线程的调用栈"""
+        own_id = threading.get_ident()
+        while not capture.stop_event.wait(self.sample_interval) and time.time() < capture.ends_at:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.reverse()
+                capture.samples[";".join(stack)] += 1
+            capture.sample_count += 1
+        
+        with open(capture.path, 'w', encoding='utf-8') as f:
+            for stack, count in capture.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        self._finish(capture)
+    
+    def _wait(self, capture):
+        """cProfile 模式：等待窗口结束后写出合并的统计"""
+        capture.stop_event.wait(capture.seconds)
+        with self.lock:
+            # 先结束窗口，之后开始的请求不再采集；写出文件前仍保持 active，
+            # 查询状态时不会出现既没有进行中、也没有上一次结果的间隙
+            capture.closed = True
+            stats = capture.stats
+        if stats is not None:
+            stats.dump_stats(capture.path)
+        else:
+            capture.path = None
+        self._finish(capture)
+    
+    def _finish(self, capture):
+        with self.lock:
+            if self.active is capture:
+                self.active = None
+            self.last = capture
+    
+    def begin_request(self):
+        """请求开始时调用，cProfile 采集窗口内返回在当前线程启用的 Profile"""
+        capture = self.active
+        if capture is None or capture.mode != "cprofile" or capture.closed:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 当前线程已有其他profiler
+            return None
+        return capture, profile
+    
+    def end_request(self, handle):
+        """请求结束时调用（需与 begin_request 在同一线程），合并该请求的统计"""
+        if handle is None:
+            return
+        capture, profile = handle
+        profile.disable()
+        with self.lock:
+            if self.active is not capture or capture.closed:
+                return
+            capture.requests += 1
+            if capture.stats is None:
+                capture.stats = pstats.Stats(profile)
+            else:
+                capture.stats.add(profile)
+
+
+PROFILER = Profiler(TRACE_CONFIG["profile_dir"], TRACE_CONFIG["max_profile_seconds"], TRACE_CONFIG["sample_interval"])
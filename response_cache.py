@@ -0,0 +1,153 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class SQLiteCacheTier:
+    """基于SQLite的磁盘缓存层，进程重启后缓存仍然有效"""
+    
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value TEXT NOT NULL)"
+            )
+    
+    def get(self, key):
+        """返回 (过期时间, 序列化的响应)，不存在时返回None"""
+        with self.lock:
+            return self.conn.execute("SELECT expires_at, value FROM cache WHERE key = ?", (key,)).fetchone()
+    
+    def set(self, key, expires_at, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO cache (key, expires_at, value) VALUES (?, ?, ?)",
+                              (key, expires_at, value))
+    
+    def delete(self, key):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+    
+    def purge_expired(self):
+        """删除所有过期条目"""
+        with self.lock, self.conn:
+            return self.conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),)).rowcount
+    
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM cache")
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ResponseCache:
+    """模型响应缓存
+    
+    内存层按序列化后的字节数限制容量并按LRU淘汰，每个条目带TTL；
+    可选的磁盘层（需提供 get/set/delete/clear/close）在内存未命中时查询，命中后回填内存。
+    """
+    
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=3600, disk_tier=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_tier = disk_tier
+        # key -> (过期时间, 序列化的响应, 字节数)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(messages, temperature, top_k, max_tokens, model_id):
+        """对请求参数做规范化后计算哈希作为缓存键"""
+        normalized = json.dumps({
+            "messages": [{"role": m["role"], "content": m["content"].strip()} for m in messages],
+            "temperature": float(temperature),
+            "top_k": int(top_k),
+            "max_tokens": int(max_tokens),
+            "model_id": model_id
+        }, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """查询缓存，命中时返回响应的新副本"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(entry[1])
+                self._remove(key)
+        
+        if self.disk_tier is not None:
+            entry = self.disk_tier.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    with self.lock:
+                        self.disk_hits += 1
+                        self._store(key, entry[0], entry[1])
+                    return json.loads(entry[1])
+                self.disk_tier.delete(key)
+        
+        with self.lock:
+            self.misses += 1
+        return None
+    
+    def set(self, key, response, ttl=None):
+        """写入缓存"""
+        expires_at = time.time() + (ttl or self.ttl)
+        value = json.dumps(response, ensure_ascii=False)
+        with self.lock:
+            self._store(key, expires_at, value)
+        if self.disk_tier is not None:
+            self.disk_tier.set(key, expires_at, value)
+    
+    def _store(self, key, expires_at, value):
+        """写入内存层并按LRU淘汰到容量以内（调用方持有锁）"""
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (expires_at, value, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+    
+    def _remove(self, key):
+        self.total_bytes -= self.entries.pop(key)[2]
+    
+    def stats(self):
+        """获取缓存命中统计"""
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0
+            }
+    
+    def clear(self):
+        """清空缓存"""
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+        if self.disk_tier is not None:
+            self.disk_tier.clear()
+    
+    def close(self):
+        if self.disk_tier is not None:
+            self.disk_tier.close()
@@ -0,0 +1,587 @@
+import argparse
+import heapq
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from collections import Counter
+from config import SEARCH_CONFIG, STORAGE_CONFIG
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+# 对话消息的全文索引
+#
+# 中文按相邻两字切分（bigram），连续汉字段的最后一个字额外生成「字+RUN_END」词项，
+# 每个字都是某个词项的首字，单字查询按前缀范围扫描即可命中；其他文字按单词切分并转为小写。
+# 倒排表按词项分块存放在SQLite中（每块最多 block_size 条），块内为变长整数编码的
+# (消息编号差值, 词频, 消息长度) 序列，打分只需读取倒排表；消息编号单调递增，新消息只追加到词项的最后一块，
+# 删除消息时同步从所在的块中移除，倒排表始终与消息表一致。
+# 存储写入后由观察者回调登记更新，后台线程按 flush_interval 合并为一个事务写入索引。
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    doc_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_docs_session_id ON docs(session_id);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    first_doc INTEGER NOT NULL,
+    last_doc INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (term, first_doc)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+TOKEN_PATTERN = re.compile(f"([{CJK}]+)|([^\\W_{CJK}]+)")
+RUN_END = "$"
+
+# BM25 参数
+K1 = 1.2
+B = 0.75
+
+# SQLite 单条语句的参数个数有限，按批查询消息
+QUERY_CHUNK = 500
+# 重建索引时每累积这么多条消息写入一次倒排块
+REBUILD_BATCH = 5000
+
+
+def normalize(text):
+    """全角转半角并转为小写"""
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def tokenize(text):
+    """切分待索引的文本，返回词项列表（可重复）"""
+    terms = []
+    for cjk, word in TOKEN_PATTERN.findall(normalize(text)):
+        if word:
+            terms.append(word)
+        else:
+            terms.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+            terms.append(cjk[-1] + RUN_END)
+    return terms
+
+
+def query_terms(query):
+    """切分查询，返回去重的 (词项, 是否按前缀匹配) 列表，所有词项都需命中"""
+    terms = []
+    for cjk, word in TOKEN_PATTERN.findall(normalize(query)):
+        if word:
+            terms.append((word, False))
+        elif len(cjk) == 1:
+            terms.append((cjk, True))
+        else:
+            terms.extend((cjk[i:i + 2], False) for i in range(len(cjk) - 1))
+    return list(dict.fromkeys(terms))
+
+
+def encode_postings(postings, previous=0):
+    """将升序的 (消息编号, 词频, 消息长度) 编码为变长整数序列，编号保存与前一条的差值"""
+    out = bytearray()
+    for doc_id, tf, length in postings:
+        for value in (doc_id - previous, tf, length):
+            while value >= 0x80:
+                out.append((value & 0x7f) | 0x80)
+                value >>= 7
+            out.append(value)
+        previous = doc_id
+    return bytes(out)
+
+
+def decode_postings(data):
+    """解码一个倒排块，返回 (消息编号, 词频, 消息长度) 列表"""
+    postings = []
+    doc_id = pos = 0
+    values = [0, 0, 0]
+    size = len(data)
+    while pos < size:
+        for i in (0, 1, 2):
+            value = shift = 0
+            while True:
+                byte = data[pos]
+                pos += 1
+                value |= (byte & 0x7f) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+            values[i] = value
+        doc_id += values[0]
+        postings.append((doc_id, values[1], values[2]))
+    return postings
+
+
+def make_snippet(content, query, width):
+    """截取消息中第一个命中关键词附近的片段"""
+    lowered = content.lower()
+    positions = [lowered.find(cjk or word) for cjk, word in TOKEN_PATTERN.findall(normalize(query))]
+    positions = [pos for pos in positions if pos >= 0]
+    if len(content) <= width or not positions:
+        return content if len(content) <= width else content[:width] + "…"
+    start = max(0, min(min(positions) - width // 4, len(content) - width))
+    return ("…" if start else "") + content[start:start + width] + ("…" if start + width < len(content) else "")
+
+
+class SearchIndex:
+    """对话消息的倒排索引，作为存储的观察者增量更新，可从存储全量重建
+    
+    写入方只登记更新（保存、追加、删除），后台线程在 flush_interval 内合并后写入；
+    查询与写入使用不同的连接（WAL模式），查询不会等待索引写入。
+    """
+    
+    def __init__(self, storage_dir="data", index_file=None, block_size=None, flush_interval=None,
+                 page_size=None, max_page_size=None, snippet_length=None):
+        self.db_path = os.path.join(storage_dir, index_file or SEARCH_CONFIG["index_file"])
+        self.block_size = block_size or SEARCH_CONFIG["block_size"]
+        self.flush_interval = flush_interval if flush_interval is not None else SEARCH_CONFIG["flush_interval"]
+        self.page_size = page_size or SEARCH_CONFIG["page_size"]
+        self.max_page_size = max_page_size or SEARCH_CONFIG["max_page_size"]
+        self.snippet_length = snippet_length or SEARCH_CONFIG["snippet_length"]
+        os.makedirs(storage_dir, exist_ok=True)
+        
+        self.write_conn = self._connect()
+        self.write_conn.executescript(SCHEMA)
+        self.read_conn = self._connect()
+        self.write_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        
+        # 待写入索引的更新：("save", {session_id: 消息列表}) / ("append", session_id, 消息) / ("delete", 会话ID列表)
+        self.pending = []
+        self.first_pending_at = None
+        self.applying = False
+        self.building = False
+        self.flush_waiters = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
+    def attach(self, storage):
+        """注册为存储的观察者；索引尚未建立过时在后台从存储全量建立"""
+        storage.add_observer(self)
+        if not self._meta(self.read_conn, "built"):
+            self.building = True
+            threading.Thread(target=self._initial_build, args=(storage,), daemon=True).start()
+    
+    def _initial_build(self, storage):
+        try:
+            count = self.rebuild(storage)
+            logger.info("全文索引已建立，共 %d 条消息", count)
+        except Exception as e:
+            logger.error("建立全文索引失败: %s", e)
+        finally:
+            with self.condition:
+                self.building = False
+                self.condition.notify_all()
+    
+    # 存储观察者回调，只登记更新，不在写入方的线程中操作索引
+    
+    def conversations_saved(self, conversations):
+        self._enqueue(("save", {session_id: list(messages) for session_id, messages in conversations.items()}))
+    
+    def message_saved(self, session_id, message):
+        self._enqueue(("append", session_id, message))
+    
+    def conversations_deleted(self, session_ids):
+        self._enqueue(("delete", list(session_ids)))
+    
+    def _enqueue(self, update):
+        with self.condition:
+            if not self.pending:
+                self.first_pending_at = time.time()
+                self.condition.notify_all()
+            self.pending.append(update)
+    
+    def _ready(self):
+        if not self.pending:
+            return False
+        return (self.flush_waiters > 0 or self.closed
+                or time.time() - self.first_pending_at >= self.flush_interval)
+    
+    def _run(self):
+        """后台线程：合并一段时间内的更新，在一个事务中写入索引"""
+        while True:
+            with self.condition:
+                while not self._ready():
+                    if self.closed and not self.pending:
+                        return
+                    timeout = None
+                    if self.pending:
+                        timeout = max(0, self.first_pending_at + self.flush_interval - time.time())
+                    self.condition.wait(timeout)
+                batch, self.pending = self.pending, []
+                self.first_pending_at = None
+                self.applying = True
+            
+            try:
+                self._apply(batch)
+            except Exception as e:
+                # 丢失的更新需要重建索引才能恢复
+                logger.error("更新全文索引失败: %s", e)
+            
+            with self.condition:
+                self.applying = False
+                self.condition.notify_all()
+    
+    def flush(self, timeout=None):
+        """等待已登记的更新（以及首次建立索引）全部完成，超时返回False"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            self.flush_waiters += 1
+            self.condition.notify_all()
+            try:
+                while self.pending or self.applying or self.building:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                return True
+            finally:
+                self.flush_waiters -= 1
+    
+    def _apply(self, batch):
+        with self.write_lock:
+            conn = self.write_conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 本批新增的倒排条目（词项 -> [(消息编号, 词频, 长度)]）和需要移除的条目（词项 -> 消息编号集合）
+                postings, removals = {}, {}
+                documents = length = 0
+                for update in batch:
+                    if update[0] == "save":
+                        for session_id, messages in update[1].items():
+                            d, l = self._replace_session(conn, session_id, messages, postings, removals)
+                            documents, length = documents + d, length + l
+                    elif update[0] == "append":
+                        d, l = self._append_doc(conn, update[1], update[2], postings)
+                        documents, length = documents + d, length + l
+                    else:
+                        for session_id in update[1]:
+                            d, l = self._remove_docs(conn, "session_id = ?", (session_id,), removals)
+                            documents, length = documents - d, length - l
+                self._purge_postings(conn, removals)
+                removed = set().union(*removals.values())
+                self._merge_postings(conn, {term: [entry for entry in entries if entry[0] not in removed]
+                                            for term, entries in postings.items()})
+                self._update_stats(conn, documents, length)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+    
+    def _replace_session(self, conn, session_id, messages, postings, removals):
+        """按新的消息列表更新会话：只为新增的消息建立索引，删除已不存在的消息，返回 (消息数变化, 总长度变化)"""
+        existing = {}
+        for doc_id, role, content, timestamp in conn.execute(
+                "SELECT doc_id, role, content, timestamp FROM docs WHERE session_id = ?", (session_id,)):
+            existing.setdefault((role, content, timestamp), []).append(doc_id)
+        new_messages = []
+        for message in messages:
+            doc_ids = existing.get((message["role"], message["content"], message.get("timestamp") or 0.0))
+            if doc_ids:
+                doc_ids.pop()
+            else:
+                new_messages.append(message)
+        stale = [doc_id for doc_ids in existing.values() for doc_id in doc_ids]
+        removed = removed_length = 0
+        for i in range(0, len(stale), QUERY_CHUNK):
+            chunk = stale[i:i + QUERY_CHUNK]
+            r, l = self._remove_docs(conn, f"doc_id IN ({','.join('?' * len(chunk))})", chunk, removals)
+            removed, removed_length = removed + r, removed_length + l
+        added, added_length = self._add_docs(conn, session_id, new_messages, postings)
+        return added - removed, added_length - removed_length
+    
+    def _append_doc(self, conn, session_id, message, postings):
+        """追加一条消息；重建索引时可能已从存储读到这条消息，已存在时跳过"""
+        exists = conn.execute(
+            "SELECT 1 FROM docs WHERE session_id = ? AND timestamp = ? AND role = ? AND content = ? LIMIT 1",
+            (session_id, message.get("timestamp") or 0.0, message["role"], message["content"])).fetchone()
+        if exists:
+            return 0, 0
+        return self._add_docs(conn, session_id, [message], postings)
+    
+    def _add_docs(self, conn, session_id, messages, postings):
+        """写入消息并将其词项登记到 postings，返回 (消息数, 总词项数)"""
+        total_length = 0
+        for message in messages:
+            terms = Counter(tokenize(message["content"]))
+            length = sum(terms.values())
+            cursor = conn.execute(
+                "INSERT INTO docs (session_id, role, content, timestamp, length) VALUES (?, ?, ?, ?, ?)",
+                (session_id, message["role"], message["content"], message.get("timestamp") or 0.0, length))
+            for term, tf in terms.items():
+                postings.setdefault(term, []).append((cursor.lastrowid, tf, length))
+            total_length += length
+        return len(messages), total_length
+    
+    def _remove_docs(self, conn, condition, params, removals):
+        """删除消息，并将其词项登记到 removals 以便从倒排表中移除，返回 (消息数, 总词项数)"""
+        rows = conn.execute(f"SELECT doc_id, content, length FROM docs WHERE {condition}", params).fetchall()
+        for doc_id, content, _ in rows:
+            for term in set(tokenize(content)):
+                removals.setdefault(term, set()).add(doc_id)
+        if rows:
+            conn.execute(f"DELETE FROM docs WHERE {condition}", params)
+        return len(rows), sum(row[2] for row in rows)
+    
+    def _purge_postings(self, conn, removals):
+        """从包含被删除消息的块中移除其条目，块为空时删除"""
+        for term, doc_ids in removals.items():
+            blocks = conn.execute("SELECT first_doc, data FROM postings WHERE term = ? AND first_doc <= ? AND last_doc >= ?",
+                                  (term, max(doc_ids), min(doc_ids))).fetchall()
+            for first_doc, data in blocks:
+                entries = decode_postings(data)
+                kept = [entry for entry in entries if entry[0] not in doc_ids]
+                if len(kept) == len(entries):
+                    continue
+                if kept:
+                    conn.execute("UPDATE postings SET first_doc = ?, last_doc = ?, count = ?, data = ? "
+                                 "WHERE term = ? AND first_doc = ?",
+                                 (kept[0][0], kept[-1][0], len(kept), encode_postings(kept), term, first_doc))
+                else:
+                    conn.execute("DELETE FROM postings WHERE term = ? AND first_doc = ?", (term, first_doc))
+    
+    def _merge_postings(self, conn, postings):
+        """将新条目追加到各词项的最后一块，写满后开始新块"""
+        for term, entries in postings.items():
+            if not entries:
+                continue
+            row = conn.execute("SELECT first_doc, last_doc, count, data FROM postings WHERE term = ? "
+                               "ORDER BY first_doc DESC LIMIT 1", (term,)).fetchone()
+            if row is not None and row[2] < self.block_size:
+                first_doc, last_doc, count, data = row
+                head, entries = entries[:self.block_size - count], entries[self.block_size - count:]
+                conn.execute("UPDATE postings SET last_doc = ?, count = ?, data = ? WHERE term = ? AND first_doc = ?",
+                             (head[-1][0], count + len(head), data + encode_postings(head, last_doc), term, first_doc))
+            for i in range(0, len(entries), self.block_size):
+                block = entries[i:i + self.block_size]
+                conn.execute("INSERT INTO postings (term, first_doc, last_doc, count, data) VALUES (?, ?, ?, ?, ?)",
+                             (term, block[0][0], block[-1][0], len(block), encode_postings(block)))
+    
+    @staticmethod
+    def _meta(conn, key):
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+    
+    def _update_stats(self, conn, documents, length):
+        for key, delta in (("documents", documents), ("length", length)):
+            if delta:
+                conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) "
+                             "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value", (key, delta))
+    
+    def rebuild(self, storage):
+        """清空索引并从存储全量重建，返回索引的消息数；重建期间登记的更新在完成后写入"""
+        with self.write_lock:
+            conn = self.write_conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM docs")
+                conn.execute("DELETE FROM postings")
+                conn.execute("DELETE FROM meta")
+                postings = {}
+                total = total_length = batch = 0
+                for session_id, conversation in storage.iter_conversations():
+                    added, length = self._add_docs(conn, session_id, conversation.get("messages", []), postings)
+                    total, total_length, batch = total + added, total_length + length, batch + added
+                    if batch >= REBUILD_BATCH:
+                        self._merge_postings(conn, postings)
+                        postings, batch = {}, 0
+                self._merge_postings(conn, postings)
+                self._update_stats(conn, total, total_length)
+                conn.execute("INSERT INTO meta (key, value) VALUES ('built', 1)")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return total
+    
+    def search(self, query, session_id=None, since=None, until=None, offset=0, limit=None):
+        """按BM25相关度搜索消息，可按会话和消息时间 [since, until] 过滤，offset / limit 分页"""
+        start_time = time.perf_counter()
+        offset = max(0, offset)
+        limit = max(1, min(limit or self.page_size, self.max_page_size))
+        result = {"query": query, "total": 0, "offset": offset, "limit": limit, "results": []}
+        terms = query_terms(query)
+        if terms:
+            with self.read_lock:
+                conn = self.read_conn
+                conn.execute("BEGIN")
+                try:
+                    total, hits = self._search(conn, terms, session_id, since, until, offset + limit)
+                    page = [doc_id for doc_id, _ in hits[offset:]]
+                    rows = {}
+                    if page:
+                        rows = {row[0]: row for row in conn.execute(
+                            "SELECT doc_id, session_id, role, content, timestamp FROM docs "
+                            f"WHERE doc_id IN ({','.join('?' * len(page))})", page)}
+                finally:
+                    conn.execute("COMMIT")
+            result["total"] = total
+            for doc_id, score in hits[offset:]:
+                _, hit_session, role, content, timestamp = rows[doc_id]
+                result["results"].append({
+                    "session_id": hit_session,
+                    "role": role,
+                    "timestamp": timestamp,
+                    "snippet": make_snippet(content, query, self.snippet_length),
+                    "score": round(score, 4)
+                })
+        result["took_ms"] = round((time.perf_counter() - start_time) * 1000, 2)
+        return result
+    
+    def _search(self, conn, terms, session_id, since, until, top):
+        """返回 (命中总数, 得分最高的 top 条 [(消息编号, 得分)])"""
+        documents = self._meta(conn, "documents")
+        if not documents:
+            return 0, []
+        avg_length = max(1.0, self._meta(conn, "length") / documents)
+        
+        groups = []
+        for term, prefix in terms:
+            if prefix:
+                condition, params = "term >= ? AND term < ?", (term, chr(ord(term) + 1))
+            else:
+                condition, params = "term = ?", (term,)
+            df = conn.execute(f"SELECT COALESCE(SUM(count), 0) FROM postings WHERE {condition}", params).fetchone()[0]
+            if not df:
+                return 0, []
+            groups.append((df, condition, params))
+        # 从最少见的词项开始求交集，候选集合越来越小，后续词项只解码包含候选消息的块
+        groups.sort()
+        
+        # 候选消息：消息编号 -> 累计得分；倒排条目带有消息长度，打分不需要查询消息表
+        idf = [math.log(1 + (documents - df + 0.5) / (df + 0.5)) for df, _, _ in groups]
+        base, slope = K1 * (1 - B), K1 * B / avg_length
+        candidates = None
+        if session_id is not None:
+            candidates = {row[0]: 0.0 for row in conn.execute("SELECT doc_id FROM docs WHERE session_id = ?", (session_id,))}
+            if not candidates:
+                return 0, []
+        for weight, (_, condition, params) in zip(idf, groups):
+            # 消息编号 -> [词频, 长度]，前缀匹配的多个词项词频相加
+            matched = {}
+            if candidates is None:
+                for (data,) in conn.execute(f"SELECT data FROM postings WHERE {condition}", params):
+                    for doc_id, tf, length in decode_postings(data):
+                        entry = matched.get(doc_id)
+                        if entry is None:
+                            matched[doc_id] = [tf, length]
+                        else:
+                            entry[0] += tf
+                candidates = {}
+            else:
+                ordered = sorted(candidates)
+                for first_doc, last_doc, data in conn.execute(
+                        f"SELECT first_doc, last_doc, data FROM postings WHERE {condition} ORDER BY first_doc", params):
+                    if first_doc > ordered[-1]:
+                        break
+                    i = bisect_left(ordered, first_doc)
+                    if i == len(ordered) or ordered[i] > last_doc:
+                        continue
+                    for doc_id, tf, length in decode_postings(data):
+                        if doc_id in candidates:
+                            entry = matched.get(doc_id)
+                            if entry is None:
+                                matched[doc_id] = [tf, length]
+                            else:
+                                entry[0] += tf
+            weight *= K1 + 1
+            candidates = {doc_id: candidates.get(doc_id, 0.0) + weight * tf / (tf + base + slope * length)
+                          for doc_id, (tf, length) in matched.items()}
+            if not candidates:
+                return 0, []
+        
+        if since is not None or until is not None:
+            filters, filter_params = "", []
+            if since is not None:
+                filters += " AND timestamp >= ?"
+                filter_params.append(since)
+            if until is not None:
+                filters += " AND timestamp <= ?"
+                filter_params.append(until)
+            doc_ids = sorted(candidates)
+            in_range = {}
+            for i in range(0, len(doc_ids), QUERY_CHUNK):
+                chunk = doc_ids[i:i + QUERY_CHUNK]
+                for (doc_id,) in conn.execute(
+                        f"SELECT doc_id FROM docs WHERE doc_id IN ({','.join('?' * len(chunk))}){filters}",
+                        chunk + filter_params):
+                    in_range[doc_id] = candidates[doc_id]
+            candidates = in_range
+        # 得分相同时较新的消息在前
+        return len(candidates), heapq.nlargest(top, candidates.items(), key=lambda hit: (hit[1], hit[0]))
+    
+    def stats(self):
+        with self.read_lock:
+            return {
+                "documents": self._meta(self.read_conn, "documents"),
+                "pending": len(self.pending),
+                "index_bytes": os.path.getsize(self.db_path)
+            }
+    
+    def close(self, timeout=None):
+        """写入剩余的更新并关闭连接，最多等待 timeout 秒（默认 close_timeout），超时返回False"""
+        timeout = SEARCH_CONFIG["close_timeout"] if timeout is None else timeout
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.worker.join(timeout)
+        finished = not self.worker.is_alive()
+        if not finished:
+            with self.condition:
+                logger.error("全文索引关闭超时，%d 个更新未写入索引", len(self.pending) + self.applying)
+        # 后台线程仍在写入时由它持有写连接，进程退出时释放
+        if self.write_lock.acquire(blocking=False):
+            try:
+                self.write_conn.close()
+            finally:
+                self.write_lock.release()
+        self.read_conn.close()
+        return finished
+
+
+def main():
+    """从存储全量重建全文索引"""
+    from data_storage import create_storage
+    parser = argparse.ArgumentParser(description="重建对话全文索引")
+    parser.add_argument("--backend", default=STORAGE_CONFIG["backend"], choices=["json", "log", "sqlite"],
+                        help="存储后端")
+    parser.add_argument("--storage-dir", default=STORAGE_CONFIG["storage_dir"], help="存储目录")
+    args = parser.parse_args()
+    
+    storage = create_storage(args.backend, args.storage_dir)
+    index = SearchIndex(args.storage_dir)
+    try:
+        start_time = time.time()
+        count = index.rebuild(storage)
+    finally:
+        index.close()
+        storage.close()
+    
+    print(f"已为 {count} 条消息建立全文索引，耗时 {time.time() - start_time:.1f} 秒")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
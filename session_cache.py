@@ -0,0 +1,179 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+# MessageManager 的内存会话存储
+#
+# 容量按会话数和估算字节数限制，超出时淘汰最久未使用的会话。消息在写入时已持久化（或在写回队列中），
+# 淘汰只释放内存，再次访问时由 MessageManager 从存储重新加载。
+#
+# 过期按时间轮处理：到期时间按 resolution 取整分桶，每个会话只登记在一个桶中，活跃时移到新桶；
+# 非空桶的编号放在小顶堆中，清理时只弹出已到期的桶，开销与过期会话数成正比，不再全量扫描。
+
+
+class SessionCache:
+    """按LRU淘汰、按时间轮过期的会话缓存，提供 dict 风格的访问，所有操作线程安全
+    
+    会话对象需要有 last_active、bytes（估算的内存占用）和 lock 属性，
+    lock 被持有时（会话正在写入）不会被淘汰。
+    """
+    
+    def __init__(self, max_sessions=10000, max_bytes=256 * 1024 * 1024, expire_time=3600, resolution=1.0):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.expire_time = expire_time
+        self.resolution = resolution
+        self.lock = threading.RLock()
+        self.sessions = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        # 时间轮：桶编号 -> 会话ID集合，会话ID -> 所在桶编号，小顶堆保存所有桶编号
+        self.buckets = {}
+        self.bucket_of = {}
+        self.bucket_heap = []
+        self.evictions = 0
+        self.expirations = 0
+    
+    def __contains__(self, session_id):
+        with self.lock:
+            return session_id in self.sessions
+    
+    def __len__(self):
+        return len(self.sessions)
+    
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.sessions))
+    
+    def __getitem__(self, session_id):
+        with self.lock:
+            session = self.sessions[session_id]
+            self.sessions.move_to_end(session_id)
+            return session
+    
+    def get(self, session_id, default=None):
+        try:
+            return self[session_id]
+        except KeyError:
+            return default
+    
+    def __setitem__(self, session_id, session):
+        with self.lock:
+            self._remove(session_id)
+            self.sessions[session_id] = session
+            self._update(session_id, session)
+    
+    def setdefault(self, session_id, session):
+        """会话不存在时放入，返回缓存中的会话（并发加载同一会话时以先放入的为准）"""
+        with self.lock:
+            existing = self.sessions.get(session_id)
+            if existing is not None:
+                self.sessions.move_to_end(session_id)
+                return existing
+            self.sessions[session_id] = session
+            self._update(session_id, session)
+            return session
+    
+    def __delitem__(self, session_id):
+        with self.lock:
+            if not self._remove(session_id):
+                raise KeyError(session_id)
+    
+    def pop(self, session_id, default=None):
+        with self.lock:
+            session = self.sessions.get(session_id, default)
+            self._remove(session_id)
+            return session
+    
+    def touch(self, session_id, last_active=None):
+        """会话被修改后调用：更新活跃时间、重新计算占用并移到LRU末尾，必要时淘汰其他会话"""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return
+            if last_active is not None:
+                session.last_active = last_active
+            self.sessions.move_to_end(session_id)
+            self._update(session_id, session)
+    
+    def expire(self, now=None):
+        """清理过期会话，只处理已到期的时间轮桶，返回清理的会话数"""
+        now = time.time() if now is None else now
+        due = int(now // self.resolution)
+        expired = 0
+        with self.lock:
+            while self.bucket_heap and self.bucket_heap[0] < due:
+                bucket = heapq.heappop(self.bucket_heap)
+                for session_id in self.buckets.pop(bucket):
+                    del self.bucket_of[session_id]
+                    session = self.sessions[session_id]
+                    if now - session.last_active > self.expire_time:
+                        self._remove(session_id)
+                        expired += 1
+                    else:
+                        # 活跃时间被直接修改而未调用 touch，按实际时间重新登记
+                        self._schedule(session_id, session.last_active)
+            self.expirations += expired
+        return expired
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "bytes": self.total_bytes,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+    
+    def _update(self, session_id, session):
+        size = session.bytes
+        self.total_bytes += size - self.sizes.get(session_id, 0)
+        self.sizes[session_id] = size
+        self._schedule(session_id, session.last_active)
+        self._evict(session_id)
+    
+    def _schedule(self, session_id, last_active):
+        """将会话登记到到期时间所在的桶，已在同一个桶中时不做任何事"""
+        bucket = int((last_active + self.expire_time) // self.resolution)
+        old = self.bucket_of.get(session_id)
+        if old == bucket:
+            return
+        if old is not None:
+            # 旧桶即使变空也保留到到期时再弹出，保证堆与桶一一对应
+            self.buckets[old].discard(session_id)
+        members = self.buckets.get(bucket)
+        if members is None:
+            members = self.buckets[bucket] = set()
+            heapq.heappush(self.bucket_heap, bucket)
+        members.add(session_id)
+        self.bucket_of[session_id] = bucket
+    
+    def _remove(self, session_id):
+        if self.sessions.pop(session_id, None) is None:
+            return False
+        self.total_bytes -= self.sizes.pop(session_id, 0)
+        bucket = self.bucket_of.pop(session_id, None)
+        if bucket is not None:
+            self.buckets[bucket].discard(session_id)
+        return True
+    
+    def _evict(self, keep):
+        """超出容量时从最久未使用的会话开始淘汰，跳过刚访问的会话和正在写入的会话"""
+        count, size = len(self.sessions), self.total_bytes
+        if count <= self.max_sessions and size <= self.max_bytes:
+            return
+        victims = []
+        for session_id, session in self.sessions.items():
+            if count <= self.max_sessions and size <= self.max_bytes:
+                break
+            if session_id == keep or session.lock.locked():
+                continue
+            victims.append(session_id)
+            count -= 1
+            size -= self.sizes[session_id]
+        for session_id in victims:
+            self._remove(session_id)
+        self.evictions += len(victims)
@@ -0,0 +1,129 @@
+import threading
+from deadline import Deadline
+
+
+class Flight:
+    """一次进行中的上游生成，缓存已产出的事件并广播给所有订阅者
+    
+    deadline 为生成自身的截止时间，取所有订阅者中最晚的截止时间，所有订阅者离开时被取消。
+    """
+    
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.events = []
+        self.error = None
+        self.done = False
+        self.cancelled = False
+        self.waiters = 0
+        self.condition = threading.Condition()
+
+
+class SingleFlight:
+    """合并请求键相同的并发上游调用
+    
+    同一个键同时只有一次上游生成，由后台线程驱动；每个订阅者都会从头收到完整的事件序列，
+    后加入的订阅者先回放已产出的事件。订阅者超时或被取消时只有它自己离开，
+    所有订阅者都离开后才取消生成并关闭上游连接。
+    """
+    
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.started = 0
+        self.coalesced = 0
+    
+    def stream(self, key, factory, deadline=None):
+        """订阅键对应的生成
+        
+        factory(deadline) 返回上游事件生成器，仅在没有进行中的生成时调用，参数为生成自身的截止时间；
+        deadline 为本订阅者的截止时间，超过时只有本订阅者抛出 DeadlineExceeded。
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight(Deadline(deadline.remaining()) if deadline else None)
+                self.started += 1
+            else:
+                self.coalesced += 1
+                if flight.deadline is not None and deadline is not None:
+                    flight.deadline.extend(deadline.expires_at)
+            with flight.condition:
+                flight.waiters += 1
+        
+        if leader:
+            threading.Thread(target=self._run, args=(key, flight, factory), daemon=True).start()
+        return self._subscribe(key, flight, deadline)
+    
+    def _run(self, key, flight, factory):
+        """驱动上游生成，把事件追加到 flight 并唤醒订阅者"""
+        generator = None
+        try:
+            generator = factory(flight.deadline)
+            for event in generator:
+                with flight.condition:
+                    if flight.cancelled:
+                        break
+                    flight.events.append(event)
+                    flight.condition.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            # 关闭生成器即归还（或在取消时关闭）上游连接
+            if generator is not None:
+                generator.close()
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
+    
+    def _subscribe(self, key, flight, deadline=None):
+        """按顺序产出 flight 的事件，直到生成结束或本订阅者超过截止时间"""
+        index = 0
+        unwatch = None
+        if deadline is not None:
+            # 本订阅者被取消时立即唤醒，离开生成
+            unwatch = deadline.on_cancel(lambda: self._wake(flight))
+        try:
+            while True:
+                with flight.condition:
+                    while index >= len(flight.events) and not flight.done:
+                        if deadline is None:
+                            flight.condition.wait()
+                            continue
+                        deadline.check()
+                        flight.condition.wait(deadline.remaining())
+                    pending = flight.events[index:]
+                    index += len(pending)
+                    if not pending:
+                        if flight.error is not None:
+                            raise flight.error
+                        return
+                yield from pending
+        finally:
+            if unwatch is not None:
+                unwatch()
+            cancel = False
+            with self.lock:
+                with flight.condition:
+                    flight.waiters -= 1
+                    if flight.waiters == 0 and not flight.done:
+                        # 最后一个订阅者离开，取消生成；新的请求将重新发起上游调用
+                        flight.cancelled = cancel = True
+                        if self.flights.get(key) is flight:
+                            del self.flights[key]
+            if cancel and flight.deadline is not None:
+                # 立即关闭上游连接，不必等到下一帧到达
+                flight.deadline.cancel()
+    
+    @staticmethod
+    def _wake(flight):
+        with flight.condition:
+            flight.condition.notify_all()
+    
+    def stats(self):
+        """获取合并统计"""
+        with self.lock:
+            return {"in_flight": len(self.flights), "started": self.started, "coalesced": self.coalesced}
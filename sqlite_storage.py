@@ -0,0 +1,323 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from data_storage import DataStorage, message_cursor
+from config import STORAGE_CONFIG
+from metrics import STORAGE_BYTES
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    last_updated REAL NOT NULL,
+    updated_at TEXT NOT NULL
+);
+DROP INDEX IF EXISTS idx_sessions_last_updated;
+CREATE INDEX IF NOT EXISTS idx_sessions_last_updated_id ON sessions(last_updated, session_id);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL REFERENCES sessions(session_id) ON DELETE CASCADE,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp REAL,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages(session_id, id);
+DROP INDEX IF EXISTS idx_messages_session_timestamp;
+CREATE INDEX IF NOT EXISTS idx_messages_session_timestamp_id ON messages(session_id, timestamp, id);
+"""
+
+UPSERT_SESSION = """
+INSERT INTO sessions (session_id, last_updated, updated_at) VALUES (?, ?, ?)
+ON CONFLICT(session_id) DO UPDATE SET last_updated = excluded.last_updated, updated_at = excluded.updated_at
+"""
+
+INSERT_MESSAGE = "INSERT INTO messages (session_id, role, content, timestamp, created_at) VALUES (?, ?, ?, ?, ?)"
+
+# 流式导出时每次查询的会话数
+EXPORT_PAGE_SIZE = 500
+
+
+class SQLiteStorage(DataStorage):
+    """基于SQLite（WAL模式）的存储后端
+    
+    会话和消息分表存储，按session_id和last_updated建立索引，
+    单会话加载为点查询，旧会话清理为一次索引范围删除，分页读取消息和会话列表为索引范围查询。
+    """
+    
+    def __init__(self, storage_dir="data", db_file=None, pool_size=None):
+        self.db_path = os.path.join(storage_dir, db_file or STORAGE_CONFIG["sqlite_file"])
+        self.pool_size = pool_size or STORAGE_CONFIG["pool_size"]
+        self.pool = queue.LifoQueue()
+        self.pool_lock = threading.Lock()
+        self.created_connections = 0
+        super().__init__(storage_dir)
+    
+    def init_storage(self):
+        """初始化存储目录和数据库表"""
+        if not os.path.exists(self.storage_dir):
+            os.makedirs(self.storage_dir)
+        
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+    
+    def _create_connection(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        # 多个进程同时打开新数据库时，切换WAL模式可能不经忙等待直接报告数据库被锁定，稍后重试
+        deadline = time.time() + 30
+        while True:
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                break
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or time.time() >= deadline:
+                    conn.close()
+                    raise
+                time.sleep(0.05)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        """从连接池取出一个连接，使用期间由当前线程独占，退出时提交事务并归还"""
+        conn = None
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            with self.pool_lock:
+                if self.created_connections < self.pool_size:
+                    # 建立连接成功后才占用名额，失败时不会永久减少连接池容量
+                    conn = self._create_connection()
+                    self.created_connections += 1
+            if conn is None:
+                conn = self.pool.get()
+        
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.pool.put(conn)
+    
+    # 字节统计按消息内容的UTF-8长度计算，不含SQLite页和WAL的开销
+    @staticmethod
+    def _row_to_message(row):
+        role, content, timestamp, created_at = row
+        STORAGE_BYTES.inc(len(content.encode('utf-8')), direction="read")
+        message = {"role": role, "content": content, "timestamp": timestamp}
+        if created_at is not None:
+            message["created_at"] = created_at
+        return message
+    
+    @staticmethod
+    def _message_params(session_id, message):
+        STORAGE_BYTES.inc(len(message["content"].encode('utf-8')), direction="write")
+        return (session_id, message["role"], message["content"],
+                message.get("timestamp"), message.get("created_at"))
+    
+    def save_conversation(self, session_id, messages):
+        """保存对话历史"""
+        with self.connection() as conn:
+            conn.execute(UPSERT_SESSION, (session_id, time.time(), datetime.now().isoformat()))
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.executemany(INSERT_MESSAGE, [self._message_params(session_id, m) for m in messages])
+        self._notify("conversations_saved", {session_id: messages})
+    
+    def save_conversations(self, conversations):
+        """批量保存多个会话的对话历史，在一个事务内完成"""
+        with self.connection() as conn:
+            for session_id, messages in conversations.items():
+                conn.execute(UPSERT_SESSION, (session_id, time.time(), datetime.now().isoformat()))
+                conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                conn.executemany(INSERT_MESSAGE, [self._message_params(session_id, m) for m in messages])
+        self._notify("conversations_saved", conversations)
+    
+    def load_conversation(self, session_id):
+        """加载特定会话的对话历史"""
+        with self.connection() as conn:
+            session = conn.execute(
+                "SELECT last_updated, updated_at FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if session is None:
+                return {
+                    "messages": [],
+                    "last_updated": time.time(),
+                    "updated_at": datetime.now().isoformat()
+                }
+            rows = conn.execute(
+                "SELECT role, content, timestamp, created_at FROM messages WHERE session_id = ? ORDER BY id",
+                (session_id,)
+            ).fetchall()
+        
+        return {
+            "messages": [self._row_to_message(row) for row in rows],
+            "last_updated": session[0],
+            "updated_at": session[1]
+        }
+    
+    def load_all_conversations(self):
+        """加载所有对话历史"""
+        conversations = {}
+        with self.connection() as conn:
+            for session_id, last_updated, updated_at in conn.execute(
+                    "SELECT session_id, last_updated, updated_at FROM sessions"):
+                conversations[session_id] = {
+                    "messages": [],
+                    "last_updated": last_updated,
+                    "updated_at": updated_at
+                }
+            for row in conn.execute(
+                    "SELECT session_id, role, content, timestamp, created_at FROM messages ORDER BY id"):
+                conversations[row[0]]["messages"].append(self._row_to_message(row[1:]))
+        return conversations
+    
+    def _iter_session_rows(self, session_ids, conditions, params):
+        """按条件逐页查询会话行；未指定会话ID时按会话ID分页遍历，指定时逐个点查"""
+        if session_ids is not None:
+            query = "SELECT session_id, last_updated, updated_at FROM sessions WHERE " + \
+                    " AND ".join(["session_id = ?"] + conditions)
+            for session_id in sorted(set(session_ids)):
+                with self.connection() as conn:
+                    rows = conn.execute(query, [session_id] + params).fetchall()
+                yield from rows
+            return
+        
+        query = "SELECT session_id, last_updated, updated_at FROM sessions WHERE " + \
+                " AND ".join(["session_id > ?"] + conditions) + f" ORDER BY session_id LIMIT {EXPORT_PAGE_SIZE}"
+        last_id = ""
+        while True:
+            with self.connection() as conn:
+                page = conn.execute(query, [last_id] + params).fetchall()
+            yield from page
+            if len(page) < EXPORT_PAGE_SIZE:
+                return
+            last_id = page[-1][0]
+    
+    def iter_conversations(self, session_ids=None, since=None, until=None):
+        """逐个读取满足条件的会话，每次查询完即归还连接，不长期占用读事务"""
+        conditions, params = [], []
+        if since is not None:
+            conditions.append("last_updated >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("last_updated <= ?")
+            params.append(until)
+        
+        for session_id, last_updated, updated_at in self._iter_session_rows(session_ids, conditions, params):
+            with self.connection() as conn:
+                rows = conn.execute(
+                    "SELECT role, content, timestamp, created_at FROM messages WHERE session_id = ? ORDER BY id",
+                    (session_id,)
+                ).fetchall()
+            yield session_id, {
+                "messages": [self._row_to_message(row) for row in rows],
+                "last_updated": last_updated,
+                "updated_at": updated_at
+            }
+    
+    def iter_messages(self, session_id, before=None, limit=None):
+        """按时间倒序逐条返回会话中排在游标 before 之后的消息（见 message_cursor），最多 limit 条
+        
+        为 (session_id, timestamp, id) 索引上的一次范围查询；同一时间戳中已返回的消息用 OFFSET 跳过，
+        排序与 (timestamp, id) 一致，整个会话重写后行ID改变也不影响。
+        """
+        query = "SELECT role, content, timestamp, created_at FROM messages WHERE session_id = ?"
+        params = [session_id]
+        skip = 0
+        before = message_cursor(before)
+        if before is not None:
+            timestamp, skip = before
+            query += " AND timestamp < ?" if skip is None else " AND timestamp <= ?"
+            params.append(timestamp)
+        query += " ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?"
+        params.extend([-1 if limit is None else limit, skip or 0])
+        with self.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        for row in rows:
+            yield self._row_to_message(row)
+    
+    def list_sessions(self, before=None, limit=None):
+        """按最后更新时间倒序列出会话，before 为上一页最后一项的 (last_updated, session_id)"""
+        query = "SELECT session_id, last_updated, updated_at FROM sessions"
+        params = []
+        if before is not None:
+            query += " WHERE (last_updated, session_id) < (?, ?)"
+            params.extend(before)
+        query += " ORDER BY last_updated DESC, session_id DESC LIMIT ?"
+        params.append(-1 if limit is None else limit)
+        with self.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return [{"session_id": session_id, "last_updated": last_updated, "updated_at": updated_at}
+                for session_id, last_updated, updated_at in rows]
+    
+    def delete_conversation(self, session_id):
+        """删除特定会话的对话历史"""
+        with self.connection() as conn:
+            deleted = conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,)).rowcount > 0
+        if deleted:
+            self._notify("conversations_deleted", [session_id])
+        return deleted
+    
+    def delete_conversations(self, session_ids):
+        """批量删除多个会话，在一个事务中完成"""
+        with self.connection() as conn:
+            session_ids = list(session_ids)
+            deleted = conn.executemany("DELETE FROM sessions WHERE session_id = ?",
+                                       [(session_id,) for session_id in session_ids]).rowcount
+        if deleted:
+            self._notify("conversations_deleted", session_ids)
+        return deleted
+    
+    def clean_old_conversations(self, days=7):
+        """清理指定天数前的对话历史"""
+        cutoff_time = time.time() - (days * 24 * 60 * 60)
+        with self.connection() as conn:
+            old_conversations = [row[0] for row in conn.execute(
+                "SELECT session_id FROM sessions WHERE last_updated < ?", (cutoff_time,))]
+            if old_conversations:
+                conn.execute("DELETE FROM sessions WHERE last_updated < ?", (cutoff_time,))
+        if old_conversations:
+            self._notify("conversations_deleted", old_conversations)
+        return len(old_conversations)
+    
+    def get_conversation_count(self):
+        """获取对话历史数量"""
+        with self.connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+    
+    def save_message(self, session_id, role, content):
+        """保存单条消息"""
+        message = {
+            "role": role,
+            "content": content,
+            "timestamp": time.time(),
+            "created_at": datetime.now().isoformat()
+        }
+        with self.connection() as conn:
+            conn.execute(UPSERT_SESSION, (session_id, time.time(), datetime.now().isoformat()))
+            conn.execute(INSERT_MESSAGE, self._message_params(session_id, message))
+        self._notify("message_saved", session_id, message)
+    
+    def import_conversations(self, conversations):
+        """批量导入对话历史（用于迁移），在一个事务内完成"""
+        with self.connection() as conn:
+            for session_id, data in conversations.items():
+                conn.execute(UPSERT_SESSION, (session_id, data.get("last_updated", time.time()),
+                                              data.get("updated_at", datetime.now().isoformat())))
+                conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                conn.executemany(INSERT_MESSAGE,
+                                 [self._message_params(session_id, m) for m in data.get("messages", [])])
+        self._notify("conversations_saved", {session_id: data.get("messages", [])
+                                             for session_id, data in conversations.items()})
+        return len(conversations)
+    
+    def close(self):
+        """关闭连接池中的所有连接"""
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
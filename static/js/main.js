@@ -7,9 +7,15 @@ class ChatApp {
         this.chatMessages = document.getElementById('chat-messages');
         this.typingIndicator = document.getElementById('typing-indicator');
         this.clearBtn = document.getElementById('clear-btn');
+        this.welcomeMessage = this.chatMessages.firstElementChild;
+        // 历史消息分页游标：null 表示尚未加载第一页
+        this.historyBefore = null;
+        this.historyDone = false;
+        this.loadingHistory = false;
         
         this.initEventListeners();
         this.autoResizeTextarea();
+        this.loadHistory();
     }
     
     generateSessionId() {
@@ -33,6 +39,57 @@ class ChatApp {
         
         // 自动调整输入框高度
         this.messageInput.addEventListener('input', () => this.autoResizeTextarea());
+        
+        // 滚动到顶部时加载更早的历史消息
+        this.chatMessages.addEventListener('scroll', () => {
+            if (this.chatMessages.scrollTop === 0) {
+                this.loadHistory();
+            }
+        });
+    }
+    
+    async loadHistory() {
+        // 每次只请求一页历史消息
+        if (this.loadingHistory || this.historyDone) return;
+        this.loadingHistory = true;
+        
+        try {
+            const params = new URLSearchParams({ session_id: this.sessionId });
+            if (this.historyBefore !== null) {
+                params.set('before', this.historyBefore);
+            }
+            const response = await fetch('/api/history?' + params);
+            const data = await response.json();
+            if (!data.success) return;
+            
+            const firstPage = this.historyBefore === null;
+            if (firstPage && data.messages.length > 0 && this.welcomeMessage) {
+                // 有历史消息时不再显示欢迎语
+                this.welcomeMessage.remove();
+            }
+            this.prependMessages(data.messages);
+            if (firstPage) {
+                this.scrollToBottom();
+            }
+            this.historyBefore = data.next_before;
+            this.historyDone = data.next_before === null;
+        } catch (error) {
+            console.error('加载历史消息失败:', error);
+        } finally {
+            this.loadingHistory = false;
+        }
+    }
+    
+    prependMessages(messages) {
+        // 在顶部插入更早的消息，并保持当前可见的内容位置不变
+        const previousHeight = this.chatMessages.scrollHeight;
+        const fragment = document.createDocumentFragment();
+        messages.forEach(message => {
+            const type = message.role === 'user' ? 'user' : 'bot';
+            fragment.appendChild(this.createMessageElement(message.content, type));
+        });
+        this.chatMessages.insertBefore(fragment, this.chatMessages.firstChild);
+        this.chatMessages.scrollTop += this.chatMessages.scrollHeight - previousHeight;
     }
     
     autoResizeTextarea() {
@@ -56,8 +113,8 @@ class ChatApp {
         this.showTypingIndicator();
         
         try {
-            // 发送请求到后端
-            const response = await fetch('/api/chat', {
+            // 发送流式请求到后端
+            const response = await fetch('/api/chat/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -68,14 +125,13 @@ class ChatApp {
                 })
             });
             
-            const data = await response.json();
-            
-            if (data.success) {
-                // 添加机器人回复到聊天界面
-                this.addMessageToUI(data.response, 'bot', data.ref_info);
-            } else {
+            if (!response.ok) {
+                const data = await response.json();
                 this.addMessageToUI('抱歉，出现了错误：' + data.error, 'bot');
+                return;
             }
+            
+            await this.readStream(response);
         } catch (error) {
             console.error('聊天请求失败:', error);
             this.addMessageToUI('抱歉，连接服务器失败，请稍后重试。', 'bot');
@@ -85,13 +141,80 @@ class ChatApp {
         }
     }
     
+    async readStream(response) {
+        // 逐块读取Server-Sent Events，收到增量内容即渲染
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let text = '';
+        let refInfo = [];
+        let contentDiv = null;
+        let renderPending = false;
+        
+        const render = () => {
+            if (!contentDiv) {
+                this.hideTypingIndicator();
+                contentDiv = this.addMessageToUI(text, 'bot', refInfo);
+            } else if (!renderPending) {
+                // 同一帧内的多次增量合并为一次渲染
+                renderPending = true;
+                requestAnimationFrame(() => {
+                    renderPending = false;
+                    this.renderMessageContent(contentDiv, text, refInfo);
+                    this.scrollToBottom();
+                });
+            }
+        };
+        
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+            
+            for (const raw of events) {
+                if (!raw.startsWith('data: ')) continue;
+                const event = JSON.parse(raw.slice(6));
+                
+                if (event.type === 'delta') {
+                    text += event.content;
+                    render();
+                } else if (event.type === 'search_info') {
+                    refInfo.push(event.search_info);
+                } else if (event.type === 'done') {
+                    refInfo = event.ref_info;
+                    render();
+                } else if (event.type === 'error') {
+                    this.addMessageToUI('抱歉，出现了错误：' + event.error, 'bot');
+                }
+            }
+        }
+    }
+    
     addMessageToUI(content, type, refInfo = []) {
+        const messageDiv = this.createMessageElement(content, type, refInfo);
+        this.chatMessages.appendChild(messageDiv);
+        
+        // 滚动到底部
+        this.scrollToBottom();
+        return messageDiv.firstChild;
+    }
+    
+    createMessageElement(content, type, refInfo = []) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${type}-message`;
         
         const contentDiv = document.createElement('div');
         contentDiv.className = 'message-content';
+        this.renderMessageContent(contentDiv, content, refInfo);
         
+        messageDiv.appendChild(contentDiv);
+        return messageDiv;
+    }
+    
+    renderMessageContent(contentDiv, content, refInfo = []) {
         // 解析Markdown格式的内容
         const formattedContent = this.parseMarkdown(content);
         contentDiv.innerHTML = formattedContent;
@@ -113,12 +236,6 @@ class ChatApp {
             refDiv.innerHTML += '</ul>';
             contentDiv.appendChild(refDiv);
         }
-        
-        messageDiv.appendChild(contentDiv);
-        this.chatMessages.appendChild(messageDiv);
-        
-        // 滚动到底部
-        this.scrollToBottom();
     }
     
     parseMarkdown(text) {
@@ -181,8 +298,9 @@ class ChatApp {
                 })
             });
             
-            // 清空聊天界面
+            // 清空聊天界面，之前的历史不再加载
             this.chatMessages.innerHTML = '';
+            this.historyDone = true;
             this.addMessageToUI('上下文已清空，我们可以开始新的对话了！', 'bot');
         } catch (error) {
             console.error('清空上下文失败:', error);
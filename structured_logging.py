@@ -0,0 +1,178 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+from config import LOG_CONFIG
+from metrics import LOG_DROPPED
+from tracing import current_request_id
+
+# 结构化日志：各模块通过 get_logger 获取 "chatbot.*" 下的日志器
+#
+# 日志记录只被放入有界的内存队列，由后台 QueueListener 线程格式化并写出，
+# 调用线程（如上游WebSocket的读线程）上没有同步IO；队列满时丢弃新记录并计数，不阻塞调用方。
+# 消息中的 %s 参数也在后台线程中格式化，级别未开启的日志不会产生任何格式化开销。
+# 上游逐帧日志（FRAME_LOGGER，DEBUG级别）另经令牌桶限流。
+
+ROOT_LOGGER = "chatbot"
+FRAME_LOGGER = "chatbot.frames"
+# LogRecord 的标准属性，其余属性（通过 extra 传入）作为结构化字段输出
+STANDARD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_exception_formatter = logging.Formatter()
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def get_logger(name):
+    """获取模块日志器，name 通常为模块的 __name__"""
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def record_fields(record):
+    """日志记录中通过 extra 传入的结构化字段"""
+    return {key: value for key, value in vars(record).items() if key not in STANDARD_ATTRS}
+
+
+class JSONFormatter(logging.Formatter):
+    """每条日志输出为一行JSON：时间、级别、日志器、消息和结构化字段"""
+    
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        entry.update(record_fields(record))
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """单行文本格式，结构化字段以 key=value 附在消息之后"""
+    
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    
+    def format(self, record):
+        text = super().format(record)
+        fields = record_fields(record)
+        if fields:
+            first_line, newline, rest = text.partition("\n")
+            text = first_line + "".join(f" {key}={value}" for key, value in fields.items()) + newline + rest
+        return text
+
+
+class RateLimitFilter(logging.Filter):
+    """令牌桶限流：每秒最多放行 rate 条，允许 burst 条突发
+    
+    被丢弃的条数记录在下一条放行的日志的 suppressed 字段中。
+    """
+    
+    def __init__(self, rate, burst=None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+    
+    def filter(self, record):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                LOG_DROPPED.inc(reason="rate_limited")
+                return False
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """把日志记录放入有界队列的处理器，队列满时丢弃并计数
+    
+    与标准 QueueHandler 不同，消息不在调用线程中格式化，而是原样交给后台线程，
+    因此记录日志后不应再修改作为参数传入的对象。
+    """
+    
+    def prepare(self, record):
+        # 异常堆栈在调用线程中展开，traceback 不跨线程保存
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        request_id = current_request_id()
+        if request_id is not None and not hasattr(record, "request_id"):
+            record.request_id = request_id
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc(reason="queue_full")
+
+
+class BackgroundQueueListener(logging.handlers.QueueListener):
+    """停止时等待队列中的日志全部写出"""
+    
+    def enqueue_sentinel(self):
+        # 队列已满时标准实现会抛出 queue.Full，这里阻塞到后台线程腾出空间
+        self.queue.put(self._sentinel)
+
+
+def setup_logging(config=None):
+    """按 LOG_CONFIG 安装后台日志队列，config 中的项覆盖默认配置；重复调用时替换之前的配置"""
+    global _listener
+    config = {**LOG_CONFIG, **(config or {})}
+    if config["format"] not in ("text", "json"):
+        raise ValueError(f"不支持的日志格式: {config['format']}")
+    
+    with _setup_lock:
+        _stop_listener()
+        if config["file"]:
+            output = logging.FileHandler(config["file"], encoding="utf-8")
+        else:
+            output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JSONFormatter() if config["format"] == "json" else TextFormatter())
+        
+        log_queue = queue.Queue(config["queue_size"])
+        logger = logging.getLogger(ROOT_LOGGER)
+        logger.setLevel(config["level"])
+        logger.handlers = [BackgroundQueueHandler(log_queue)]
+        logger.propagate = False
+        frame_logger = logging.getLogger(FRAME_LOGGER)
+        frame_logger.filters = [RateLimitFilter(config["frame_rate"], config["frame_burst"])]
+        
+        _listener = BackgroundQueueListener(log_queue, output)
+        _listener.start()
+    return _listener
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def shutdown_logging():
+    """停止后台日志线程，写出队列中剩余的日志"""
+    with _setup_lock:
+        _stop_listener()
+
+
+atexit.register(shutdown_logging)
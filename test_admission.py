@@ -0,0 +1,201 @@
+import asyncio
+import threading
+import time
+from admission import AdmissionController, AdmissionRejected, PRIORITIES, parse_priority
+from deadline import Deadline
+from test_model_service import EchoConnection
+
+def start_waiter(controller, granted, name, session_id, priority=PRIORITIES["normal"]):
+    """在线程中排队获取许可，记录名称和获得的许可（或拒绝的异常）；返回前确认已进入等待队列"""
+    queued = len(controller.queue)
+    
+    def worker():
+        try:
+            granted.append((name, controller.acquire(session_id, priority)))
+        except AdmissionRejected as e:
+            granted.append((name, e))
+    
+    threading.Thread(target=worker, daemon=True).start()
+    while len(controller.queue) == queued:
+        time.sleep(0.001)
+
+def wait_granted(granted, count):
+    deadline = time.time() + 2
+    while len(granted) < count and time.time() < deadline:
+        time.sleep(0.001)
+    assert len(granted) == count, "等待中的请求未获准"
+
+# 测试准入控制
+def test_admission():
+    print("开始测试准入控制...")
+    
+    # 测试1: 并发上限与有界队列
+    print("\n1. 测试并发上限与等待队列...")
+    controller = AdmissionController(max_concurrency=1, max_queue=1)
+    granted = []
+    first = controller.acquire("a")
+    start_waiter(controller, granted, "queued", "b")
+    try:
+        controller.acquire("c")
+        assert False, "队列已满时应拒绝"
+    except AdmissionRejected as e:
+        assert e.reason == "queue_full" and e.retry_after >= 1, "拒绝原因不正确"
+    first.release()
+    first.release()
+    wait_granted(granted, 1)
+    assert controller.stats()["active"] == 1, "重复释放不应影响计数"
+    granted[0][1].release()
+    print("✓ 并发上限与等待队列正确")
+    
+    # 测试2: 优先级与会话公平
+    print("\n2. 测试优先级与会话公平...")
+    controller = AdmissionController(max_concurrency=2, max_queue=10)
+    heavy = controller.acquire("heavy")
+    other = controller.acquire("other")
+    granted = []
+    start_waiter(controller, granted, "heavy", "heavy")
+    start_waiter(controller, granted, "light", "light")
+    start_waiter(controller, granted, "low", "batch", PRIORITIES["low"])
+    start_waiter(controller, granted, "high", "admin", PRIORITIES["high"])
+    other.release()
+    wait_granted(granted, 1)
+    granted[0][1].release()
+    wait_granted(granted, 2)
+    granted[1][1].release()
+    wait_granted(granted, 3)
+    heavy.release()
+    wait_granted(granted, 4)
+    assert [name for name, _ in granted] == ["high", "light", "heavy", "low"], "出队顺序不正确"
+    print("✓ 优先级与会话公平正确")
+    
+    # 测试3: 单会话排队上限、排队超时与按等待时限拒绝
+    print("\n3. 测试排队超时与快速拒绝...")
+    controller = AdmissionController(max_concurrency=1, max_queue=10, queue_timeout=0.05, max_session_queue=1)
+    permit = controller.acquire("a")
+    granted = []
+    start_waiter(controller, granted, "queued", "b")
+    try:
+        controller.acquire("b")
+        assert False, "会话排队数超限时应拒绝"
+    except AdmissionRejected as e:
+        assert e.reason == "session_limit", "拒绝原因不正确"
+    start = time.time()
+    try:
+        controller.acquire("c", timeout=0.05)
+        assert False, "排队超时应拒绝"
+    except AdmissionRejected as e:
+        assert e.reason == "timeout" and time.time() - start >= 0.05, "排队超时处理不正确"
+    controller.avg_duration = 1
+    start = time.time()
+    try:
+        controller.acquire("d", timeout=0.5)
+        assert False, "预计无法在时限内轮到的请求应立即拒绝"
+    except AdmissionRejected as e:
+        assert e.reason == "deadline" and time.time() - start < 0.05, "未按等待时限快速拒绝"
+    wait_granted(granted, 1)
+    assert isinstance(granted[0][1], AdmissionRejected), "排队的请求应超时"
+    assert controller.stats()["rejected"] == {"session_limit": 1, "timeout": 2, "deadline": 1}, "拒绝统计不正确"
+    permit.release()
+    print("✓ 排队超时与快速拒绝正确")
+    
+    # 测试4: 令牌桶限速
+    print("\n4. 测试令牌桶限速...")
+    controller = AdmissionController(max_concurrency=10, rate=20, burst=1)
+    start = time.time()
+    for _ in range(3):
+        controller.acquire("a").release()
+    assert time.time() - start >= 0.09, "请求速率未被限制"
+    print("✓ 令牌桶限速正确")
+    
+    # 测试5: 排队时间不超过请求的截止时间
+    print("\n5. 测试按截止时间拒绝...")
+    controller = AdmissionController(max_concurrency=1, max_queue=10, queue_timeout=10)
+    permit = controller.acquire("a")
+    start = time.time()
+    try:
+        controller.acquire("b", deadline=Deadline(0.05))
+        assert False, "截止前未轮到的请求应拒绝"
+    except AdmissionRejected as e:
+        assert e.reason == "timeout" and time.time() - start < 1, "排队时间超过了请求的截止时间"
+    controller.avg_duration = 1
+    start = time.time()
+    try:
+        controller.acquire("c", deadline=Deadline(0.5))
+        assert False, "预计截止前无法轮到的请求应立即拒绝"
+    except AdmissionRejected as e:
+        assert e.reason == "deadline" and time.time() - start < 0.05, "未按截止时间快速拒绝"
+    permit.release()
+    print("✓ 按截止时间拒绝正确")
+    
+    # 测试6: 解析请求中的优先级
+    print("\n6. 测试优先级解析...")
+    assert parse_priority("low") == PRIORITIES["low"], "low 解析不正确"
+    assert parse_priority("high") == PRIORITIES["normal"], "不可信的调用方不能使用 high"
+    assert parse_priority("high", trusted=True) == PRIORITIES["high"], "可信的调用方应能使用 high"
+    for value in ("urgent", ["high"], {"level": "high"}, None, 1):
+        assert parse_priority(value, trusted=True) == PRIORITIES["normal"], f"无效的优先级应按 normal 处理: {value!r}"
+    print("✓ 优先级解析正确")
+    
+    print("\n所有测试完成！")
+
+# 测试异步获取许可
+def test_admission_async():
+    print("开始测试异步准入控制...")
+    
+    async def run():
+        controller = AdmissionController(max_concurrency=1, max_queue=10)
+        permit = await controller.acquire_async("a")
+        waiter = asyncio.create_task(controller.acquire_async("b"))
+        cancelled = asyncio.create_task(controller.acquire_async("c"))
+        await asyncio.sleep(0.01)
+        assert len(controller.queue) == 2, "请求未进入等待队列"
+        cancelled.cancel()
+        await asyncio.sleep(0.01)
+        assert len(controller.queue) == 1, "取消的请求未退出队列"
+        # 在其他线程释放许可，异步等待者同样被唤醒
+        await asyncio.to_thread(permit.release)
+        with await asyncio.wait_for(waiter, 1):
+            assert controller.stats()["active"] == 1
+        assert controller.stats()["active"] == 0, "许可未释放"
+    
+    asyncio.run(run())
+    print("✓ 异步准入控制正确")
+    
+    print("\n所有测试完成！")
+
+# 测试聊天接口的429响应
+def test_admission_endpoint():
+    print("开始测试准入控制接口...")
+    import app as chat_app
+    chat_app.model_service.connection_class = EchoConnection
+    client = chat_app.app.test_client()
+    admission = chat_app.admission
+    chat_app.admission = AdmissionController(max_concurrency=0, max_queue=0)
+    
+    print("\n1. 测试过载时返回429...")
+    try:
+        for url in ('/api/chat', '/api/chat/stream'):
+            response = client.post(url, json={"session_id": "test_admission_session", "message": "过载"})
+            assert response.status_code == 429, "过载时应返回429"
+            assert response.headers["Retry-After"] == "1" and response.json["reason"] == "queue_full"
+            response.close()
+        assert chat_app.message_manager.get_context("test_admission_session") == [], "被拒绝的请求不应写入消息"
+    finally:
+        chat_app.admission = admission
+    print("✓ 过载时返回429")
+    
+    print("\n2. 测试正常请求释放许可...")
+    response = client.post('/api/chat', json={"session_id": "test_admission_session", "message": "正常"})
+    assert response.json["response"] == "正常"
+    response.close()
+    client.post('/api/chat/stream', json={"session_id": "test_admission_session", "message": "流式"}).close()
+    assert client.get('/api/session_info').json["admission"]["active"] == 0, "请求结束后许可未释放"
+    client.post('/api/clear_context', json={"session_id": "test_admission_session"})
+    print("✓ 许可释放正确")
+    
+    print("\n所有测试完成！")
+
+if __name__ == "__main__":
+    test_admission()
+    test_admission_async()
+    test_admission_endpoint()
@@ -1,6 +1,8 @@
+import threading
 import time
 from model_service import SparkModelService
-from message_manager import MessageManager
+from message_manager import MessageManager, Session
+from session_cache import SessionCache
 
 # 测试聊天机器人核心功能
 def test_chatbot():
@@ -22,7 +24,7 @@ def test_chatbot():
     # 测试2: 添加消息
     print("\n2. 测试添加消息...")
     message_manager.add_message(session_id, "user", "你好，我是测试用户")
-    assert len(message_manager.context_store[session_id]["messages"]) == 1, "消息添加失败"
+    assert len(message_manager.context_store[session_id]) == 1, "消息添加失败"
     print("✓ 消息添加成功")
     
     # 测试3: 获取上下文
@@ -67,13 +69,127 @@ def test_chatbot():
     message_manager.add_message(old_session, "user", "这是一条测试消息")
     
     # 模拟会话过期（将最后活跃时间设置为1小时前）
-    message_manager.context_store[old_session]["last_active"] = time.time() - 3601
+    message_manager.context_store.touch(old_session, time.time() - 3601)
     
     # 清理过期会话
     expired_count = message_manager.clean_expired_sessions()
+    assert expired_count == 1 and old_session not in message_manager.context_store, "过期会话未被清理"
     print(f"✓ 过期会话清理成功，清理了 {expired_count} 个会话")
     
     print("\n所有测试完成！")
 
+# 测试按token预算截断上下文
+def test_token_budget():
+    print("开始测试token预算...")
+    message_manager = MessageManager()
+    message_manager.token_budget = 60
+    session_id = "test_token_budget_session"
+    message_manager.delete_session(session_id)
+    
+    # 测试1: 长消息使较早的轮次被截断
+    print("\n1. 测试按token预算截断...")
+    message_manager.add_message(session_id, "user", "你好")
+    message_manager.add_message(session_id, "assistant", "你好！有什么可以帮你？")
+    message_manager.add_message(session_id, "user", "请总结这段内容：" + "长文本" * 15)
+    context = message_manager.get_context(session_id)
+    assert len(context) == 1 and context[0]["role"] == "user", "超出预算的早期轮次未被截断"
+    session = message_manager.context_store[session_id]
+    assert len(session) == 3 and session.token_total == sum(session.tokens), "token预算不应截断会话本身"
+    assert len(message_manager.load_messages(session_id)) == 3, "token预算不应删除已保存的历史"
+    print("✓ 按token预算截断成功")
+    
+    # 测试2: 单条消息超出预算时仍保留最新消息
+    print("\n2. 测试保留最新消息...")
+    message_manager.add_message(session_id, "assistant", "长回复" * 50)
+    context = message_manager.get_context(session_id)
+    assert len(context) == 1 and context[0]["role"] == "assistant", "最新消息应始终保留"
+    message_manager.delete_session(session_id)
+    print("✓ 保留最新消息成功")
+    
+    print("\n所有测试完成！")
+
+# 测试内存会话缓存的容量限制与过期
+def test_session_cache():
+    print("开始测试会话缓存...")
+    
+    # 测试1: 超出会话数上限时淘汰最久未使用的会话
+    print("\n1. 测试LRU淘汰...")
+    def make_session(last_active, size=0):
+        session = Session()
+        session.last_active = last_active
+        session.bytes = size
+        return session
+    
+    cache = SessionCache(max_sessions=2, max_bytes=1000, expire_time=60)
+    now = time.time()
+    cache["a"] = make_session(now, 100)
+    cache["b"] = make_session(now, 100)
+    cache["a"]
+    cache["c"] = make_session(now, 100)
+    assert list(cache) == ["a", "c"], "未按LRU顺序淘汰"
+    cache["d"] = make_session(now, 950)
+    assert list(cache) == ["d"] and cache.total_bytes == 950, "超出字节上限时未淘汰"
+    cache["e"] = make_session(now, 100)
+    with cache["e"].lock:
+        cache["f"] = make_session(now, 950)
+        assert "e" in cache, "正在写入的会话不应被淘汰"
+    print("✓ LRU淘汰成功")
+    
+    # 测试2: 清理只处理到期的会话，重新活跃的会话不被清理
+    print("\n2. 测试时间轮过期...")
+    cache = SessionCache(max_sessions=10000, max_bytes=10 ** 9, expire_time=60)
+    for n in range(1000):
+        cache[f"s{n}"] = make_session(now - (100 if n < 10 else 0))
+    cache.touch("s0", now)
+    cache["s1"].last_active = now
+    assert cache.expire(now) == 8, "过期会话数不正确"
+    assert "s0" in cache and "s1" in cache and "s2" not in cache, "过期判断不正确"
+    assert cache.expire(now + 61) == 992 and len(cache) == 0, "到期会话未全部清理"
+    print("✓ 时间轮过期成功")
+    
+    # 测试3: 被淘汰的会话再次访问时从存储加载，并发写入不丢消息
+    print("\n3. 测试淘汰后重新加载...")
+    message_manager = MessageManager()
+    message_manager.max_history = 1000
+    message_manager.context_store.max_sessions = 1
+    sessions = ["test_cache_session_1", "test_cache_session_2"]
+    for session_id in sessions:
+        message_manager.delete_session(session_id)
+    message_manager.add_message(sessions[0], "user", "第一条")
+    message_manager.add_message(sessions[1], "user", "另一个会话")
+    assert sessions[0] not in message_manager.context_store, "会话未被淘汰"
+    message_manager.add_message(sessions[0], "assistant", "第二条")
+    context = message_manager.get_context(sessions[0])
+    assert [m["content"] for m in context] == ["第一条", "第二条"], "淘汰后重新加载的历史不正确"
+    
+    def worker(n):
+        for i in range(20):
+            message_manager.add_message(sessions[0], "user", f"{n}-{i}")
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(message_manager.get_context(sessions[0])) == 82, "并发写入丢失消息"
+    assert len(message_manager.load_messages(sessions[0])) == 82, "持久化的消息不完整"
+    for session_id in sessions:
+        message_manager.delete_session(session_id)
+    print("✓ 淘汰后重新加载成功")
+    
+    # 测试4: 按列保存的消息在边界处还原为字典格式
+    print("\n4. 测试紧凑消息表示...")
+    stored = [{"role": "system", "content": "设定", "timestamp": 1.5},
+              {"role": "user", "content": "你好", "timestamp": 2.0},
+              {"role": "tool", "content": "结果", "timestamp": 3.0}]
+    session = message_manager.new_session(stored)
+    assert session.messages() == stored, "持久化格式还原不正确"
+    assert session.context() == [{"role": m["role"], "content": m["content"]} for m in stored], "上下文格式不正确"
+    assert len(session.roles) == 3 and not hasattr(session, "__dict__"), "会话应按列紧凑保存"
+    print("✓ 紧凑消息表示正确")
+    
+    print("\n所有测试完成！")
+
 if __name__ == "__main__":
     test_chatbot()
+    test_token_budget()
+    test_session_cache()
@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+import queue
+import tempfile
+import time
+from metrics import LOG_DROPPED
+from model_service import SparkConnection
+from structured_logging import BackgroundQueueHandler, RateLimitFilter, get_logger, setup_logging, shutdown_logging
+from tracing import Tracer
+
+class CountingArg:
+    """记录被格式化次数的日志参数"""
+    
+    def __init__(self):
+        self.formatted = 0
+    
+    def __str__(self):
+        self.formatted += 1
+        return "参数"
+
+def dropped(reason):
+    return LOG_DROPPED.collect().get((reason,), 0)
+
+# 测试后台日志队列
+def test_structured_logging():
+    print("开始测试结构化日志...")
+    log_file = os.path.join(tempfile.mkdtemp(), "chatbot.log")
+    setup_logging({"level": "INFO", "format": "json", "file": log_file, "frame_rate": 5, "frame_burst": 5})
+    logger = get_logger("test_logging")
+    try:
+        # 测试1: JSON格式输出结构化字段和请求ID
+        print("\n1. 测试JSON格式输出...")
+        tracer = Tracer()
+        trace = tracer.begin("chat", "req-log")
+        logger.info("处理请求 %s", "s1", extra={"session_id": "s1"})
+        tracer.end(trace)
+        try:
+            raise ValueError("出错了")
+        except ValueError:
+            logger.exception("调用失败")
+        
+        # 测试2: 未开启的级别不格式化参数
+        print("\n2. 测试延迟格式化...")
+        arg = CountingArg()
+        logger.debug("调试信息 %s", arg)
+        
+        # 测试3: 逐帧日志限流，收到的帧不再重新序列化
+        print("\n3. 测试逐帧日志限流...")
+        logging.getLogger("chatbot.frames").setLevel(logging.DEBUG)
+        connection = SparkConnection("ws://unused")
+        before = dropped("rate_limited")
+        for i in range(50):
+            connection.on_message(None, json.dumps({"seq": i}))
+        assert connection.frames.qsize() == 50, "限流不应影响帧的处理"
+        assert dropped("rate_limited") - before >= 40, "逐帧日志未被限流"
+    finally:
+        logging.getLogger("chatbot.frames").setLevel(logging.NOTSET)
+        shutdown_logging()
+    
+    with open(log_file, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f]
+    request = next(e for e in entries if e["message"] == "处理请求 s1")
+    assert request["level"] == "INFO" and request["logger"] == "chatbot.test_logging", "日志字段不正确"
+    assert request["session_id"] == "s1" and request["request_id"] == "req-log", "结构化字段丢失"
+    assert "ValueError: 出错了" in next(e for e in entries if e["message"] == "调用失败")["exception"], "异常堆栈丢失"
+    assert arg.formatted == 0 and not any(e["message"].startswith("调试信息") for e in entries), "未开启的级别不应格式化"
+    frames = [e for e in entries if e["logger"] == "chatbot.frames"]
+    assert 1 <= len(frames) <= 10 and frames[0]["message"] == '收到模型响应: {"seq": 0}', "逐帧日志不正确"
+    print("✓ 格式化、延迟格式化和限流正确")
+    
+    # 测试4: 队列已满时丢弃而不阻塞
+    print("\n4. 测试队列满时不阻塞...")
+    handler = BackgroundQueueHandler(queue.Queue(2))
+    before = dropped("queue_full")
+    start = time.perf_counter()
+    for i in range(10):
+        handler.handle(logging.makeLogRecord({"msg": f"记录{i}", "levelno": logging.INFO}))
+    assert time.perf_counter() - start < 0.1, "队列满时不应阻塞"
+    assert handler.queue.qsize() == 2 and dropped("queue_full") - before == 8, "丢弃计数不正确"
+    print("✓ 队列满时丢弃成功")
+    
+    # 测试5: 令牌桶随时间恢复，并报告被丢弃的条数
+    print("\n5. 测试令牌桶...")
+    limiter = RateLimitFilter(rate=100, burst=2)
+    records = [logging.makeLogRecord({"msg": "帧"}) for _ in range(5)]
+    assert [limiter.filter(r) for r in records] == [True, True, False, False, False], "突发限制不正确"
+    time.sleep(0.02)
+    record = logging.makeLogRecord({"msg": "帧"})
+    assert limiter.filter(record) and record.suppressed == 3, "未报告被丢弃的条数"
+    print("✓ 令牌桶正确")
+    
+    # 恢复默认配置
+    setup_logging()
+    print("\n所有测试完成！")
+
+if __name__ == "__main__":
+    test_structured_logging()
@@ -0,0 +1,83 @@
+import threading
+import metrics
+from metrics import Counter, Gauge, Histogram, Registry
+from test_model_service import EchoConnection
+
+# 测试指标采集与导出
+def test_metrics():
+    print("开始测试指标...")
+    registry = Registry()
+    
+    # 测试1: 多线程计数，已退出线程的分片合并后不丢失
+    print("\n1. 测试按线程分片的计数器...")
+    counter = Counter("test_requests_total", "测试计数", ["code"], registry=registry)
+    def worker():
+        for _ in range(1000):
+            counter.inc(code=200)
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    counter.inc(5, code=500)
+    assert counter.collect() == {("200",): 8000, ("500",): 5}, "多线程计数不正确"
+    assert len(counter._shards) == 1, "已退出线程的分片未合并"
+    print("✓ 计数器正确")
+    
+    # 测试2: 直方图分桶与Prometheus文本格式
+    print("\n2. 测试直方图...")
+    histogram = Histogram("test_latency_seconds", "测试耗时", buckets=(0.1, 1), registry=registry)
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value)
+    text = registry.generate_latest()
+    for line in ('test_latency_seconds_bucket{le="0.1"} 1', 'test_latency_seconds_bucket{le="1.0"} 3',
+                 'test_latency_seconds_bucket{le="+Inf"} 4', 'test_latency_seconds_count 4',
+                 'test_requests_total{code="500"} 5.0', '# TYPE test_latency_seconds histogram'):
+        assert line in text, f"导出文本缺少: {line}"
+    print("✓ 直方图正确")
+    
+    # 测试3: 仪表的增减与导出时取值
+    print("\n3. 测试仪表...")
+    gauge = Gauge("test_in_flight", "测试仪表", ["state"], registry=registry)
+    with gauge.track_inprogress(state="busy"):
+        assert gauge.collect()[("busy",)] == 1, "进行中计数不正确"
+    gauge.set_function(lambda: 42, state="idle")
+    assert gauge.collect() == {("busy",): 0, ("idle",): 42}, "仪表取值不正确"
+    print("✓ 仪表正确")
+    
+    print("\n所有测试完成！")
+
+# 测试 /api/metrics 接口
+def test_metrics_endpoint():
+    print("开始测试指标接口...")
+    import app as chat_app
+    chat_app.model_service.connection_class = EchoConnection
+    client = chat_app.app.test_client()
+    
+    print("\n1. 测试请求统计...")
+    def count(histogram, *key):
+        state = histogram.collect().get(key)
+        return state[-1] if state else 0
+    chats = count(metrics.CHAT_LATENCY, "chat_stream")
+    first_tokens = count(metrics.UPSTREAM_FIRST_TOKEN)
+    response = client.post('/api/chat/stream', json={"session_id": "test_metrics_session", "message": "指标"})
+    assert '"type": "done"' in response.get_data(as_text=True), "聊天请求失败"
+    response.close()
+    assert count(metrics.CHAT_LATENCY, "chat_stream") == chats + 1, "未统计聊天耗时"
+    assert count(metrics.UPSTREAM_FIRST_TOKEN) == first_tokens + 1, "未统计首token耗时"
+    
+    text = client.get('/api/metrics').get_data(as_text=True)
+    assert 'chatbot_requests_in_flight{endpoint="chat_stream"} 0.0' in text, "进行中请求数未归零"
+    # 后台预热的热备连接也计入空闲连接
+    idle = float(chat_app.model_service.pool.stats()["idle"])
+    assert idle >= 1 and f'chatbot_upstream_connections{{state="idle"}} {idle}' in text, "未导出连接数"
+    assert 'chatbot_upstream_connections{state="in_use"} 0.0' in text, "连接未归还"
+    assert 'chatbot_storage_bytes_total{direction="write"}' in text, "未统计存储字节数"
+    client.post('/api/clear_context', json={"session_id": "test_metrics_session"})
+    print("✓ 指标接口正确")
+    
+    print("\n所有测试完成！")
+
+if __name__ == "__main__":
+    test_metrics()
+    test_metrics_endpoint()
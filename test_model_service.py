@@ -0,0 +1,633 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from async_model_service import AsyncSparkModelService
+from mock_spark_server import MockSparkServer
+import metrics
+from connection_pool import backoff_delay
+from deadline import Deadline, DeadlineExceeded, request_deadline
+from hedging import HedgePolicy
+from model_service import SparkConnection, SparkModelService
+from response_cache import ResponseCache, SQLiteCacheTier
+from singleflight import SingleFlight
+
+def make_frame(content, status=1, seq=0):
+    """构造一帧上游响应"""
+    return json.dumps({
+        "header": {"code": 0, "message": "Success", "status": status},
+        "payload": {"choices": {"status": status, "seq": seq, "text": [{"role": "assistant", "content": content}]}}
+    }, ensure_ascii=False)
+
+class EchoConnection(SparkConnection):
+    """本地回显连接：逐字返回最后一条用户消息"""
+    frame_delay = 0.01
+    sent_count = 0
+    
+    def connect(self, timeout):
+        self.is_connected = True
+        return True
+    
+    def send(self, request_data):
+        text = request_data["payload"]["message"]["text"][-1]["content"]
+        EchoConnection.sent_count += 1
+        
+        def reply():
+            for seq, char in enumerate(text):
+                time.sleep(self.frame_delay)
+                self.on_message(None, make_frame(char, seq=seq))
+            self.on_message(None, make_frame("", status=2, seq=len(text)))
+        
+        threading.Thread(target=reply, daemon=True).start()
+    
+    def close(self):
+        self.closed = True
+        self.is_connected = False
+
+class EchoModelService(SparkModelService):
+    connection_class = EchoConnection
+
+class FlakyConnection(EchoConnection):
+    """前 failures 次发送后连接立即断开，不返回任何帧"""
+    failures = 0
+    
+    def send(self, request_data):
+        if FlakyConnection.failures > 0:
+            FlakyConnection.failures -= 1
+            self.on_close(None, 1006, "连接异常断开")
+            return
+        super().send(request_data)
+
+class MuteConnection(EchoConnection):
+    """内容为“沉默”的请求不返回任何帧，用于测试响应超时"""
+    def send(self, request_data):
+        if request_data["payload"]["message"]["text"][-1]["content"] != "沉默":
+            super().send(request_data)
+
+class StallingConnection(EchoConnection):
+    """第奇数次发送的请求约1秒后才开始返回，用于测试对冲请求"""
+    sends = 0
+    
+    def send(self, request_data):
+        StallingConnection.sends += 1
+        if StallingConnection.sends % 2:
+            threading.Timer(1.0, EchoConnection.send, (self, request_data)).start()
+        else:
+            super().send(request_data)
+
+class DeadConnection(EchoConnection):
+    """无法建立的连接"""
+    def connect(self, timeout):
+        return False
+
+# 测试模型服务的连接池与响应路由
+def test_concurrent_chat():
+    print("开始测试并发聊天...")
+    service = EchoModelService()
+    service.pool.max_size = 4
+    
+    # 测试1: 并发请求的响应互不串线
+    print("\n1. 测试并发请求响应路由...")
+    results = {}
+    def worker(n):
+        text = f"请求{n}的内容"
+        results[n] = service.chat([{"role": "user", "content": text}])["text"] == text
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(results) == 8 and all(results.values()), "并发请求的响应发生串线"
+    print("✓ 并发请求响应路由正确")
+    
+    # 测试2: 连接池大小与复用
+    print("\n2. 测试连接池...")
+    stats = service.pool.stats()
+    assert stats["size"] <= 4 and stats["in_use"] == 0, "连接池大小超出限制或连接未归还"
+    conn = service.pool.acquire()
+    conn.closed = True
+    service.pool.release(conn)
+    assert service.pool.stats()["size"] == stats["size"] - 1, "失效连接未被淘汰"
+    print("✓ 连接池正常")
+    
+    # 测试3: 帧到达即被消费，不受轮询间隔限制
+    print("\n3. 测试帧投递延迟...")
+    EchoConnection.frame_delay = 0
+    start_time = time.time()
+    assert service.chat([{"role": "user", "content": "帧" * 50}])["text"] == "帧" * 50, "响应内容不正确"
+    elapsed = time.time() - start_time
+    EchoConnection.frame_delay = 0.01
+    assert elapsed < 0.5, f"51帧耗时{elapsed:.2f}秒，帧投递存在轮询延迟"
+    service.close()
+    print(f"✓ 51帧耗时{elapsed * 1000:.1f}毫秒")
+    
+    print("\n所有测试完成！")
+
+# 测试流式聊天
+def test_chat_stream():
+    print("开始测试流式聊天...")
+    service = EchoModelService()
+    
+    # 测试1: 逐帧产出增量内容
+    print("\n1. 测试增量输出...")
+    deltas = [event["content"] for event in service.chat_stream([{"role": "user", "content": "流式输出"}])
+              if event["type"] == "delta"]
+    assert deltas == ["流", "式", "输", "出"], "增量内容不正确"
+    assert service.pool.stats()["idle"] == 1, "完整读取后连接应归还复用"
+    print("✓ 增量输出成功")
+    
+    # 测试2: 调用方提前结束时连接不再复用
+    print("\n2. 测试提前结束...")
+    stream = service.chat_stream([{"role": "user", "content": "提前结束的请求"}])
+    next(stream)
+    stream.close()
+    assert service.pool.stats() == {"size": 0, "idle": 0, "in_use": 0}, "提前结束的连接未被丢弃"
+    service.close()
+    print("✓ 提前结束成功")
+    
+    print("\n所有测试完成！")
+
+# 测试响应缓存
+def test_response_cache():
+    print("开始测试响应缓存...")
+    
+    # 测试1: 按字节数LRU淘汰与TTL过期
+    print("\n1. 测试LRU淘汰与TTL...")
+    cache = ResponseCache(max_bytes=200, ttl=60)
+    for n in range(5):
+        cache.set(f"key{n}", {"text": "x" * 40, "ref_info": []})
+    assert cache.total_bytes <= 200 and cache.get("key0") is None and cache.get("key4") is not None, "LRU淘汰不正确"
+    cache.set("short", {"text": "", "ref_info": []}, ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get("short") is None, "过期条目不应命中"
+    print("✓ LRU淘汰与TTL正确")
+    
+    # 测试2: 磁盘层在重启后仍然有效
+    print("\n2. 测试磁盘缓存...")
+    path = os.path.join(tempfile.mkdtemp(), "cache.db")
+    ResponseCache(disk_tier=SQLiteCacheTier(path)).set("persist", {"text": "持久化", "ref_info": []})
+    restarted = ResponseCache(disk_tier=SQLiteCacheTier(path))
+    assert restarted.get("persist")["text"] == "持久化" and restarted.stats()["disk_hits"] == 1, "磁盘缓存未命中"
+    print("✓ 磁盘缓存成功")
+    
+    # 测试3: 模型服务的缓存命中、跳过缓存与流式回放
+    print("\n3. 测试模型服务缓存...")
+    service = EchoModelService()
+    service.cache = ResponseCache()
+    messages = [{"role": "user", "content": "常见问题"}]
+    sent_before = EchoConnection.sent_count
+    service.chat(messages)
+    assert service.chat([{"role": "user", "content": " 常见问题 "}])["text"] == "常见问题", "缓存响应不正确"
+    service.chat(messages, use_cache=False)
+    assert EchoConnection.sent_count - sent_before == 2, "缓存命中时不应请求上游"
+    replayed = "".join(e["content"] for e in service.chat_stream(messages) if e["type"] == "delta")
+    assert replayed == "常见问题" and EchoConnection.sent_count - sent_before == 2, "流式接口未回放缓存"
+    assert service.cache.stats()["hits"] == 2, "命中计数不正确"
+    service.close()
+    print("✓ 模型服务缓存成功")
+    
+    print("\n所有测试完成！")
+
+# 测试相同请求合并
+def test_request_coalescing():
+    print("开始测试相同请求合并...")
+    service = EchoModelService()
+    service.singleflight = SingleFlight()
+    messages = [{"role": "user", "content": "热门问题的回答"}]
+    
+    # 测试1: 并发的相同请求只发起一次上游调用
+    print("\n1. 测试并发合并...")
+    sent_before = EchoConnection.sent_count
+    results = []
+    def worker():
+        results.append(service.chat(messages)["text"])
+    threads = [threading.Thread(target=worker) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ["热门问题的回答"] * 10, "合并后的响应不完整"
+    assert EchoConnection.sent_count - sent_before == 1, "相同请求应只调用一次上游"
+    assert service.singleflight.stats()["coalesced"] == 9, "合并计数不正确"
+    print("✓ 10个并发请求合并为1次上游调用")
+    
+    # 测试2: 中途加入的请求先回放已产出的内容
+    print("\n2. 测试中途加入...")
+    first = service.chat_stream(messages)
+    assert next(first)["content"] == "热"
+    late = "".join(e["content"] for e in service.chat_stream(messages) if e["type"] == "delta")
+    rest = "".join(e["content"] for e in first if e["type"] == "delta")
+    assert late == "热门问题的回答" and rest == "门问题的回答", "中途加入的请求内容不完整"
+    assert EchoConnection.sent_count - sent_before == 2, "中途加入的请求不应再次调用上游"
+    print("✓ 中途加入成功")
+    
+    # 测试3: 所有订阅者离开后取消生成并丢弃连接
+    print("\n3. 测试取消...")
+    stream = service.chat_stream(messages)
+    next(stream)
+    stream.close()
+    deadline = time.time() + 1
+    while service.pool.stats()["size"] and time.time() < deadline:
+        time.sleep(0.01)
+    assert service.singleflight.stats()["in_flight"] == 0, "取消后不应保留进行中的生成"
+    assert service.pool.stats() == {"size": 0, "idle": 0, "in_use": 0}, "取消的连接未被丢弃"
+    print("✓ 取消成功")
+    
+    # 测试4: 订阅者超时或被取消时只有它自己离开，生成按最晚的截止时间继续
+    print("\n4. 测试订阅者各自的截止时间...")
+    long_messages = [{"role": "user", "content": "长" * 60}]
+    outcomes = {}
+    def subscriber(name, deadline):
+        start_time = time.time()
+        try:
+            outcomes[name] = service.chat(long_messages, use_cache=False, deadline=deadline)["text"]
+        except DeadlineExceeded:
+            outcomes[name] = time.time() - start_time
+    cancelled = Deadline(5)
+    threads = [threading.Thread(target=subscriber, args=("short", Deadline(0.2)))]
+    threads[0].start()
+    time.sleep(0.05)
+    threads += [threading.Thread(target=subscriber, args=("long", Deadline(5))),
+                threading.Thread(target=subscriber, args=("cancelled", cancelled))]
+    for t in threads[1:]:
+        t.start()
+    threading.Timer(0.1, cancelled.cancel).start()
+    for t in threads:
+        t.join()
+    assert outcomes["short"] < 0.5 and outcomes["cancelled"] < 0.5, "订阅者未按自己的截止时间离开"
+    assert outcomes["long"] == "长" * 60, "其他订阅者离开后生成不应被取消"
+    service.close()
+    print("✓ 订阅者截止时间互不影响")
+    
+    print("\n所有测试完成！")
+
+# 测试本地模拟服务与真实WebSocket连接
+def test_mock_spark_server():
+    print("开始测试模拟讯飞星辰服务...")
+    with MockSparkServer(search_info=True) as mock:
+        service = SparkModelService()
+        service.scheme = "ws"
+        service.host = mock.address
+        
+        # 测试1: 校验签名
+        print("\n1. 测试鉴权...")
+        path = service.generate_auth_url().split(mock.address, 1)[1]
+        assert mock.verify_auth(path) is None, "正确的签名未通过校验"
+        service.api_secret = "wrong_secret"
+        service.backoff_base = 0.01
+        assert mock.verify_auth(service.generate_auth_url().split(mock.address, 1)[1]), "错误的签名应被拒绝"
+        try:
+            service.chat([{"role": "user", "content": "你好"}])
+            assert False, "签名错误时应无法建立连接"
+        except ConnectionError:
+            pass
+        service.api_secret = mock.api_secret
+        print("✓ 鉴权校验成功")
+        
+        # 测试2: 逐帧回复与search_info
+        print("\n2. 测试回复...")
+        response = service.chat([{"role": "user", "content": "模拟服务"}])
+        assert response["text"] == "模拟服务" and response["ref_info"][0]["urls"], "回复内容不正确"
+        print("✓ 回复成功")
+        
+        # 测试3: 错误码与连接中断
+        print("\n3. 测试故障注入...")
+        # 关闭重试，单独验证故障透传
+        service.retry_times = 0
+        mock.error_rate = 1
+        try:
+            service.chat([{"role": "user", "content": "错误"}], use_cache=False)
+            assert False, "错误码应抛出异常"
+        except Exception as e:
+            assert "10013" in str(e), "错误码未透传"
+        mock.error_rate = 0
+        mock.drop_rate = 1
+        try:
+            service.chat([{"role": "user", "content": "中途断开的请求"}], use_cache=False)
+            assert False, "连接中断应抛出异常"
+        except ConnectionError:
+            pass
+        assert mock.stats["errors"] == 1 and mock.stats["dropped"] == 1, "故障注入统计不正确"
+        service.close()
+        print("✓ 故障注入成功")
+    
+    print("\n所有测试完成！")
+
+# 测试连接预热、鉴权缓存与重连
+def test_reconnect():
+    print("开始测试连接预热与重连...")
+    
+    # 测试1: 鉴权URL在有效期内复用，参数变化时重新生成
+    print("\n1. 测试鉴权URL缓存...")
+    service = EchoModelService()
+    url = service.auth_url()
+    assert service.auth_url() is url, "有效期内应复用鉴权URL"
+    service.api_secret = "another_secret"
+    assert service.auth_url() != url, "鉴权参数变化后应重新签名"
+    delays = [backoff_delay(n, base=0.5, cap=4) for n in range(1, 8)]
+    assert 0.25 <= delays[0] <= 0.5 and all(2 <= d <= 4 for d in delays[4:]), "退避时间不正确"
+    print("✓ 鉴权URL缓存正确")
+    
+    # 测试2: 预热热备连接，连接断开后后台立即补充
+    print("\n2. 测试连接预热...")
+    assert not service.health()["ready"], "未建立连接时不应就绪"
+    service.warm_up()
+    deadline = time.time() + 2
+    while not service.pool.idle and time.time() < deadline:
+        time.sleep(0.01)
+    assert service.health()["ready"] and service.pool.stats()["idle"] == 1, "预热连接未建立"
+    warm = service.pool.idle[0]
+    warm.on_error(None, "连接被重置")
+    deadline = time.time() + 2
+    while (not service.pool.idle or service.pool.idle[0] is warm) and time.time() < deadline:
+        time.sleep(0.01)
+    assert service.pool.idle and service.pool.idle[0] is not warm, "断开的热备连接未被替换"
+    service.close()
+    print("✓ 连接预热成功")
+    
+    # 测试3: 首帧前连接断开的请求换连接重试
+    print("\n3. 测试进行中请求重试...")
+    service = EchoModelService()
+    service.connection_class = FlakyConnection
+    service.backoff_base = 0.01
+    FlakyConnection.failures = 2
+    reconnects = metrics.UPSTREAM_RECONNECTS.collect().get((), 0)
+    assert service.chat([{"role": "user", "content": "重试"}])["text"] == "重试", "重试后的响应不正确"
+    assert FlakyConnection.failures == 0, "断开的请求未重试"
+    assert metrics.UPSTREAM_RECONNECTS.collect()[()] - reconnects == 2, "重连次数统计不正确"
+    service.close()
+    print("✓ 进行中请求重试成功")
+    
+    # 测试4: 无法建立连接时退避重试后报错
+    print("\n4. 测试建立连接失败...")
+    service = EchoModelService()
+    service.connection_class = DeadConnection
+    service.backoff_base = 0.01
+    service.retry_times = 2
+    try:
+        service.chat([{"role": "user", "content": "失败"}])
+        assert False, "无法建立连接时应抛出异常"
+    except ConnectionError:
+        pass
+    health = service.health()
+    assert not health["ready"] and health["failures"] == 3 and health["last_error"], "健康状态不正确"
+    service.close()
+    print("✓ 建立连接失败处理正确")
+    
+    # 测试5: 健康检查接口
+    print("\n5. 测试健康检查接口...")
+    import app as chat_app
+    client = chat_app.app.test_client()
+    assert client.get('/api/health').status_code == 200, "存活检查应始终返回200"
+    response = client.get('/api/ready')
+    assert response.status_code == (200 if response.json["ready"] else 503), "就绪检查状态码不正确"
+    print("✓ 健康检查接口正常")
+    
+    print("\n所有测试完成！")
+
+# 测试批量聊天
+def test_chat_batch():
+    print("开始测试批量聊天...")
+    service = EchoModelService()
+    service.connection_class = MuteConnection
+    
+    # 测试1: 并发执行，单项错误和超时不影响其他项
+    print("\n1. 测试批量执行...")
+    lock = threading.Lock()
+    active = peak = 0
+    
+    @contextmanager
+    def admit(index, deadline):
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        try:
+            yield
+        finally:
+            with lock:
+                active -= 1
+    
+    items = [{"id": f"q{n}", "message": f"问题{n}"} for n in range(6)]
+    items += [{"id": "bad", "messages": []}, {"id": "slow", "message": "沉默"}]
+    results = list(service.chat_batch(items, parallelism=3, timeout=0.3, admit=admit))
+    by_id = {r["id"]: r for r in results}
+    assert len(results) == len(items), "批量结果数量不正确"
+    assert all(by_id[f"q{n}"]["response"] == f"问题{n}" for n in range(6)), "批量响应不正确"
+    assert by_id["bad"]["error_type"] == "invalid" and by_id["slow"]["error_type"] == "timeout", "单项错误类型不正确"
+    assert results[-1]["id"] == "slow", "结果应按完成顺序返回"
+    assert 2 <= peak <= 3, "批内并发数不正确"
+    print("✓ 批量执行成功")
+    
+    # 测试2: 提前关闭时取消尚未开始的项
+    print("\n2. 测试提前关闭...")
+    sent = EchoConnection.sent_count
+    results = service.chat_batch([{"message": f"取消{n}"} for n in range(20)], parallelism=1)
+    next(results)
+    results.close()
+    time.sleep(0.1)
+    assert EchoConnection.sent_count - sent < 5, "关闭后仍在执行剩余的项"
+    service.close()
+    print("✓ 提前关闭成功")
+    
+    # 测试3: NDJSON接口
+    print("\n3. 测试批量接口...")
+    import app as chat_app
+    chat_app.model_service.connection_class = EchoConnection
+    client = chat_app.app.test_client()
+    assert client.post('/api/chat/batch', json={"conversations": []}).status_code == 400, "空批次应返回400"
+    response = client.post('/api/chat/batch', json={
+        "conversations": [{"id": "a", "message": "甲"}, {"id": "b", "messages": [{"role": "user", "content": "乙"}]},
+                          {"id": "c", "message": 1}],
+        "parallelism": 2
+    })
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    response.close()
+    by_id = {line["id"]: line for line in lines[:-1]}
+    assert by_id["a"]["response"] == "甲" and by_id["b"]["response"] == "乙" and not by_id["c"]["success"]
+    assert lines[-1]["done"] and lines[-1]["total"] == 3 and lines[-1]["failed"] == 1, "批次汇总不正确"
+    print("✓ 批量接口正确")
+    
+    print("\n所有测试完成！")
+
+# 测试请求截止时间与取消
+def test_deadline():
+    print("开始测试请求截止时间...")
+    service = EchoModelService()
+    service.connection_class = MuteConnection
+    
+    # 测试1: 超过截止时间时抛出 DeadlineExceeded
+    print("\n1. 测试截止时间...")
+    start_time = time.time()
+    try:
+        service.chat([{"role": "user", "content": "沉默"}], deadline=Deadline(0.2))
+        assert False, "超过截止时间应抛出异常"
+    except DeadlineExceeded:
+        pass
+    assert time.time() - start_time < 1, "截止时间未生效"
+    assert service.chat([{"role": "user", "content": "你好"}], deadline=Deadline(5))["text"] == "你好"
+    print("✓ 截止时间正确")
+    
+    # 测试2: 取消请求时立即关闭上游连接
+    print("\n2. 测试取消请求...")
+    conn = service.pool.idle[-1]
+    deadline = Deadline(30)
+    threading.Timer(0.1, deadline.cancel).start()
+    start_time = time.time()
+    try:
+        service.chat([{"role": "user", "content": "沉默"}], deadline=deadline)
+        assert False, "取消的请求应抛出异常"
+    except DeadlineExceeded:
+        pass
+    assert time.time() - start_time < 1, "取消后未立即返回"
+    assert conn.closed and service.pool.stats()["in_use"] == 0, "被取消请求的连接应关闭，不再复用"
+    called = []
+    deadline.on_cancel(lambda: called.append(True))
+    assert called and deadline.remaining() == 0, "已取消时注册的回调应立即执行"
+    service.close()
+    print("✓ 取消请求正确")
+    
+    # 测试3: 请求指定的 timeout
+    print("\n3. 测试请求超时参数...")
+    assert request_deadline(1000).timeout == 300 and request_deadline().timeout == 60, "超时上限或默认值不正确"
+    for value in (0, -1, "abc"):
+        try:
+            request_deadline(value)
+            assert False, "无效的超时应抛出异常"
+        except ValueError:
+            pass
+    import app as chat_app
+    client = chat_app.app.test_client()
+    response = client.post('/api/chat', json={"message": "你好", "timeout": "abc"})
+    assert response.status_code == 400, "无效的超时应返回400"
+    print("✓ 请求超时参数正确")
+    
+    print("\n所有测试完成！")
+
+# 测试对冲请求
+def test_hedged_requests():
+    print("开始测试对冲请求...")
+    
+    # 测试1: 对冲延迟取分位数并限制在上下限内，对冲次数受预算限制
+    print("\n1. 测试对冲策略...")
+    policy = HedgePolicy(percentile=0.5, min_delay=0.1, max_delay=1.0, min_samples=4, budget=0.1)
+    assert policy.delay() is None, "样本不足时不应对冲"
+    for seconds in (0.2, 0.3, 0.4, 5.0):
+        policy.observe(seconds)
+    assert policy.delay() == 0.4, "对冲延迟应为首帧延迟的分位数"
+    assert policy.allow() and not policy.allow(), "对冲预算不正确"
+    for _ in range(10):
+        policy.delay()
+    assert policy.allow(), "积累预算后应允许对冲"
+    clamped = HedgePolicy(min_delay=0.1, max_delay=1.0, min_samples=1)
+    clamped.observe(0.01)
+    assert clamped.delay() == 0.1, "对冲延迟应不低于下限"
+    print("✓ 对冲策略正确")
+    
+    # 测试2: 原请求首帧迟迟未到时，对冲请求先返回
+    print("\n2. 测试对冲请求...")
+    service = EchoModelService()
+    service.connection_class = StallingConnection
+    service.hedging = HedgePolicy(min_delay=0.05, max_delay=0.05, min_samples=0, budget=1.0)
+    service.pool.warm(2)
+    deadline = time.time() + 2
+    while len(service.pool.idle) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    won = metrics.UPSTREAM_HEDGES.collect().get(("won",), 0)
+    StallingConnection.sends = 0
+    start_time = time.time()
+    assert service.chat([{"role": "user", "content": "对冲测试"}], use_cache=False)["text"] == "对冲测试"
+    elapsed = time.time() - start_time
+    assert elapsed < 0.8, f"对冲后仍耗时{elapsed:.2f}秒"
+    assert metrics.UPSTREAM_HEDGES.collect()[("won",)] - won == 1, "对冲胜出次数统计不正确"
+    for n in range(4):
+        assert service.chat([{"role": "user", "content": f"对冲{n}"}], use_cache=False)["text"] == f"对冲{n}"
+    assert service.pool.stats()["in_use"] == 0, "连接未归还"
+    assert all(conn.listener is None for conn in service.pool.idle), "归还的连接不应保留对冲监听"
+    service.close()
+    print(f"✓ 对冲请求耗时{elapsed * 1000:.1f}毫秒")
+    
+    # 测试3: 没有空闲连接时不为对冲新建连接
+    print("\n3. 测试无空闲连接...")
+    service = EchoModelService()
+    service.connection_class = StallingConnection
+    service.hedging = HedgePolicy(min_delay=0.05, max_delay=0.05, min_samples=0, budget=1.0)
+    sent = metrics.UPSTREAM_HEDGES.collect().get(("sent",), 0)
+    StallingConnection.sends = 0
+    assert service.chat([{"role": "user", "content": "等待"}], use_cache=False)["text"] == "等待"
+    assert metrics.UPSTREAM_HEDGES.collect().get(("sent",), 0) == sent, "没有空闲连接时不应对冲"
+    assert service.pool.stats() == {"size": 1, "idle": 1, "in_use": 0}, "不应新建对冲连接"
+    service.close()
+    print("✓ 无空闲连接时不对冲")
+    
+    print("\n所有测试完成！")
+
+# 测试异步模型服务
+def test_async_chat():
+    print("开始测试异步模型服务...")
+    
+    async def run():
+        with MockSparkServer() as mock:
+            service = AsyncSparkModelService()
+            service.scheme = "ws"
+            service.host = mock.address
+            
+            # 测试1: 大量并发请求
+            print("\n1. 测试并发请求...")
+            texts = [f"异步请求{n}" for n in range(50)]
+            responses = await asyncio.gather(*(service.chat([{"role": "user", "content": t}]) for t in texts))
+            assert [r["text"] for r in responses] == texts, "并发请求的响应不正确"
+            print("✓ 50个并发请求成功")
+            
+            # 测试2: 流式输出与提前结束
+            print("\n2. 测试流式输出...")
+            stream = service.chat_stream([{"role": "user", "content": "流式"}])
+            assert (await stream.__anext__())["content"] == "流", "流式输出不正确"
+            await stream.aclose()
+            print("✓ 流式输出成功")
+            
+            # 测试3: 批量请求
+            print("\n3. 测试批量请求...")
+            items = [{"id": n, "message": f"批量{n}"} for n in range(5)] + [{"id": "bad"}]
+            results = [r async for r in service.chat_batch(items, parallelism=2)]
+            by_id = {r["id"]: r for r in results}
+            assert all(by_id[n]["response"] == f"批量{n}" for n in range(5)), "批量请求的响应不正确"
+            assert by_id["bad"]["error_type"] == "invalid", "格式错误的项应单独报错"
+            print("✓ 批量请求成功")
+            
+            # 测试4: 预热热备连接并优先取用
+            print("\n4. 测试连接预热...")
+            await service.warm_up()
+            for _ in range(100):
+                if service.standby:
+                    break
+                await asyncio.sleep(0.01)
+            assert service.health()["ready"] and service.health()["idle"] == 1, "预热连接未建立"
+            connections = mock.stats["connections"]
+            assert (await service.chat([{"role": "user", "content": "热备"}]))["text"] == "热备"
+            for _ in range(100):
+                if service.standby:
+                    break
+                await asyncio.sleep(0.01)
+            assert mock.stats["connections"] == connections + 1, "请求应使用热备连接，并补充一条新的热备连接"
+            await service.close()
+            print("✓ 连接预热成功")
+    
+    asyncio.run(run())
+    print("\n所有测试完成！")
+
+if __name__ == "__main__":
+    test_concurrent_chat()
+    test_chat_stream()
+    test_response_cache()
+    test_request_coalescing()
+    test_mock_spark_server()
+    test_reconnect()
+    test_chat_batch()
+    test_deadline()
+    test_hedged_requests()
+    test_async_chat()
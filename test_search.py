@@ -0,0 +1,179 @@
+import tempfile
+import threading
+import time
+from data_storage import DataStorage
+from log_storage import LogStorage
+from search_index import SearchIndex, decode_postings, encode_postings, query_terms, tokenize
+from sqlite_storage import SQLiteStorage
+from tiered_storage import TieredStorage
+
+def message(content, timestamp, role="user"):
+    return {"role": role, "content": content, "timestamp": timestamp}
+
+def sessions_of(result):
+    return [hit["session_id"] for hit in result["results"]]
+
+# 测试分词与倒排编码
+def test_tokenize():
+    print("开始测试分词与倒排编码...")
+    assert tokenize("今天天气") == ["今天", "天天", "天气", "气$"], "中文切分不正确"
+    assert tokenize("Python很好ＡＢＣ") == ["python", "很好", "好$", "abc"], "混合文本切分不正确"
+    assert query_terms("天 天气 Python") == [("天", True), ("天气", False), ("python", False)], "查询切分不正确"
+    postings = [(1, 1, 5), (2, 3, 12), (200, 1, 300), (100000, 2, 40)]
+    data = encode_postings(postings)
+    assert decode_postings(data) == postings, "倒排编码不一致"
+    assert len(data) < len(postings) * 5, "倒排编码不够紧凑"
+    print("✓ 分词与倒排编码正确")
+
+# 测试全文索引
+def test_search_index():
+    print("开始测试全文索引...")
+    storage_dir = tempfile.mkdtemp()
+    storage = DataStorage(storage_dir)
+    index = SearchIndex(storage_dir, block_size=2, flush_interval=0.01)
+    index.attach(storage)
+    index.flush()
+    
+    # 测试1: 随存储写入增量更新
+    print("\n1. 测试增量更新...")
+    storage.save_conversation("weather", [message("今天天气怎么样？", 100.0),
+                                          message("今天晴，适合出门。", 101.0, "assistant")])
+    storage.save_conversation("python", [message("Python 怎么读取文件？", 200.0)])
+    storage.save_message("chat", "user", "天气预报说明天下雨")
+    index.flush()
+    result = index.search("天气")
+    assert sessions_of(result) == ["weather", "chat"] or sessions_of(result) == ["chat", "weather"]
+    assert result["total"] == 2 and "天气" in result["results"][0]["snippet"], "搜索结果不正确"
+    assert sessions_of(index.search("python")) == ["python"], "英文单词搜索失败"
+    assert sessions_of(index.search("晴")) == ["weather"], "单字搜索失败"
+    assert index.search("天气 下雨")["total"] == 1, "多个关键词应同时命中"
+    assert index.search("台风")["total"] == 0
+    print("✓ 增量更新成功")
+    
+    # 测试2: 保存整个会话时只索引变化的消息
+    print("\n2. 测试会话覆盖保存...")
+    storage.save_conversation("weather", [message("今天晴，适合出门。", 101.0, "assistant"),
+                                          message("那明天呢？", 102.0)])
+    index.flush()
+    assert index.stats()["documents"] == 4, "覆盖保存后消息数不正确"
+    assert sessions_of(index.search("天气")) == ["chat"], "被删除的消息仍可搜索到"
+    assert sessions_of(index.search("明天")) in (["weather", "chat"], ["chat", "weather"])
+    print("✓ 会话覆盖保存成功")
+    
+    # 测试3: 排序、过滤与分页
+    print("\n3. 测试排序、过滤与分页...")
+    storage.save_conversations({f"page_{i}": [message("退款" * (1 if i else 5) + f"第{i}个", 300.0 + i)]
+                                for i in range(5)})
+    index.flush()
+    result = index.search("退款", limit=2)
+    assert result["total"] == 5 and len(result["results"]) == 2, "分页数量不正确"
+    assert result["results"][0]["session_id"] == "page_0", "词频最高的消息应排在最前"
+    second = index.search("退款", offset=4, limit=2)
+    assert len(second["results"]) == 1, "最后一页数量不正确"
+    assert index.search("退款", session_id="page_3")["total"] == 1, "会话过滤失败"
+    assert index.search("退款", since=302.0, until=303.0)["total"] == 2, "时间过滤失败"
+    print("✓ 排序、过滤与分页成功")
+    
+    # 测试4: 删除与重建
+    print("\n4. 测试删除与重建...")
+    storage.delete_conversation("chat")
+    storage.delete_conversations(["page_0", "page_1"])
+    index.flush()
+    assert index.search("下雨")["total"] == 0, "删除的会话仍可搜索到"
+    assert index.search("退款")["total"] == 3
+    assert index.rebuild(storage) == 6, "重建的消息数不正确"
+    assert index.stats()["documents"] == 6
+    assert index.search("退款")["total"] == 3, "重建后搜索结果不正确"
+    index.close()
+    
+    reopened = SearchIndex(storage_dir)
+    assert sessions_of(reopened.search("python")) == ["python"], "重新打开后索引丢失"
+    reopened.close()
+    print("✓ 删除与重建成功")
+    
+    # 测试5: 索引写入卡住时关闭不会一直等待
+    print("\n5. 测试关闭超时...")
+    release = threading.Event()
+    
+    class StuckIndex(SearchIndex):
+        def _apply(self, batch):
+            with self.write_lock:
+                release.wait(5)
+            super()._apply(batch)
+    
+    stuck = StuckIndex(tempfile.mkdtemp(), flush_interval=0.01)
+    stuck.conversations_saved({"stuck": [message("卡住的写入", 1.0)]})
+    start_time = time.time()
+    assert not stuck.close(timeout=0.1), "写入未完成时关闭应返回False"
+    assert time.time() - start_time < 1, "关闭时等待过久"
+    release.set()
+    stuck.worker.join(5)
+    assert not stuck.worker.is_alive(), "后台线程未退出"
+    print("✓ 关闭超时成功")
+    
+    print("\n所有测试完成！")
+
+# 测试各存储后端的写入通知
+def test_storage_observers():
+    print("开始测试存储写入通知...")
+    backends = (
+        ("log", lambda storage_dir: LogStorage(storage_dir)),
+        ("sqlite", lambda storage_dir: SQLiteStorage(storage_dir)),
+        ("tiered", lambda storage_dir: TieredStorage(SQLiteStorage(storage_dir), storage_dir))
+    )
+    for name, create in backends:
+        storage_dir = tempfile.mkdtemp()
+        storage = create(storage_dir)
+        index = SearchIndex(storage_dir, flush_interval=0.01)
+        index.attach(storage)
+        storage.save_conversation("s1", [message("订单查询", 1.0)])
+        storage.save_message("s2", "user", "订单取消")
+        storage.import_conversations({"s3": {"messages": [message("订单退货", 1.0)], "last_updated": 0}})
+        index.flush()
+        assert index.search("订单")["total"] == 3, f"{name} 后端未通知写入"
+        if name == "tiered":
+            storage.archive(idle_seconds=-1)
+            index.flush()
+            assert index.search("订单")["total"] == 3, "归档后的会话应仍可搜索"
+        assert storage.clean_old_conversations(days=1) == 1
+        storage.delete_conversation("s1")
+        index.flush()
+        assert sessions_of(index.search("订单")) == ["s2"], f"{name} 后端未通知删除"
+        index.close()
+        storage.close()
+        print(f"✓ {name} 后端写入通知正确")
+    
+    print("\n所有测试完成！")
+
+# 测试搜索接口
+def test_search_endpoint():
+    print("开始测试搜索接口...")
+    import app as chat_app
+    client = chat_app.app.test_client()
+    response = client.get('/api/search?q=天气')
+    assert response.status_code == 404, "未启用全文搜索时应返回404"
+    
+    storage_dir = tempfile.mkdtemp()
+    index = SearchIndex(storage_dir, flush_interval=0.01)
+    index.conversations_saved({"endpoint_session": [message("接口搜索测试", 1.0)]})
+    index.flush()
+    chat_app.message_manager.search_index = index
+    try:
+        assert client.get('/api/search').status_code == 400, "缺少关键词应返回400"
+        assert client.get('/api/search?q=搜索&limit=x').status_code == 400, "参数错误应返回400"
+        data = client.get('/api/search?q=搜索&limit=5').json
+        assert data["success"] and data["total"] == 1 and data["limit"] == 5, "搜索接口返回不正确"
+        assert data["results"][0]["session_id"] == "endpoint_session"
+        assert client.get('/api/search?q=搜索&session_id=other').json["total"] == 0, "会话过滤失败"
+    finally:
+        chat_app.message_manager.search_index = None
+        index.close()
+    print("✓ 搜索接口正确")
+    
+    print("\n所有测试完成！")
+
+if __name__ == "__main__":
+    test_tokenize()
+    test_search_index()
+    test_storage_observers()
+    test_search_endpoint()
@@ -0,0 +1,533 @@
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+from config import PERSIST_CONFIG, STORAGE_CONFIG
+from data_storage import DataStorage, create_storage, iter_json_object, next_message_cursor
+from log_storage import LogStorage
+from sqlite_storage import SQLiteStorage
+from tiered_storage import TieredStorage
+from write_behind import WriteBehindQueue
+
+# 测试追加日志存储后端
+def test_log_storage():
+    print("开始测试追加日志存储后端...")
+    storage_dir = tempfile.mkdtemp()
+    storage = LogStorage(storage_dir, segment_max_bytes=512)
+
+    # 测试1: 保存与加载
+    print("\n1. 测试保存与加载...")
+    storage.save_conversation("s1", [{"role": "user", "content": "你好", "timestamp": 1.0}])
+    storage.save_message("s1", "assistant", "你好！有什么可以帮你？")
+    storage.save_message("s2", "user", "天气怎么样？")
+    conversation = storage.load_conversation("s1")
+    assert [m["content"] for m in conversation["messages"]] == ["你好", "你好！有什么可以帮你？"], "会话加载失败"
+    assert storage.get_conversation_count() == 2, "会话数量不正确"
+    print("✓ 保存与加载成功")
+
+    # 测试2: 删除与清理
+    print("\n2. 测试删除与清理...")
+    assert storage.delete_conversation("s2"), "会话删除失败"
+    assert not storage.delete_conversation("s2"), "重复删除应返回False"
+    assert storage.clean_old_conversations(days=0) == 1, "旧会话清理失败"
+    assert storage.get_conversation_count() == 0, "清理后会话数量不正确"
+    print("✓ 删除与清理成功")
+
+    # 测试3: 分段与压缩
+    print("\n3. 测试分段与压缩...")
+    for i in range(50):
+        storage.save_message(f"session_{i % 5}", "user", f"第{i}条消息")
+    assert len(storage.segments) > 2, "日志未按大小分段"
+    storage.compact()
+    assert len(storage.segments) <= 2, "日志压缩失败"
+    for i in range(5):
+        assert len(storage.load_conversation(f"session_{i}")["messages"]) == 10, "压缩后数据丢失"
+    print("✓ 分段与压缩成功")
+
+    # 测试4: 崩溃恢复
+    print("\n4. 测试崩溃恢复...")
+    storage.save_message("session_0", "assistant", "最后一条")
+    storage.close()
+    with open(os.path.join(storage.log_dir, f"segment_{storage.active_segment:06d}.jsonl"), 'ab') as f:
+        f.write(b'{"op": "append", "session_id": "session_0", "mess')
+
+    recovered = LogStorage(storage_dir, segment_max_bytes=512)
+    messages = recovered.load_conversation("session_0")["messages"]
+    assert len(messages) == 11, "恢复后消息数量不正确"
+    assert messages[-1]["content"] == "最后一条", "恢复后消息内容不正确"
+    recovered.save_message("session_0", "user", "恢复后继续写入")
+    assert len(recovered.load_conversation("session_0")["messages"]) == 12, "恢复后写入失败"
+    recovered.close()
+    print("✓ 崩溃恢复成功")
+
+    print("\n所有测试完成！")
+
+# 测试SQLite存储后端
+def test_sqlite_storage():
+    print("开始测试SQLite存储后端...")
+    storage_dir = tempfile.mkdtemp()
+    storage = SQLiteStorage(storage_dir, pool_size=2)
+
+    # 测试1: 保存与加载
+    print("\n1. 测试保存与加载...")
+    storage.save_conversation("s1", [{"role": "user", "content": "你好", "timestamp": 1.0}])
+    storage.save_message("s1", "assistant", "你好！有什么可以帮你？")
+    conversation = storage.load_conversation("s1")
+    assert [m["content"] for m in conversation["messages"]] == ["你好", "你好！有什么可以帮你？"], "会话加载失败"
+    assert storage.load_conversation("missing")["messages"] == [], "不存在的会话应返回空历史"
+    print("✓ 保存与加载成功")
+
+    # 测试2: 多线程并发写入
+    print("\n2. 测试多线程并发写入...")
+    def worker(n):
+        for i in range(20):
+            storage.save_message(f"thread_{n}", "user", f"消息{i}")
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert storage.created_connections <= 2, "连接池大小超出限制"
+    assert all(len(storage.load_conversation(f"thread_{n}")["messages"]) == 20 for n in range(4)), "并发写入丢失消息"
+    print("✓ 多线程并发写入成功")
+
+    # 测试3: 导入、删除与清理
+    print("\n3. 测试导入、删除与清理...")
+    storage.import_conversations({"old": {"messages": [], "last_updated": 0, "updated_at": "1970-01-01T00:00:00"}})
+    assert storage.get_conversation_count() == 6, "会话数量不正确"
+    assert storage.clean_old_conversations(days=7) == 1, "旧会话清理失败"
+    assert storage.delete_conversation("s1"), "会话删除失败"
+    assert storage.get_conversation_count() == 4, "清理后会话数量不正确"
+    storage.close()
+    print("✓ 导入、删除与清理成功")
+
+    # 测试4: 建立连接失败不占用连接池名额
+    print("\n4. 测试建立连接失败...")
+    failures = []
+
+    class FlakyStorage(SQLiteStorage):
+        def _create_connection(self):
+            if len(failures) < 3 and self.created_connections:
+                failures.append(1)
+                raise sqlite3.OperationalError("unable to open database file")
+            return super()._create_connection()
+
+    storage = FlakyStorage(tempfile.mkdtemp(), pool_size=2)
+    with storage.connection():
+        for _ in range(3):
+            try:
+                with storage.connection():
+                    pass
+                assert False, "建立连接失败时应抛出异常"
+            except sqlite3.OperationalError:
+                pass
+        assert storage.created_connections == 1, "失败的连接不应占用名额"
+        with storage.connection():
+            assert storage.created_connections == 2, "失败后应能继续建立连接"
+    storage.close()
+    print("✓ 建立连接失败后连接池仍可用")
+
+    print("\n所有测试完成！")
+
+# 测试写回队列
+def test_write_behind_queue():
+    print("开始测试写回队列...")
+    batches = []
+
+    class RecordingStorage(DataStorage):
+        def save_conversations(self, conversations):
+            batches.append(set(conversations))
+            super().save_conversations(conversations)
+
+    storage = RecordingStorage(tempfile.mkdtemp())
+    write_queue = WriteBehindQueue(storage, flush_interval=60, batch_size=1000, max_pending=10)
+
+    # 测试1: 同一会话的多次写入合并为一次
+    print("\n1. 测试会话合并与批量写入...")
+    for i in range(5):
+        write_queue.put("s1", [{"role": "user", "content": f"消息{i}"}] * (i + 1))
+    write_queue.put("s2", [{"role": "user", "content": "你好"}])
+    found, messages = write_queue.lookup("s1")
+    assert found and len(messages) == 5, "未落盘的数据应可读取"
+    assert storage.get_conversation_count() == 0, "写回模式不应同步写入"
+    assert write_queue.flush(timeout=5), "flush超时"
+    assert batches == [{"s1", "s2"}], "脏会话未合并为一个批次"
+    assert len(storage.load_conversation("s1")["messages"]) == 5, "合并后的快照不正确"
+    print("✓ 会话合并与批量写入成功")
+
+    # 测试2: 队列满时背压
+    print("\n2. 测试背压...")
+    for i in range(10):
+        write_queue.put(f"bp_{i}", [])
+    blocked = threading.Thread(target=write_queue.put, args=("bp_extra", []))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive(), "队列已满时写入方应阻塞"
+    write_queue.flush(timeout=5)
+    blocked.join(5)
+    assert not blocked.is_alive(), "写入后应解除阻塞"
+    print("✓ 背压成功")
+
+    # 测试3: 删除与关闭
+    print("\n3. 测试删除与关闭...")
+    write_queue.delete("s1")
+    assert write_queue.lookup("s1") == (True, None), "待删除的会话应返回None"
+    write_queue.close(timeout=5)
+    assert storage.load_conversation("s1")["messages"] == [], "关闭时未写入删除操作"
+    assert storage.get_conversation_count() == 12, "关闭时未写入剩余数据"
+    print("✓ 删除与关闭成功")
+
+    # 测试4: 存储持续失败时关闭不会无限重试
+    print("\n4. 测试存储失败时关闭...")
+    attempts = []
+
+    class FailingStorage(DataStorage):
+        def save_conversations(self, conversations):
+            attempts.append(set(conversations))
+            raise IOError("磁盘不可用")
+
+    write_queue = WriteBehindQueue(FailingStorage(tempfile.mkdtemp()), flush_interval=0.05, close_retries=2)
+    write_queue.put("s1", [{"role": "user", "content": "你好"}])
+    start_time = time.time()
+    assert write_queue.close(timeout=5), "存储持续失败时关闭应在有限次重试后结束"
+    assert time.time() - start_time < 2 and not write_queue.worker.is_alive(), "关闭耗时过长"
+    assert write_queue.lookup("s1") == (False, None), "放弃的数据应从队列中移除"
+    print(f"✓ 写入尝试 {len(attempts)} 次后放弃")
+
+    # 测试5: 因背压等待的写入方在关闭后改为同步写入
+    print("\n5. 测试关闭时等待中的写入方...")
+    storage = DataStorage(tempfile.mkdtemp())
+    write_queue = WriteBehindQueue(storage, flush_interval=60, max_pending=1)
+    write_queue.put("s1", [])
+    blocked = threading.Thread(target=write_queue.put, args=("s2", [{"role": "user", "content": "你好"}]))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive(), "队列已满时写入方应阻塞"
+    assert write_queue.close(timeout=5), "关闭超时"
+    blocked.join(5)
+    assert not blocked.is_alive(), "关闭后写入方应解除阻塞"
+    assert len(storage.load_conversation("s2")["messages"]) == 1, "关闭时等待中的写入丢失"
+    print("✓ 等待中的写入已落盘")
+
+    print("\n所有测试完成！")
+
+# 测试流式导出
+def test_export():
+    print("开始测试流式导出...")
+    conversations = {
+        f"s{i}": [{"role": "user", "content": f"第{i}个会话", "timestamp": 1.0},
+                  {"role": "assistant", "content": "回复\n第二行", "timestamp": 2.0}]
+        for i in range(5)
+    }
+
+    # 测试1: 各存储后端的导出格式与过滤
+    print("\n1. 测试导出格式与过滤...")
+    for storage_class in (DataStorage, LogStorage, SQLiteStorage):
+        storage = storage_class(tempfile.mkdtemp())
+        storage.save_conversations(conversations)
+        exported = json.loads(storage.export_conversations("json"))
+        assert {sid: c["messages"] for sid, c in exported.items()} == conversations, "JSON导出内容不正确"
+        lines = b"".join(storage.iter_export("ndjson", session_ids=["s1", "s3", "missing"])).decode('utf-8').splitlines()
+        assert sorted(json.loads(line)["session_id"] for line in lines) == ["s1", "s3"], "按会话ID过滤不正确"
+        assert b"".join(storage.iter_export("json", since=exported["s0"]["last_updated"] + 3600)) == b"{}", "按时间过滤不正确"
+        text = gzip.decompress(b"".join(storage.iter_export("txt", session_ids=["s2"], compress=True))).decode('utf-8')
+        assert text.startswith("=== 会话 s2 ===") and "[assistant] 回复\n第二行" in text, "gzip文本导出不正确"
+        try:
+            storage.iter_export("xml")
+            assert False, "不支持的格式应被拒绝"
+        except ValueError:
+            pass
+        storage.close()
+
+    storage = DataStorage(tempfile.mkdtemp())
+    storage.save_conversations(conversations)
+    expected = json.dumps(storage.load_all_conversations(), ensure_ascii=False, indent=2)
+    assert storage.export_conversations("json") == expected, "JSON导出应与整体序列化一致"
+    assert list(iter_json_object(io.BytesIO(expected.encode('utf-8')), chunk_size=7)) == \
+        list(json.loads(expected).items()), "增量解析结果不正确"
+    print("✓ 导出格式与过滤正确")
+
+    # 测试2: 导出时内存占用不随存储大小增长
+    print("\n2. 测试导出内存占用...")
+    storage.save_conversations({f"big_{i}": [{"role": "user", "content": "长消息" * 300, "timestamp": 1.0}] * 10
+                                for i in range(300)})
+    file_size = os.path.getsize(storage.conversations_file)
+    tracemalloc.start()
+    exported_size = sum(len(chunk) for chunk in storage.iter_export("ndjson", compress=True))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert exported_size > 0 and peak < file_size / 5, f"导出峰值内存过高: {peak} / {file_size}"
+    print(f"✓ 存储文件 {file_size} 字节，导出峰值内存 {peak} 字节")
+
+    print("\n所有测试完成！")
+
+# 测试 /api/export 接口
+def test_export_endpoint():
+    print("开始测试导出接口...")
+    import app as chat_app
+    client = chat_app.app.test_client()
+    chat_app.message_manager.add_message("test_export_session", "user", "导出测试")
+
+    print("\n1. 测试分块导出...")
+    response = client.get('/api/export?format=ndjson&gzip=1&session_id=test_export_session')
+    assert response.is_streamed and response.headers["Content-Type"] == "application/gzip", "应以流式gzip返回"
+    records = [json.loads(line) for line in gzip.decompress(response.get_data()).decode('utf-8').splitlines()]
+    assert [r["session_id"] for r in records] == ["test_export_session"], "导出会话不正确"
+    assert records[0]["messages"][-1]["content"] == "导出测试", "导出内容不正确"
+    assert client.get('/api/export?format=xml').status_code == 400, "不支持的格式应返回400"
+    assert client.get('/api/export?since=abc').status_code == 400, "非法时间应返回400"
+    chat_app.message_manager.delete_session("test_export_session")
+    print("✓ 分块导出成功")
+
+    print("\n2. 测试存储持续失败时导出与列表...")
+
+    class FailingStorage(DataStorage):
+        def save_conversations(self, conversations):
+            raise IOError("磁盘不可用")
+
+    manager = chat_app.message_manager
+    write_queue = WriteBehindQueue(FailingStorage(tempfile.mkdtemp()), flush_interval=0.05, close_retries=1)
+    write_queue.put("failing", [])
+    original_queue, original_timeout = manager.write_queue, PERSIST_CONFIG["flush_timeout"]
+    manager.write_queue, PERSIST_CONFIG["flush_timeout"] = write_queue, 0.2
+    try:
+        start_time = time.time()
+        assert client.get('/api/export').status_code == 503, "未落盘数据写入超时应返回503"
+        assert client.get('/api/sessions').status_code == 503, "未落盘数据写入超时应返回503"
+        assert time.time() - start_time < 2, "请求不应无限等待写入"
+    finally:
+        manager.write_queue, PERSIST_CONFIG["flush_timeout"] = original_queue, original_timeout
+        write_queue.close(timeout=5)
+    print("✓ 写入超时返回503")
+
+    print("\n所有测试完成！")
+
+def stress_worker(backend, storage_dir, worker, sessions, turns):
+    """模拟一个worker进程：轮流向所有会话追加消息"""
+    STORAGE_CONFIG.update(backend=backend, storage_dir=storage_dir, multi_process=True)
+    from message_manager import MessageManager
+    manager = MessageManager()
+    manager.max_history = sessions * turns * 100
+    manager.token_budget = 0
+    for turn in range(turns):
+        for session in range(sessions):
+            manager.add_message(f"stress_{session}", "user", f"{worker}-{turn}")
+    manager.close()
+
+# 测试多进程并发写入
+def test_multi_process():
+    print("开始测试多进程并发写入...")
+    workers, sessions, turns = 4, 3, 15
+    spawn = multiprocessing.get_context("spawn")
+
+    for backend in ("json", "sqlite"):
+        print(f"\n测试 {backend} 存储后端...")
+        storage_dir = tempfile.mkdtemp()
+        processes = [spawn.Process(target=stress_worker, args=(backend, storage_dir, n, sessions, turns))
+                     for n in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(60)
+            assert process.exitcode == 0, "worker进程异常退出"
+        storage = create_storage(backend, storage_dir)
+        expected = sorted(f"{n}-{turn}" for n in range(workers) for turn in range(turns))
+        for session in range(sessions):
+            messages = storage.load_conversation(f"stress_{session}")["messages"]
+            assert sorted(m["content"] for m in messages) == expected, "并发写入丢失了消息"
+        storage.close()
+        print(f"✓ {workers} 个进程写入 {workers * sessions * turns} 条消息，无丢失")
+
+    try:
+        STORAGE_CONFIG["multi_process"] = True
+        create_storage("log", tempfile.mkdtemp())
+        assert False, "log 后端不应用于多进程部署"
+    except ValueError:
+        pass
+    finally:
+        STORAGE_CONFIG["multi_process"] = False
+
+    print("\n所有测试完成！")
+
+# 测试分层存储
+def test_tiered_storage():
+    print("开始测试分层存储...")
+    for compression in ("gzip", "lzma"):
+        print(f"\n测试 {compression} 归档...")
+        storage_dir = tempfile.mkdtemp()
+        storage = TieredStorage(LogStorage(storage_dir), storage_dir, compression=compression, block_size=512)
+        for i in range(20):
+            storage.save_message(f"idle_{i}", "user", f"旧消息{i}" * 10)
+        storage.save_message("active", "user", "活跃会话")
+
+        # 测试1: 归档空闲会话
+        assert storage.archive(idle_seconds=-1) == 21, "归档的会话数不正确"
+        storage.save_message("fresh", "user", "新会话")
+        assert storage.archive(idle_seconds=3600) == 0, "未到时间的会话不应归档"
+        stats = storage.archive_stats()
+        assert stats["segments"] == 1 and stats["archived_sessions"] == 21, "归档统计不正确"
+        assert storage.hot.get_conversation_count() == 1, "归档后热存储中仍有旧会话"
+        assert storage.get_conversation_count() == 22, "会话数量不正确"
+        print("✓ 空闲会话归档成功")
+
+        # 测试2: 按需读取、恢复写入与删除
+        assert storage.load_conversation("idle_3")["messages"][0]["content"] == "旧消息3" * 10, "归档会话读取失败"
+        assert storage.archived_loads == 1
+        storage.save_message("idle_5", "user", "继续对话")
+        assert len(storage.load_conversation("idle_5")["messages"]) == 2, "归档会话恢复写入失败"
+        assert storage.archive_stats()["archived_sessions"] == 20, "恢复的会话应从归档中移除"
+        assert storage.delete_conversation("idle_7"), "归档会话删除失败"
+        assert storage.load_conversation("idle_7")["messages"] == [], "删除的会话仍可读取"
+        assert storage.delete_conversations(["idle_8", "fresh", "missing"]) == 2, "批量删除数量不正确"
+        assert len(dict(storage.iter_conversations())) == 19, "遍历的会话数不正确"
+        print("✓ 按需读取、恢复写入与删除成功")
+
+        # 测试3: 重启后加载索引与墓碑，清理遗留的段文件
+        storage.close()
+        with open(os.path.join(storage_dir, "archive", "segment_000009.gz"), 'wb') as f:
+            f.write(b"partial")
+        storage = TieredStorage(LogStorage(storage_dir), storage_dir, compression=compression, block_size=512)
+        assert not os.path.exists(os.path.join(storage_dir, "archive", "segment_000009.gz")), "未清理遗留的段文件"
+        assert storage.load_conversation("idle_7")["messages"] == [], "重启后删除的会话又出现了"
+        assert storage.load_conversation("idle_9")["messages"][0]["content"] == "旧消息9" * 10, "重启后归档会话读取失败"
+        assert storage.get_conversation_count() == 19, "重启后会话数量不正确"
+        # 模拟归档提交后、从热存储删除前中断：同一会话同时在两层中
+        storage.hot.save_conversation("idle_9", [{"role": "user", "content": "旧消息9", "timestamp": 1.0}])
+        storage.close()
+        storage = TieredStorage(LogStorage(storage_dir), storage_dir, compression=compression, block_size=512)
+        assert storage.get_conversation_count() == 19, "两层中的同一会话应只计一次"
+        storage.hot.delete_conversation("idle_9")
+        assert storage.clean_old_conversations(days=0) == 19, "清理未覆盖归档会话"
+        assert storage.get_conversation_count() == 0
+        storage.close()
+        print("✓ 重启恢复与清理成功")
+
+    # 测试4: 归档期间被写入的会话留在热存储中
+    print("\n测试归档期间的写入...")
+    storage_dir = tempfile.mkdtemp()
+    storage = TieredStorage(DataStorage(storage_dir), storage_dir)
+    for i in range(3):
+        storage.save_message(f"s{i}", "user", "你好")
+    hot_iter = storage.hot.iter_conversations
+
+    def iter_and_write(*args, **kwargs):
+        for item in hot_iter(*args, **kwargs):
+            storage.save_message("s1", "assistant", "归档期间的回复")
+            yield item
+
+    storage.hot.iter_conversations = iter_and_write
+    assert storage.archive(idle_seconds=-1) == 2, "归档期间被写入的会话不应归档"
+    del storage.hot.iter_conversations
+    assert len(storage.hot.load_conversation("s1")["messages"]) > 1, "归档期间的写入丢失"
+    assert sorted(storage.index) == ["s0", "s2"]
+    storage.close()
+    print("✓ 归档期间的写入未丢失")
+
+    print("\n所有测试完成！")
+
+# 测试分页读取历史消息与会话列表
+def test_paginated_history():
+    print("开始测试分页读取历史...")
+    backends = (
+        ("json", lambda storage_dir: DataStorage(storage_dir)),
+        ("log", lambda storage_dir: LogStorage(storage_dir)),
+        ("sqlite", lambda storage_dir: SQLiteStorage(storage_dir)),
+        ("tiered", lambda storage_dir: TieredStorage(SQLiteStorage(storage_dir), storage_dir))
+    )
+    for name, create in backends:
+        storage_dir = tempfile.mkdtemp()
+        storage = create(storage_dir)
+        conversations = {"long": {"messages": [{"role": "user", "content": f"消息{i}", "timestamp": float(i)}
+                                               for i in range(1, 26)], "last_updated": 50.0}}
+        for i in range(5):
+            conversations[f"s_{i}"] = {"messages": [], "last_updated": 100.0 + i}
+        conversations["t_a"] = conversations["t_b"] = {"messages": [], "last_updated": 102.0}
+        conversations["same"] = {"messages": [{"role": "user", "content": f"同时{i}", "timestamp": 7.0 if 1 <= i <= 6 else float(i)}
+                                              for i in range(9)], "last_updated": 10.0}
+        storage.import_conversations(conversations)
+        storage.save_message("long", "assistant", "最新")
+        if name == "tiered":
+            # 只有 long 留在热存储中，其余会话从归档索引读取
+            assert storage.archive(idle_seconds=3600) == 8
+
+        # 测试1: 按时间倒序分页读取消息
+        page = list(storage.iter_messages("long", limit=10))
+        assert [m["content"] for m in page] == ["最新"] + [f"消息{i}" for i in range(25, 16, -1)], f"{name} 第一页不正确"
+        page = list(storage.iter_messages("long", before=page[-1]["timestamp"], limit=10))
+        assert [m["content"] for m in page] == [f"消息{i}" for i in range(16, 6, -1)], f"{name} 第二页不正确"
+        assert [m["content"] for m in storage.iter_messages("long", before=3.0)] == ["消息2", "消息1"]
+        assert list(storage.iter_messages("missing", limit=5)) == [], f"{name} 不存在的会话应返回空"
+        # 时间戳相同的消息跨页时不重复、不遗漏
+        contents, before = [], None
+        while True:
+            page = list(storage.iter_messages("same", before=before, limit=4))
+            contents.extend(m["content"] for m in page)
+            if len(page) < 4:
+                break
+            before = next_message_cursor(page, before)
+        assert contents == [f"同时{i}" for i in range(8, -1, -1)], f"{name} 相同时间戳分页不正确: {contents}"
+
+        # 测试2: 按最后更新时间倒序分页列出会话，更新时间相同时按会话ID排序
+        listed, before = [], None
+        while True:
+            sessions = storage.list_sessions(before, limit=3)
+            listed.extend(summary["session_id"] for summary in sessions)
+            if len(sessions) < 3:
+                break
+            before = (sessions[-1]["last_updated"], sessions[-1]["session_id"])
+        assert listed == ["long", "s_4", "s_3", "t_b", "t_a", "s_2", "s_1", "s_0", "same"], f"{name} 会话列表不正确: {listed}"
+        storage.close()
+        print(f"✓ {name} 后端分页读取正确")
+
+    print("\n所有测试完成！")
+
+# 测试历史消息与会话列表接口
+def test_history_endpoint():
+    print("开始测试历史消息接口...")
+    import app as chat_app
+    client = chat_app.app.test_client()
+    session_id = "test_history_session"
+    chat_app.message_manager.delete_session(session_id)
+    for i in range(5):
+        chat_app.message_manager.add_message(session_id, "user" if i % 2 == 0 else "assistant", f"历史{i}")
+
+    print("\n1. 测试历史消息分页...")
+    contents, before = [], ""
+    while before is not None:
+        data = client.get(f'/api/history?session_id={session_id}&limit=2&before={before}').json
+        assert data["success"] and len(data["messages"]) <= 2, "分页数量不正确"
+        contents = [m["content"] for m in data["messages"]] + contents
+        before = data["next_before"]
+    assert contents == [f"历史{i}" for i in range(5)], "分页读取的历史不完整"
+    assert client.get('/api/history').status_code == 400, "缺少会话ID应返回400"
+    assert client.get(f'/api/history?session_id={session_id}&before=x').status_code == 400, "参数错误应返回400"
+    print("✓ 历史消息分页成功")
+
+    print("\n2. 测试会话列表分页...")
+    data = client.get('/api/sessions?limit=1').json
+    assert data["success"] and data["sessions"][0]["session_id"] == session_id, "最近更新的会话应排在最前"
+    if data["next_cursor"]:
+        next_page = client.get(f'/api/sessions?limit=1&cursor={data["next_cursor"]}').json
+        assert next_page["sessions"][0]["session_id"] != session_id, "下一页不应重复上一页的会话"
+    assert client.get('/api/sessions?cursor=abc').status_code == 400, "无效游标应返回400"
+    chat_app.message_manager.delete_session(session_id)
+    print("✓ 会话列表分页成功")
+
+    print("\n所有测试完成！")
+
+if __name__ == "__main__":
+    test_log_storage()
+    test_sqlite_storage()
+    test_write_behind_queue()
+    test_export()
+    test_export_endpoint()
+    test_multi_process()
+    test_tiered_storage()
+    test_paginated_history()
+    test_history_endpoint()
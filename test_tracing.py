@@ -0,0 +1,137 @@
+import os
+import pstats
+import tempfile
+import time
+from config import TRACE_CONFIG
+from profiling import Profiler, PROFILER
+from tracing import Tracer, TRACER, span, mark
+from test_model_service import EchoConnection
+
+# 测试链路追踪
+def test_tracing():
+    print("开始测试链路追踪...")
+    tracer = Tracer(slow_threshold=0.01, buffer_size=2)
+    
+    # 测试1: 同一请求的span嵌套记录
+    print("\n1. 测试span记录...")
+    with span("no_trace"):
+        pass
+    trace = tracer.begin("chat", "req-1")
+    with span("outer"):
+        with span("inner"):
+            time.sleep(0.02)
+        mark("first_token")
+    tracer.end(trace)
+    spans = {s["name"]: s for s in tracer.find("req-1")["spans"]}
+    assert set(spans) == {"outer", "inner", "first_token"}, "span记录不完整"
+    assert spans["outer"]["depth"] == 0 and spans["inner"]["depth"] == 1, "span嵌套深度不正确"
+    assert spans["inner"]["duration"] >= 0.02, "span耗时不正确"
+    print("✓ span记录成功")
+    
+    # 测试2: 环形缓冲区只保留最近的慢请求
+    print("\n2. 测试慢请求缓冲区...")
+    tracer.end(tracer.begin("chat", "fast"))
+    for n in range(3):
+        trace = tracer.begin("chat", f"slow-{n}")
+        time.sleep(0.011)
+        tracer.end(trace)
+    assert [t["request_id"] for t in tracer.recent_slow()] == ["slow-2", "slow-1"], "慢请求缓冲区不正确"
+    assert tracer.stats()["finished"] == 5, "请求计数不正确"
+    print("✓ 慢请求缓冲区正确")
+    
+    print("\n所有测试完成！")
+
+# 测试聊天请求的链路与管理接口
+def test_chat_trace():
+    print("开始测试聊天链路...")
+    import app as chat_app
+    chat_app.model_service.connection_class = EchoConnection
+    client = chat_app.app.test_client()
+    threshold = TRACER.slow_threshold
+    TRACER.slow_threshold = 0
+    
+    print("\n1. 测试请求链路...")
+    try:
+        response = client.post('/api/chat', json={"session_id": "test_trace_session", "message": "追踪"},
+                               headers={"X-Request-ID": "trace-test-1"})
+        assert response.headers["X-Request-ID"] == "trace-test-1", "响应未返回请求ID"
+        response.close()
+    finally:
+        TRACER.slow_threshold = threshold
+    trace = client.get('/api/admin/traces?request_id=trace-test-1').json["trace"]
+    names = {s["name"] for s in trace["spans"]}
+    for name in ("message_manager.add_message", "storage.save", "message_manager.get_context",
+                 "model.chat", "upstream.acquire", "upstream.send", "upstream.frames", "upstream.first_token"):
+        assert name in names, f"链路缺少阶段: {name}"
+    assert trace["attributes"]["session_id"] == "test_trace_session", "未记录会话ID"
+    client.post('/api/clear_context', json={"session_id": "test_trace_session"})
+    print("✓ 请求链路完整")
+    
+    print("\n2. 测试管理令牌...")
+    TRACE_CONFIG["admin_token"] = "secret"
+    try:
+        assert client.get('/api/admin/traces').status_code == 403, "缺少令牌时应拒绝访问"
+        assert client.get('/api/admin/traces', headers={"X-Admin-Token": "secret"}).status_code == 200
+    finally:
+        TRACE_CONFIG["admin_token"] = None
+    remote = {"REMOTE_ADDR": "10.0.0.8"}
+    for path in ('/api/admin/traces', '/api/export', '/api/search?q=追踪', '/api/sessions'):
+        assert client.get(path, environ_base=remote).status_code == 403, f"未配置令牌时 {path} 不应对外开放"
+    assert client.get('/api/admin/traces', headers={"X-Forwarded-For": "10.0.0.8"}).status_code == 403, \
+        "经反向代理转发的请求不应视为本机"
+    assert client.post('/api/admin/profile', json={"seconds": 1}, environ_base=remote).status_code == 403
+    print("✓ 管理令牌校验成功")
+    
+    print("\n3. 测试cProfile采集...")
+    output_dir = PROFILER.output_dir
+    PROFILER.output_dir = tempfile.mkdtemp()
+    try:
+        assert client.post('/api/admin/profile', json={"mode": "cprofile", "seconds": 0.5}).json["success"]
+        assert client.post('/api/admin/profile', json={"seconds": 1}).status_code == 409, "不应同时进行两次采集"
+        client.post('/api/chat', json={"session_id": "test_profile_session", "message": "采集"}).close()
+        client.post('/api/clear_context', json={"session_id": "test_profile_session"})
+        deadline = time.time() + 5
+        while client.get('/api/admin/profile').json["active"] and time.time() < deadline:
+            time.sleep(0.05)
+        last = client.get('/api/admin/profile').json["last"]
+        assert last["requests"] >= 1 and os.path.exists(last["path"]), "采集文件未生成"
+        assert pstats.Stats(last["path"]).total_calls > 0, "采集文件内容为空"
+    finally:
+        PROFILER.output_dir = output_dir
+    print("✓ cProfile采集成功")
+    
+    print("\n所有测试完成！")
+
+# 测试采样模式
+def test_sampling_profile():
+    print("开始测试采样采集...")
+    profiler = Profiler(tempfile.mkdtemp(), max_seconds=5, sample_interval=0.001)
+    
+    def busy_loop():
+        deadline = time.time() + 0.3
+        while time.time() < deadline:
+            pass
+    
+    capture = profiler.start("sample", 0.2)
+    busy_loop()
+    time.sleep(0.1)
+    with open(capture["path"], encoding='utf-8') as f:
+        stacks = f.read()
+    assert "busy_loop" in stacks, "采样结果缺少调用栈"
+    assert profiler.status()["last"]["samples"] > 0, "采样次数为0"
+    try:
+        profiler.start("sample", 10)
+        profiler.stop()
+        time.sleep(0.05)
+        profiler.start("unknown", 1)
+        assert False, "未知模式应被拒绝"
+    except ValueError:
+        pass
+    print("✓ 采样采集成功")
+    
+    print("\n所有测试完成！")
+
+if __name__ == "__main__":
+    test_tracing()
+    test_chat_trace()
+    test_sampling_profile()
@@ -0,0 +1,394 @@
+import json
+import lzma
+import os
+import re
+import threading
+import time
+import zlib
+from datetime import datetime
+from data_storage import DataStorage, conversation_matches, newest_messages, newest_sessions
+from config import STORAGE_CONFIG
+from metrics import STORAGE_BYTES
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+ARCHIVE_PATTERN = re.compile(r"^segment_(\d{6})\.idx$")
+COMPRESSIONS = {"gzip": ".gz", "lzma": ".xz"}
+
+
+def compress_block(data, compression):
+    """压缩一个数据块，每个块是独立的 gzip 成员 / xz 流，拼接后的段文件仍可用 gzip / xz 工具直接解压"""
+    if compression == "lzma":
+        return lzma.compress(data, format=lzma.FORMAT_XZ, preset=6)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_block(data, compression):
+    if compression == "lzma":
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+    return zlib.decompress(data, zlib.MAX_WBITS | 16)
+
+
+class TieredStorage(DataStorage):
+    """分层存储：活跃会话保存在热存储（json / log / sqlite 后端）中，长时间未更新的会话归档到压缩段
+    
+    归档段写入后不再修改，由多个独立压缩的数据块组成，每个块包含若干会话（JSONL）；
+    同名的 .idx 索引文件记录每个会话所在块的偏移、长度和最后更新时间，启动时只加载索引。
+    读取时热存储优先，不存在时按索引解压对应的块（只解压一个块），会话再次写入时回到热存储。
+    会话再次写入、删除或清理时为其归档副本追加墓碑记录，段文件本身保持不变，
+    因此同一会话除归档提交的瞬间外只存在于一层中。
+    """
+    
+    def __init__(self, hot, storage_dir="data", archive_after=None, archive_interval=None,
+                 compression=None, block_size=None):
+        self.hot = hot
+        self.archive_dir = os.path.join(storage_dir, "archive")
+        self.archive_after = archive_after or STORAGE_CONFIG["archive_after"]
+        self.archive_interval = archive_interval or STORAGE_CONFIG["archive_interval"]
+        self.compression = compression or STORAGE_CONFIG["archive_compression"]
+        self.block_size = block_size or STORAGE_CONFIG["archive_block_size"]
+        if self.compression not in COMPRESSIONS:
+            raise ValueError(f"不支持的归档压缩格式: {self.compression}")
+        
+        # 写入操作与归档的提交阶段互斥
+        self.lock = threading.RLock()
+        self.archive_lock = threading.Lock()
+        # session_id -> (段号, 块偏移, 块长度, 最后更新时间)
+        self.index = {}
+        # 段号 -> 压缩格式
+        self.segments = {}
+        # 归档进行期间被写入的会话，提交时不从热存储删除
+        self.dirty = None
+        # 同时留在热存储中的归档会话（归档提交后、从热存储删除前中断），计数时去重
+        self.overlap = set()
+        self.archived_loads = 0
+        
+        super().__init__(storage_dir)
+        # 热存储的写入直接通知本存储的观察者
+        self.hot.observers = self.observers
+        
+        # 启动后台归档线程
+        self._stop_event = threading.Event()
+        self._archiver = threading.Thread(target=self._archive_loop, daemon=True)
+        self._archiver.start()
+    
+    def init_storage(self):
+        """加载所有归档段的索引并应用墓碑记录"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        
+        segment_ids = []
+        for name in os.listdir(self.archive_dir):
+            match = ARCHIVE_PATTERN.match(name)
+            if match:
+                segment_ids.append(int(match.group(1)))
+        for segment_id in sorted(segment_ids):
+            with open(self._index_path(segment_id), 'rb') as f:
+                data = json.loads(f.read())
+            self.segments[segment_id] = data["compression"]
+            for session_id, (offset, length, last_updated) in data["sessions"].items():
+                # 同一会话被多次归档时以最新的段为准
+                self.index[session_id] = (segment_id, offset, length, last_updated)
+        
+        # 清理归档过程中崩溃遗留的、没有索引的段文件
+        for name in os.listdir(self.archive_dir):
+            segment_id = name.split(".")[0][len("segment_"):]
+            if name.startswith("segment_") and not name.endswith(".idx") and int(segment_id) not in self.segments:
+                os.remove(os.path.join(self.archive_dir, name))
+        
+        try:
+            with open(self._tombstone_path(), 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    entry = self.index.get(record["session_id"])
+                    # 墓碑只覆盖写入时已存在的归档，之后重新归档的会话不受影响
+                    if entry is not None and entry[0] <= record["segment"]:
+                        del self.index[record["session_id"]]
+        except FileNotFoundError:
+            pass
+        
+        # 只在启动时扫描一次热存储，之后由归档和墓碑增量维护
+        if self.index:
+            self.overlap = {summary["session_id"] for summary in self.hot.list_sessions()
+                            if summary["session_id"] in self.index}
+    
+    def _segment_path(self, segment_id, compression=None):
+        suffix = COMPRESSIONS[compression or self.segments[segment_id]]
+        return os.path.join(self.archive_dir, f"segment_{segment_id:06d}{suffix}")
+    
+    def _index_path(self, segment_id):
+        return os.path.join(self.archive_dir, f"segment_{segment_id:06d}.idx")
+    
+    def _tombstone_path(self):
+        return os.path.join(self.archive_dir, "tombstones.jsonl")
+    
+    def _read_block(self, segment_id, offset, length):
+        """读取并解压一个数据块，返回其中的 (session_id, 对话数据) 列表"""
+        with open(self._segment_path(segment_id), 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        STORAGE_BYTES.inc(len(data), direction="read")
+        conversations = []
+        for line in decompress_block(data, self.segments[segment_id]).splitlines():
+            record = json.loads(line)
+            conversations.append((record.pop("session_id"), record))
+        return conversations
+    
+    def _load_archived(self, session_id):
+        """从归档段中读取会话，不存在时返回None"""
+        with self.lock:
+            entry = self.index.get(session_id)
+        if entry is None:
+            return None
+        segment_id, offset, length, _ = entry
+        for archived_id, conversation in self._read_block(segment_id, offset, length):
+            if archived_id == session_id:
+                self.archived_loads += 1
+                return conversation
+        return None
+    
+    def _tombstone(self, session_ids):
+        """将会话的归档标记为已删除（需持有 lock）"""
+        records = []
+        for session_id in session_ids:
+            entry = self.index.pop(session_id, None)
+            self.overlap.discard(session_id)
+            if entry is not None:
+                records.append(json.dumps({"session_id": session_id, "segment": entry[0]}, ensure_ascii=False))
+        if records:
+            data = ("\n".join(records) + "\n").encode('utf-8')
+            with open(self._tombstone_path(), 'ab') as f:
+                f.write(data)
+            STORAGE_BYTES.inc(len(data), direction="write")
+        return len(records)
+    
+    def _written(self, session_ids):
+        """会话写入热存储后调用（需持有 lock）：归档中的旧副本标记为删除，归档进行中时记录为脏会话"""
+        self._tombstone([session_id for session_id in session_ids if session_id in self.index])
+        if self.dirty is not None:
+            self.dirty.update(session_ids)
+    
+    def save_conversation(self, session_id, messages):
+        """保存对话历史，写入热存储"""
+        with self.lock:
+            self.hot.save_conversation(session_id, messages)
+            self._written([session_id])
+    
+    def save_conversations(self, conversations):
+        """批量保存多个会话的对话历史"""
+        with self.lock:
+            self.hot.save_conversations(conversations)
+            self._written(conversations)
+    
+    def load_conversation(self, session_id):
+        """加载会话，热存储中没有时透明地从归档读取"""
+        conversation = self.hot.load_conversation(session_id)
+        if conversation["messages"]:
+            return conversation
+        return self._load_archived(session_id) or conversation
+    
+    def load_all_conversations(self):
+        """加载所有对话历史，包括归档的会话"""
+        return dict(self.iter_conversations())
+    
+    def iter_conversations(self, session_ids=None, since=None, until=None):
+        """先遍历热存储，再按段和偏移顺序读取归档会话，每个块只解压一次"""
+        session_ids = set(session_ids) if session_ids is not None else None
+        seen = set()
+        for session_id, conversation in self.hot.iter_conversations(session_ids, since, until):
+            seen.add(session_id)
+            yield session_id, conversation
+        
+        with self.lock:
+            # 按索引中的更新时间过滤，不需要的块不解压
+            pending = sorted(
+                (entry, session_id) for session_id, entry in self.index.items()
+                if session_id not in seen and
+                conversation_matches(session_id, {"last_updated": entry[3]}, session_ids, since, until))
+        block, conversations = None, {}
+        for (segment_id, offset, length, _), session_id in pending:
+            if block != (segment_id, offset):
+                block = (segment_id, offset)
+                conversations = dict(self._read_block(segment_id, offset, length))
+            if session_id in conversations:
+                yield session_id, conversations[session_id]
+    
+    def iter_messages(self, session_id, before=None, limit=None):
+        """分页读取会话消息：归档的会话解压一个块，其余交给热存储"""
+        conversation = self._load_archived(session_id)
+        if conversation is None:
+            yield from self.hot.iter_messages(session_id, before, limit)
+        else:
+            yield from newest_messages(conversation["messages"], before, limit)
+    
+    def list_sessions(self, before=None, limit=None):
+        """合并热存储的一页会话与归档索引中的会话，归档会话只使用索引，不解压"""
+        sessions = self.hot.list_sessions(before, limit)
+        with self.lock:
+            archived = newest_sessions(({
+                "session_id": session_id,
+                "last_updated": entry[3],
+                "updated_at": datetime.fromtimestamp(entry[3]).isoformat()
+            } for session_id, entry in self.index.items()), before, limit)
+        # 归档提交的瞬间同一会话可能同时出现在两层中
+        hot_ids = {summary["session_id"] for summary in sessions}
+        return newest_sessions(sessions + [summary for summary in archived if summary["session_id"] not in hot_ids],
+                               None, limit)
+    
+    def delete_conversation(self, session_id):
+        """删除会话，归档中的副本同时标记为删除"""
+        with self.lock:
+            deleted = self.hot.delete_conversation(session_id)
+            if self._tombstone([session_id]):
+                self._notify("conversations_deleted", [session_id])
+                deleted = True
+            self._written([session_id])
+            return deleted
+    
+    def delete_conversations(self, session_ids):
+        """批量删除多个会话，返回删除的会话数"""
+        session_ids = list(dict.fromkeys(session_ids))
+        with self.lock:
+            archived = [session_id for session_id in session_ids if session_id in self.index]
+            deleted = self.hot.delete_conversations(session_ids) + self._tombstone(archived)
+            if archived:
+                self._notify("conversations_deleted", archived)
+            self._written(session_ids)
+            return deleted
+    
+    def clean_old_conversations(self, days=7):
+        """清理指定天数前的对话历史，包括归档中的会话"""
+        cutoff_time = time.time() - (days * 24 * 60 * 60)
+        with self.lock:
+            cleaned = self.hot.clean_old_conversations(days)
+            self.overlap = {session_id for session_id in self.overlap
+                            if self.hot.load_conversation(session_id)["messages"]}
+            expired = [session_id for session_id, entry in self.index.items() if entry[3] < cutoff_time]
+            if expired:
+                self._notify("conversations_deleted", expired)
+            return cleaned + self._tombstone(expired)
+    
+    def get_conversation_count(self):
+        """获取对话历史数量（热存储与归档中的会话去重后）
+        
+        写入热存储时会移除归档中的副本，但归档提交后、从热存储删除前中断时，同一会话会同时留在两层中，
+        这些会话记录在 overlap 中，计数不需要扫描热存储。
+        """
+        with self.lock:
+            return self.hot.get_conversation_count() + len(self.index) - len(self.overlap)
+    
+    def save_message(self, session_id, role, content):
+        """保存单条消息，归档中的会话先恢复到热存储再追加"""
+        with self.lock:
+            if not self.hot.load_conversation(session_id)["messages"]:
+                archived = self._load_archived(session_id)
+                if archived is not None:
+                    self.hot.save_conversation(session_id, archived["messages"])
+            self.hot.save_message(session_id, role, content)
+            self._written([session_id])
+    
+    def import_conversations(self, conversations):
+        """批量导入对话历史（用于迁移）"""
+        with self.lock:
+            count = self.hot.import_conversations(conversations)
+            self._written(conversations)
+            return count
+    
+    def archive(self, idle_seconds=None):
+        """将超过 idle_seconds（默认 archive_after）未更新的会话写入新的归档段，返回归档的会话数
+        
+        读取热存储、压缩和写段文件都在锁外进行；提交时排除期间被写入的会话，
+        写入索引文件（提交点）后再从热存储中删除。
+        """
+        cutoff = time.time() - (idle_seconds if idle_seconds is not None else self.archive_after)
+        with self.archive_lock:
+            with self.lock:
+                self.dirty = set()
+                segment_id = max(self.segments, default=0) + 1
+            try:
+                path = self._segment_path(segment_id, self.compression)
+                entries = {}
+                with open(path, 'wb') as f:
+                    block, block_sessions, size = [], [], 0
+                    
+                    def write_block():
+                        data = compress_block("".join(block).encode('utf-8'), self.compression)
+                        offset = f.tell()
+                        f.write(data)
+                        for session_id, last_updated in block_sessions:
+                            entries[session_id] = [offset, len(data), last_updated]
+                    
+                    for session_id, conversation in self.hot.iter_conversations(until=cutoff):
+                        line = json.dumps({"session_id": session_id, **conversation}, ensure_ascii=False) + "\n"
+                        block.append(line)
+                        block_sessions.append((session_id, conversation.get("last_updated", 0)))
+                        size += len(line)
+                        if size >= self.block_size:
+                            write_block()
+                            block, block_sessions, size = [], [], 0
+                    if block:
+                        write_block()
+                    f.flush()
+                    os.fsync(f.fileno())
+                    STORAGE_BYTES.inc(f.tell(), direction="write")
+                
+                with self.lock:
+                    for session_id in self.dirty:
+                        entries.pop(session_id, None)
+                    if not entries:
+                        os.remove(path)
+                        return 0
+                    index_data = json.dumps({"compression": self.compression, "sessions": entries},
+                                            ensure_ascii=False).encode('utf-8')
+                    tmp_path = self._index_path(segment_id) + ".tmp"
+                    with open(tmp_path, 'wb') as f:
+                        f.write(index_data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, self._index_path(segment_id))
+                    self.segments[segment_id] = self.compression
+                    for session_id, (offset, length, last_updated) in entries.items():
+                        self.index[session_id] = (segment_id, offset, length, last_updated)
+                    # 从热存储删除完成前，这些会话同时在两层中
+                    self.overlap.update(entries)
+                    # 归档不是删除，不通知观察者
+                    observers, self.hot.observers = self.hot.observers, []
+                    try:
+                        self.hot.delete_conversations(list(entries))
+                        self.overlap.difference_update(entries)
+                    finally:
+                        self.hot.observers = observers
+                    return len(entries)
+            finally:
+                with self.lock:
+                    self.dirty = None
+    
+    def archive_stats(self):
+        """归档统计：段数、归档会话数和段文件总字节数"""
+        with self.lock:
+            segments = dict(self.segments)
+            sessions = len(self.index)
+        return {
+            "segments": len(segments),
+            "archived_sessions": sessions,
+            "archive_bytes": sum(os.path.getsize(self._segment_path(s, c)) for s, c in segments.items()),
+            "archived_loads": self.archived_loads
+        }
+    
+    def _archive_loop(self):
+        """后台归档线程"""
+        while not self._stop_event.wait(self.archive_interval):
+            try:
+                archived = self.archive()
+                if archived:
+                    logger.info("归档了 %d 个会话", archived)
+            except Exception as e:
+                logger.error("会话归档失败: %s", e)
+    
+    def close(self):
+        """停止后台归档并关闭热存储"""
+        self._stop_event.set()
+        self.hot.close()
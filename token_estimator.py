@@ -0,0 +1,21 @@
+# 每条消息的固定开销（角色标记、分隔符等）
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text):
+    """快速估算文本的token数
+    
+    中日韩字符大约每个字1个token，ASCII字符大约每4个字符1个token。
+    借助UTF-8编码长度在C层面统计非ASCII字符数，避免逐字符的Python循环。
+    """
+    char_count = len(text)
+    byte_count = len(text.encode('utf-8'))
+    # 常用CJK字符在UTF-8中占3个字节，非ASCII字符数约为 (字节数 - 字符数) / 2
+    non_ascii_count = min(char_count, (byte_count - char_count) // 2)
+    ascii_count = char_count - non_ascii_count
+    return non_ascii_count + (ascii_count + 3) // 4
+
+
+def estimate_message_tokens(content):
+    """估算单条消息占用的token数，包含固定开销"""
+    return estimate_tokens(content) + MESSAGE_OVERHEAD
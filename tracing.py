@@ -0,0 +1,148 @@
+import contextvars
+import functools
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from config import TRACE_CONFIG
+
+# 请求链路追踪：一次请求的各阶段耗时记录为同一个请求ID下的span
+# 当前请求的trace保存在contextvar中，线程池（asyncio.to_thread）和异步任务会自动继承；
+# 没有进行中的trace时 span 直接返回，开销可以忽略。
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """一次请求的追踪记录"""
+    
+    def __init__(self, name, request_id=None):
+        self.name = name
+        self.request_id = request_id or uuid.uuid4().hex
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.attributes = {}
+        # (名称, 相对请求开始的时间, 耗时, 嵌套深度)
+        self.spans = []
+        self.depth = 0
+    
+    def to_dict(self):
+        return {
+            "request_id": self.request_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": self.attributes,
+            "spans": [{"name": name, "start": start, "duration": duration, "depth": depth}
+                      for name, start, duration, depth in sorted(self.spans, key=lambda s: s[1])]
+        }
+
+
+@contextmanager
+def span(name):
+    """记录代码块的耗时，没有进行中的trace时不做任何事"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    depth = trace.depth
+    trace.depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.depth -= 1
+        trace.spans.append((name, start - trace.start, time.perf_counter() - start, depth))
+
+
+def traced(name):
+    """将整个函数调用记录为一个span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def mark(name):
+    """记录一个时间点，例如收到首个token"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append((name, time.perf_counter() - trace.start, 0.0, trace.depth))
+
+
+def current_request_id():
+    """当前请求的ID，没有进行中的trace时返回None"""
+    trace = _current_trace.get()
+    return trace.request_id if trace is not None else None
+
+
+def set_attribute(key, value):
+    """为当前trace附加属性"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes[key] = value
+
+
+class Tracer:
+    """管理进行中的trace，并在环形缓冲区中保留最近的慢请求"""
+    
+    def __init__(self, slow_threshold=1.0, buffer_size=100, enabled=True):
+        self.slow_threshold = slow_threshold
+        self.enabled = enabled
+        self.slow_traces = deque(maxlen=buffer_size)
+        self.lock = threading.Lock()
+        self.finished = 0
+        self.slow = 0
+    
+    def begin(self, name, request_id=None):
+        """开始一个trace并设为当前trace，未启用时返回None"""
+        if not self.enabled:
+            return None
+        trace = Trace(name, request_id)
+        _current_trace.set(trace)
+        return trace
+    
+    def end(self, trace, error=None):
+        """结束trace，超过阈值时放入慢请求缓冲区"""
+        if trace is None:
+            return
+        trace.duration = time.perf_counter() - trace.start
+        if error is not None:
+            trace.error = str(error)
+        if _current_trace.get() is trace:
+            _current_trace.set(None)
+        with self.lock:
+            self.finished += 1
+            if trace.duration >= self.slow_threshold:
+                self.slow += 1
+                self.slow_traces.append(trace)
+    
+    def recent_slow(self, limit=None):
+        """最近的慢请求，新的在前"""
+        with self.lock:
+            traces = list(self.slow_traces)
+        traces.reverse()
+        return [trace.to_dict() for trace in traces[:limit]]
+    
+    def find(self, request_id):
+        """在慢请求缓冲区中按请求ID查找"""
+        with self.lock:
+            for trace in self.slow_traces:
+                if trace.request_id == request_id:
+                    return trace.to_dict()
+        return None
+    
+    def stats(self):
+        with self.lock:
+            return {"finished": self.finished, "slow": self.slow, "buffered": len(self.slow_traces),
+                    "slow_threshold": self.slow_threshold}
+
+
+TRACER = Tracer(TRACE_CONFIG["slow_threshold"], TRACE_CONFIG["buffer_size"], TRACE_CONFIG["enabled"])
@@ -0,0 +1,168 @@
+import threading
+import time
+from metrics import STORAGE_LATENCY
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class WriteBehindQueue:
+    """按会话合并的异步批量写入队列
+    
+    同一会话的多次写入在队列中只保留最新快照，后台线程在脏会话数量达到
+    batch_size 或最早的脏数据等待超过 flush_interval 时批量写入存储。
+    队列中的会话数达到 max_pending 时，新会话的写入方会阻塞等待（背压）。
+    写入失败的批次放回队列稍后重试；关闭后最多再尝试 close_retries 次，仍失败时记录并丢弃剩余数据，
+    存储持续不可用时进程仍能退出。
+    """
+    
+    def __init__(self, storage, flush_interval=1.0, batch_size=100, max_pending=10000, close_retries=3):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.close_retries = close_retries
+        # 关闭后写入失败的次数
+        self.close_failures = 0
+        
+        # session_id -> 消息列表快照，None 表示删除
+        self.pending = {}
+        self.inflight = {}
+        self.first_pending_at = None
+        self.flush_waiters = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+    
+    def put(self, session_id, messages):
+        """登记会话的最新消息列表"""
+        self._enqueue(session_id, list(messages))
+    
+    def delete(self, session_id):
+        """登记会话删除"""
+        self._enqueue(session_id, None)
+    
+    def _enqueue(self, session_id, value):
+        with self.condition:
+            if self.closed:
+                # 关闭后直接同步写入，避免丢失数据
+                self._write({session_id: value})
+                return
+            
+            while session_id not in self.pending and len(self.pending) >= self.max_pending:
+                self.condition.notify_all()
+                self.condition.wait()
+                if self.closed:
+                    # 等待期间队列已关闭，后台线程可能已退出，改为同步写入
+                    self._write({session_id: value})
+                    return
+            
+            if not self.pending:
+                self.first_pending_at = time.time()
+            self.pending[session_id] = value
+            if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+                self.condition.notify_all()
+    
+    def lookup(self, session_id):
+        """查询尚未落盘的会话数据，返回 (是否存在, 消息列表或None)"""
+        with self.condition:
+            for store in (self.pending, self.inflight):
+                if session_id in store:
+                    messages = store[session_id]
+                    return True, (list(messages) if messages is not None else None)
+        return False, None
+    
+    def _ready(self):
+        if not self.pending:
+            return False
+        return (len(self.pending) >= self.batch_size or self.flush_waiters > 0 or self.closed
+                or time.time() - self.first_pending_at >= self.flush_interval)
+    
+    def _run(self):
+        """后台写入线程"""
+        while True:
+            with self.condition:
+                while not self._ready():
+                    if self.closed and not self.pending:
+                        return
+                    timeout = None
+                    if self.pending:
+                        timeout = max(0, self.first_pending_at + self.flush_interval - time.time())
+                    self.condition.wait(timeout)
+                
+                batch = self.inflight = self.pending
+                self.pending = {}
+                self.first_pending_at = None
+                # 唤醒因背压等待的写入方
+                self.condition.notify_all()
+            
+            failed = not self._write(batch)
+            
+            with self.condition:
+                if failed and self.closed:
+                    self.close_failures += 1
+                if failed and self.closed and self.close_failures >= self.close_retries:
+                    # 关闭后多次重试仍失败，放弃剩余数据，避免进程无法退出
+                    dropped = set(batch) | set(self.pending)
+                    logger.error("关闭时写入存储失败 %d 次，丢弃 %d 个会话的未写入数据",
+                                 self.close_failures, len(dropped))
+                    self.pending = {}
+                    self.first_pending_at = None
+                    failed = False
+                elif failed:
+                    # 写入失败时放回队列，较新的快照优先
+                    for session_id, value in batch.items():
+                        if session_id not in self.pending:
+                            self.pending[session_id] = value
+                    if self.pending and self.first_pending_at is None:
+                        self.first_pending_at = time.time()
+                self.inflight = {}
+                self.condition.notify_all()
+            
+            if failed:
+                time.sleep(self.flush_interval)
+    
+    def _write(self, batch):
+        """将一批会话写入存储"""
+        try:
+            saves = {session_id: messages for session_id, messages in batch.items() if messages is not None}
+            if saves:
+                with STORAGE_LATENCY.time(operation="save_batch"):
+                    self.storage.save_conversations(saves)
+            for session_id, messages in batch.items():
+                if messages is None:
+                    with STORAGE_LATENCY.time(operation="delete"):
+                        self.storage.delete_conversation(session_id)
+            return True
+        except Exception as e:
+            logger.error("批量写入存储失败: %s", e)
+            return False
+    
+    def flush(self, timeout=None):
+        """立即写入所有待写数据并等待完成，超时返回False"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            self.flush_waiters += 1
+            self.condition.notify_all()
+            try:
+                while self.pending or self.inflight:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                return True
+            finally:
+                self.flush_waiters -= 1
+    
+    def close(self, timeout=10):
+        """写入剩余数据并停止后台线程，最多等待 timeout 秒，超时返回False"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.worker.join(timeout)
+        if self.worker.is_alive():
+            logger.error("写回队列关闭超时，仍有 %d 个会话未写入", len(self.pending) + len(self.inflight))
+            return False
+        return True